@@ -0,0 +1,44 @@
+-- upgrade script to migrate the Koji database schema
+-- from version 1.5 to 1.6
+
+BEGIN;
+
+-- used by the hub scheduler to find the next task for a host
+CREATE INDEX task_by_queue ON task (state, channel_id, arch, priority, create_time);
+
+-- data from the rpm headers, filled in at import time (and later for older rpms)
+CREATE TABLE rpmheaders (
+	rpm_id INTEGER NOT NULL PRIMARY KEY REFERENCES rpminfo (id),
+	digest_algo TEXT NOT NULL,
+	summary TEXT,
+	description TEXT,
+	url TEXT,
+	license TEXT
+) WITHOUT OIDS;
+
+CREATE TABLE rpmfiles (
+	rpm_id INTEGER NOT NULL REFERENCES rpmheaders (rpm_id),
+	idx INTEGER NOT NULL,
+	name TEXT NOT NULL,
+	digest TEXT NOT NULL,
+	size BIGINT NOT NULL,
+	flags INTEGER NOT NULL,
+	username TEXT NOT NULL,
+	groupname TEXT NOT NULL,
+	mtime BIGINT NOT NULL,
+	mode INTEGER NOT NULL,
+	PRIMARY KEY (rpm_id, idx)
+) WITHOUT OIDS;
+CREATE INDEX rpmfiles_by_name ON rpmfiles(rpm_id, name);
+
+CREATE TABLE rpmdeps (
+	rpm_id INTEGER NOT NULL REFERENCES rpmheaders (rpm_id),
+	idx INTEGER NOT NULL,
+	type INTEGER NOT NULL,
+	name TEXT NOT NULL,
+	version TEXT NOT NULL,
+	flags INTEGER NOT NULL,
+	PRIMARY KEY (rpm_id, idx)
+) WITHOUT OIDS;
+
+COMMIT;
@@ -8,6 +8,9 @@ DROP TABLE log_messages;
 DROP TABLE buildroot_listing;
 DROP TABLE imageinfo_listing;
 
+DROP TABLE rpmfiles;
+DROP TABLE rpmdeps;
+DROP TABLE rpmheaders;
 DROP TABLE rpminfo;
 DROP TABLE imageinfo;
 
@@ -248,6 +251,8 @@ CREATE TABLE task (
 CREATE INDEX task_by_state ON task (state);
 -- CREATE INDEX task_by_parent ON task (parent);   (unique condition creates similar index)
 CREATE INDEX task_by_host ON task (host_id);
+-- used by the hub scheduler to find the next task for a host
+CREATE INDEX task_by_queue ON task (state, channel_id, arch, priority, create_time);
 
 
 -- by package, we mean srpm
@@ -614,6 +619,42 @@ CREATE TABLE rpmsigs (
 	CONSTRAINT rpmsigs_no_resign UNIQUE (rpm_id, sigkey)
 ) WITHOUT OIDS;
 
+-- data from the rpm headers, stored so that file and dependency queries
+-- do not have to read the rpms. idx keeps the header order.
+CREATE TABLE rpmheaders (
+	rpm_id INTEGER NOT NULL PRIMARY KEY REFERENCES rpminfo (id),
+	digest_algo TEXT NOT NULL,
+	summary TEXT,
+	description TEXT,
+	url TEXT,
+	license TEXT
+) WITHOUT OIDS;
+
+CREATE TABLE rpmfiles (
+	rpm_id INTEGER NOT NULL REFERENCES rpmheaders (rpm_id),
+	idx INTEGER NOT NULL,
+	name TEXT NOT NULL,
+	digest TEXT NOT NULL,
+	size BIGINT NOT NULL,
+	flags INTEGER NOT NULL,
+	username TEXT NOT NULL,
+	groupname TEXT NOT NULL,
+	mtime BIGINT NOT NULL,
+	mode INTEGER NOT NULL,
+	PRIMARY KEY (rpm_id, idx)
+) WITHOUT OIDS;
+CREATE INDEX rpmfiles_by_name ON rpmfiles(rpm_id, name);
+
+CREATE TABLE rpmdeps (
+	rpm_id INTEGER NOT NULL REFERENCES rpmheaders (rpm_id),
+	idx INTEGER NOT NULL,
+	type INTEGER NOT NULL,
+	name TEXT NOT NULL,
+	version TEXT NOT NULL,
+	flags INTEGER NOT NULL,
+	PRIMARY KEY (rpm_id, idx)
+) WITHOUT OIDS;
+
 -- buildroot_listing needs to be created after rpminfo so it can reference it
 CREATE TABLE buildroot_listing (
 	buildroot_id INTEGER NOT NULL REFERENCES buildroot(id),
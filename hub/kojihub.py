@@ -23,11 +23,14 @@
 
 import base64
 import calendar
+import cgi
 import koji
 import koji.auth
 import koji.db
+import koji.jsonrpc
 import koji.plugin
 import koji.policy
+import koji.scheduler
 import datetime
 import errno
 import logging
@@ -40,11 +43,13 @@ import os
 import random
 import re
 import rpm
+import shutil
 import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import types
 import xmlrpclib
@@ -274,6 +279,7 @@ class Task(object):
         WHERE id = %(task_id)d
         """
         _dml(update,locals())
+        notify_task_events()
         self.runCallbacks('postTaskStateChange', info, 'state', state)
         self.runCallbacks('postTaskStateChange', info, 'completion_ts', now)
 
@@ -323,6 +329,7 @@ class Task(object):
         update = """UPDATE task SET state = %(st_canceled)i, completion_time = NOW()
         WHERE id = %(task_id)i"""
         _dml(update, locals())
+        notify_task_events()
         self.runCallbacks('postTaskStateChange', info, 'state', koji.TASK_STATES['CANCELED'])
         self.runCallbacks('postTaskStateChange', info, 'completion_ts', now)
         #cancel associated builds (only if state is 'BUILDING')
@@ -515,7 +522,8 @@ def make_task(method,arglist,**opts):
         t_opts = args.get('opts', {})
         policy_data['scratch'] = t_opts.get('scratch', False)
     ruleset = context.policy.get('channel')
-    result = ruleset.apply(policy_data)
+    log_policy_input('channel', policy_data)
+    result = ruleset.apply(policy_data, cache=policy_cache())
     if result is None:
         logger.warning('Channel policy returned no result, using default')
         opts['channel_id'] = get_channel_id('default', strict=True)
@@ -703,14 +711,13 @@ def writeInheritanceData(tag_id, changes, clear=False):
         insert = InsertProcessor('tag_inheritance', data=newlink)
         insert.make_create()
         insert.execute()
+    inheritance_cache.invalidate()
 
 def readFullInheritance(tag_id,event=None,reverse=False,stops={},jumps={}):
     """Returns a list representing the full, ordered inheritance from tag"""
-    order = []
-    readFullInheritanceRecurse(tag_id,event,order,stops,{},{},0,None,False,[],reverse,jumps)
-    return order
+    return inheritance_cache.get(tag_id, event, reverse, stops, jumps)
 
-def readFullInheritanceRecurse(tag_id,event,order,prunes,top,hist,currdepth,maxdepth,noconfig,pfilter,reverse,jumps):
+def readFullInheritanceRecurse(tag_id,event,order,prunes,top,hist,currdepth,maxdepth,noconfig,pfilter,reverse,jumps,reader=None):
     if maxdepth is not None and maxdepth < 1:
         return
     #note: maxdepth is relative to where we are, but currdepth is absolute from
@@ -718,7 +725,9 @@ def readFullInheritanceRecurse(tag_id,event,order,prunes,top,hist,currdepth,maxd
     currdepth += 1
     top = top.copy()
     top[tag_id] = 1
-    if reverse:
+    if reader is not None:
+        node = reader(tag_id, reverse)
+    elif reverse:
         node = readDescendantsData(tag_id,event)
     else:
         node = readInheritanceData(tag_id,event)
@@ -791,7 +800,150 @@ def readFullInheritanceRecurse(tag_id,event,order,prunes,top,hist,currdepth,maxd
             hist[id] = []
         hist[id].append(link)   #record history
         order.append(link)
-        readFullInheritanceRecurse(id,event,order,prunes,top,hist,currdepth,nextdepth,noconfig,filter,reverse,jumps)
+        readFullInheritanceRecurse(id,event,order,prunes,top,hist,currdepth,nextdepth,noconfig,filter,reverse,jumps,reader)
+
+
+class InheritanceSnapshot(object):
+    """The tag_inheritance table as of a single event, indexed for tree walks"""
+
+    fields = ('tag_id','parent_id','priority','maxdepth','intransitive','noconfig','pkg_filter')
+
+    def __init__(self, event=None):
+        self.event = event
+        self.parents = {}
+        self.children = {}
+        self.results = {}
+        q = """SELECT %s FROM tag_inheritance
+        WHERE %s
+        ORDER BY priority, tag_id
+        """ % (",".join(self.fields), eventCondition(event))
+        for row in _multiRow(q, {}, self.fields):
+            self.parents.setdefault(row['tag_id'], []).append(row)
+            self.children.setdefault(row['parent_id'], []).append(row)
+
+    def node(self, tag_id, reverse):
+        """Return fresh link data for a tag, as readInheritanceData or
+        readDescendantsData would (minus the tag names)"""
+        if reverse:
+            return [row.copy() for row in self.children.get(tag_id, [])]
+        data = []
+        for row in self.parents.get(tag_id, []):
+            link = row.copy()
+            del link['tag_id']
+            link['child_id'] = tag_id
+            data.append(link)
+        return data
+
+    def walk(self, tag_id, reverse, stops, jumps):
+        order = []
+        # the walk records pruned tags in the stops dict, so give it a copy
+        readFullInheritanceRecurse(tag_id, self.event, order, stops.copy(), {}, {}, 0,
+                                   None, False, [], reverse, jumps, self.node)
+        return order
+
+
+class InheritanceCache(object):
+    """Process-wide cache of full inheritance data
+
+    Rather than querying tag_inheritance once per node of the tree, the whole
+    table is loaded once per event and walks are done in memory. The results
+    of each walk are kept, keyed by (tag_id, event, reverse, stops, jumps).
+
+    Data for a past event never changes. The current data (event=None) is
+    keyed by the most recent create/revoke event in tag_inheritance, which is
+    checked once per request, so changes made by other hub processes are
+    picked up. writeInheritanceData invalidates the cache directly.
+
+    The cache is shared by the request threads of the process. Snapshots
+    are loaded outside of the lock and only added under it, so a thread
+    that loses a race uses the snapshot of the winner.
+    """
+
+    max_snapshots = 8
+
+    def __init__(self):
+        self.current = None
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def _stamp(self):
+        stamp = getattr(context, 'inheritance_stamp', None)
+        if stamp is None:
+            q = """SELECT MAX(create_event), MAX(revoke_event) FROM tag_inheritance"""
+            stamp = tuple(_fetchSingle(q, {}, strict=True))
+            context.inheritance_stamp = stamp
+        return stamp
+
+    def snapshot(self, event=None):
+        if event is None:
+            stamp = self._stamp()
+            current = self.current
+            if current is None or current[0] != stamp:
+                current = (stamp, InheritanceSnapshot())
+                self.current = current
+            return current[1]
+        snap = self.snapshots.get(event)
+        if snap is not None:
+            return snap
+        snap = InheritanceSnapshot(event)
+        self.lock.acquire()
+        try:
+            if self.snapshots.has_key(event):
+                return self.snapshots[event]
+            if len(self.snapshots) >= self.max_snapshots:
+                del self.snapshots[min(self.snapshots)]
+            self.snapshots[event] = snap
+        finally:
+            self.lock.release()
+        return snap
+
+    def get(self, tag_id, event=None, reverse=False, stops={}, jumps={}):
+        snap = self.snapshot(event)
+        key = (tag_id, bool(reverse), tuple(sorted(stops.items())), tuple(sorted(jumps.items())))
+        order = snap.results.get(key)
+        if order is None:
+            order = snap.walk(tag_id, reverse, stops, jumps)
+            snap.results[key] = order
+        # callers are free to modify what we return
+        ret = []
+        for link in order:
+            link = link.copy()
+            link['filter'] = list(link['filter'])
+            ret.append(link)
+        if reverse:
+            name_key = 'tag_id'
+        else:
+            name_key = 'parent_id'
+        names = self._names([link[name_key] for link in ret])
+        for link in ret:
+            link['name'] = names[link[name_key]]
+        return ret
+
+    def _names(self, tag_ids):
+        """Return a map of tag names, cached for the current request
+
+        Names are not versioned (see edit_tag), so they are not part of the
+        snapshot data.
+        """
+        names = getattr(context, 'inheritance_names', None)
+        if names is None:
+            names = {}
+            context.inheritance_names = names
+        missing = dict([(tag_id, 1) for tag_id in tag_ids if not names.has_key(tag_id)]).keys()
+        if missing:
+            q = """SELECT id, name FROM tag WHERE id IN %(missing)s"""
+            for tag_id, name in _fetchMulti(q, locals()):
+                names[tag_id] = name
+        return names
+
+    def invalidate(self):
+        """Drop the current inheritance data"""
+        self.current = None
+        for key in ('inheritance_stamp', 'inheritance_names'):
+            if hasattr(context, key):
+                delattr(context, key)
+
+inheritance_cache = InheritanceCache()
 
 # tag-package operations
 #       add
@@ -1066,6 +1218,56 @@ def readTaggedBuilds(tag,event=None,inherit=False,latest=False,package=None,owne
     packages = readPackageList(tagID=tag, event=event, inherit=True, pkgID=package)
 
     #these values are used for each iteration
+    fields, type_join = _taggedBuildsFields(type)
+    st_complete = koji.BUILD_STATES['COMPLETE']
+
+    if use_set_listings():
+        q = _taggedBuildsSetQuery(fields, type_join, taglist, event, latest, package, owner)
+        listings = [_multiRow(q, locals(), [pair[1] for pair in fields])]
+    else:
+        listings = _taggedBuildsLoop(fields, type_join, taglist, event, package, owner)
+
+    builds = []
+    seen = {}   # used to enforce the 'latest' option
+    for listing in listings:
+        for build in listing:
+            pkgid = build['package_id']
+            pinfo = packages.get(pkgid,None)
+            if pinfo is None or pinfo['blocked']:
+                # note:
+                # tools should endeavor to keep tag_listing sane w.r.t.
+                # the package list, but if there is disagreement the package
+                # list should take priority
+                continue
+            if latest:
+                if seen.has_key(pkgid):
+                    #only take the first (note ordering in query above)
+                    continue
+                seen[pkgid] = 1
+            builds.append(build)
+
+    return builds
+
+def use_set_listings():
+    """Should inherited listings be computed with a single set-based query?
+
+    The set-based queries use window functions, which require PostgreSQL 8.4
+    or later. Otherwise we fall back to querying one tag at a time.
+    """
+    return bool(context.opts.get('SetBasedListings'))
+
+def _uniqueTags(taglist):
+    """Return taglist with only the first appearance of each tag"""
+    ret = []
+    tags_seen = {}
+    for tag_id in taglist:
+        if not tags_seen.has_key(tag_id):
+            tags_seen[tag_id] = 1
+            ret.append(tag_id)
+    return ret
+
+def _taggedBuildsFields(type):
+    """Return the fields and type join used to list tagged builds"""
     fields = [('tag.id', 'tag_id'), ('tag.name', 'tag_name'), ('build.id', 'id'),
               ('build.id', 'build_id'), ('build.version', 'version'), ('build.release', 'release'),
               ('build.epoch', 'epoch'), ('build.state', 'state'), ('build.completion_time', 'completion_time'),
@@ -1075,7 +1277,6 @@ def readTaggedBuilds(tag,event=None,inherit=False,latest=False,package=None,owne
               ('package.name', 'name'),
               ("package.name || '-' || build.version || '-' || build.release", 'nvr'),
               ('users.id', 'owner_id'), ('users.name', 'owner_name')]
-    st_complete = koji.BUILD_STATES['COMPLETE']
 
     type_join = ''
     if type is None:
@@ -1090,7 +1291,14 @@ def readTaggedBuilds(tag,event=None,inherit=False,latest=False,package=None,owne
         fields.append(('win_builds.platform', 'platform'))
     else:
         raise koji.GenericError, 'unsupported build type: %s' % type
+    return fields, type_join
+
+def _taggedBuildsLoop(fields, type_join, taglist, event, package=None, owner=None):
+    """Yield the tag_listing data for each tag in taglist, one query per tag
 
+    Each result lists the latest taggings first.
+    """
+    st_complete = koji.BUILD_STATES['COMPLETE']
     q="""SELECT %s
     FROM tag_listing
     JOIN tag ON tag.id = tag_listing.tag_id
@@ -1112,27 +1320,59 @@ def readTaggedBuilds(tag,event=None,inherit=False,latest=False,package=None,owne
     """
     # i.e. latest first
 
-    builds = []
-    seen = {}   # used to enforce the 'latest' option
     for tagid in taglist:
         #log_error(koji.db._quoteparams(q,locals()))
-        for build in _multiRow(q, locals(), [pair[1] for pair in fields]):
-            pkgid = build['package_id']
-            pinfo = packages.get(pkgid,None)
-            if pinfo is None or pinfo['blocked']:
-                # note:
-                # tools should endeavor to keep tag_listing sane w.r.t.
-                # the package list, but if there is disagreement the package
-                # list should take priority
-                continue
-            if latest:
-                if seen.has_key(pkgid):
-                    #only take the first (note ordering in query above)
-                    continue
-                seen[pkgid] = 1
-            builds.append(build)
+        yield _multiRow(q, locals(), [pair[1] for pair in fields])
 
-    return builds
+def _taggedBuildsSetQuery(fields, type_join, taglist, event, latest, package=None, owner=None, order=True):
+    """Return a single query listing the builds tagged in all of taglist
+
+    This is the set-based equivalent of _taggedBuildsLoop. The inheritance
+    order is passed in as a VALUES list and rows come back in that order,
+    latest taggings first within each tag. If latest is true, only the first
+    row for each package is returned (the package list is not applied here).
+
+    The query expects st_complete, package and owner in its values.
+    """
+    if latest:
+        # only the first appearance of a tag can matter
+        taglist = _uniqueTags(taglist)
+    tag_order = ', '.join(['(%i, %i)' % (idx, tag_id) for idx, tag_id in enumerate(taglist)])
+    columns = ', '.join(['%s AS "%s"' % pair for pair in fields])
+    aliases = ', '.join(['"%s"' % pair[1] for pair in fields])
+    rank = ''
+    if latest:
+        rank = """,
+        row_number() OVER (PARTITION BY build.pkg_id
+                           ORDER BY tag_order.idx, tag_listing.create_event DESC) AS pkg_rank"""
+    q = """SELECT %s FROM (
+    SELECT %s, tag_order.idx AS tag_idx, tag_listing.create_event AS listing_event%s
+    FROM (VALUES %s) AS tag_order (idx, tag_id)
+    JOIN tag_listing ON tag_listing.tag_id = tag_order.tag_id
+    JOIN tag ON tag.id = tag_listing.tag_id
+    JOIN build ON build.id = tag_listing.build_id
+    %s
+    JOIN users ON users.id = build.owner
+    JOIN events ON events.id = build.create_event
+    JOIN package ON package.id = build.pkg_id
+    WHERE %s
+        AND build.state=%%(st_complete)i
+    """ % (aliases, columns, rank, tag_order, type_join, eventCondition(event, 'tag_listing'))
+    if package:
+        q += """AND package.name = %(package)s
+        """
+    if owner:
+        q += """AND users.name = %(owner)s
+        """
+    q += """) AS listing
+    """
+    if latest:
+        q += """WHERE pkg_rank = 1
+    """
+    if order:
+        q += """ORDER BY tag_idx, listing_event DESC
+    """
+    return q
 
 def readTaggedRPMS(tag, package=None, arch=None, event=None,inherit=False,latest=True,rpmsigs=False,owner=None,type=None):
     """Returns a list of rpms for specified tag
@@ -1146,8 +1386,6 @@ def readTaggedRPMS(tag, package=None, arch=None, event=None,inherit=False,latest
     """
     taglist = [tag]
     if inherit:
-        #XXX really should cache this - it gets called several places
-        #   (however, it is fairly quick)
         taglist += [link['parent_id'] for link in readFullInheritance(tag, event)]
 
     builds = readTaggedBuilds(tag, event=event, inherit=inherit, latest=latest, package=package, owner=owner, type=type)
@@ -1179,7 +1417,7 @@ def readTaggedRPMS(tag, package=None, arch=None, event=None,inherit=False,latest
         q += """LEFT OUTER JOIN rpmsigs on rpminfo.id = rpmsigs.rpm_id
         """
     q += """WHERE %s AND tag_id=%%(tagid)s
-    """ % eventCondition(event)
+    """ % eventCondition(event, 'tag_listing')
     if package:
         q += """AND package.name = %(package)s
         """
@@ -1192,6 +1430,10 @@ def readTaggedRPMS(tag, package=None, arch=None, event=None,inherit=False,latest
         else:
             raise koji.GenericError, 'invalid arch option: %s' % arch
 
+    if use_set_listings():
+        return [_readTaggedRPMSSet(taglist, fields, build_idx, event, latest, package, arch,
+                                   rpmsigs, owner, type), builds]
+
     # unique constraints ensure that each of these queries will not report
     # duplicate rpminfo entries, BUT since we make the query multiple times,
     # we can get duplicates if a package is multiply tagged.
@@ -1222,6 +1464,46 @@ def readTaggedRPMS(tag, package=None, arch=None, event=None,inherit=False,latest
             rpms.append(rpminfo)
     return [rpms,builds]
 
+def _readTaggedRPMSSet(taglist, fields, build_idx, event, latest, package, arch, rpmsigs, owner, type):
+    """Set-based equivalent of the per-tag loop in readTaggedRPMS
+
+    The rpms are read with a single query against the set-based build
+    listing, so for latest listings only rpms from the latest builds are
+    fetched. The results are returned in inheritance order.
+    """
+    taglist = _uniqueTags(taglist)
+    st_complete = koji.BUILD_STATES['COMPLETE']
+    type_join = _taggedBuildsFields(type)[1]
+    listing = _taggedBuildsSetQuery([('build.id', 'build_id'), ('tag.id', 'tag_id')], type_join,
+                                    taglist, event, latest, package, owner, order=False)
+    fields = fields + [('listing.tag_id', 'listing_tag_id')]
+    q = """SELECT %s FROM rpminfo
+    JOIN (%s) AS listing ON rpminfo.build_id = listing.build_id
+    """ % (', '.join([pair[0] for pair in fields]), listing)
+    if rpmsigs:
+        q += """LEFT OUTER JOIN rpmsigs on rpminfo.id = rpmsigs.rpm_id
+        """
+    if arch:
+        if isinstance(arch, basestring):
+            q += """WHERE rpminfo.arch = %(arch)s\n"""
+        elif isinstance(arch, (list, tuple)):
+            q += """WHERE rpminfo.arch IN %(arch)s\n"""
+        else:
+            raise koji.GenericError, 'invalid arch option: %s' % arch
+
+    tag_idx = dict([(tag_id, idx) for idx, tag_id in enumerate(taglist)])
+    rpms = []
+    for rpminfo in _multiRow(q, locals(), [pair[1] for pair in fields]):
+        tagid = rpminfo.pop('listing_tag_id')
+        # as in readTaggedRPMS, the build list has the final say
+        build = build_idx.get(rpminfo['build_id'],None)
+        if build is None or build['tag_id'] != tagid:
+            continue
+        rpms.append((tag_idx[tagid], rpminfo))
+    # sort is stable, so this just groups the rpms by tag
+    rpms.sort(key=lambda x: x[0])
+    return [x[1] for x in rpms]
+
 def readTaggedArchives(tag, package=None, event=None, inherit=False, latest=True, type=None):
     """Returns a list of archives for specified tag
 
@@ -1861,6 +2143,7 @@ def add_host_to_channel(hostname, channel_name, create=False):
     insert = InsertProcessor('host_channels')
     insert.set(host_id=host_id, channel_id=channel_id)
     insert.execute()
+    host_channel_cache.invalidate()
 
 def remove_host_from_channel(hostname, channel_name):
     context.session.assertPerm('admin')
@@ -1882,6 +2165,7 @@ def remove_host_from_channel(hostname, channel_name):
     c = context.cnx.cursor()
     c.execute("""DELETE FROM host_channels WHERE host_id = %(host_id)d and channel_id = %(channel_id)d""", locals())
     context.commit_pending = True
+    host_channel_cache.invalidate()
 
 def rename_channel(old, new):
     """Rename a channel"""
@@ -1917,9 +2201,66 @@ def remove_channel(channel_name, force=False):
             raise koji.GenericError, 'channel %s has host references' % channel_name
         delete = """DELETE FROM host_channels WHERE channel_id=%(channel_id)i"""
         _dml(delete, locals())
+        host_channel_cache.invalidate()
     delete = """DELETE FROM channels WHERE id=%(channel_id)i"""
     _dml(delete, locals())
 
+def notify_task_events():
+    """Wake hosts waiting in host.waitForTaskEvents
+
+    The notification is sent when the current transaction commits.
+    """
+    context.cnx.cursor().execute('NOTIFY koji_task_events')
+
+class HostChannelCache(object):
+    """Process-wide cache of the host/channel map
+
+    get_ready_hosts is called on every getLoadData poll from every builder,
+    so the channel map is loaded with a single query and kept for
+    HostChannelCacheTTL seconds (0 disables the cache). Changes made through
+    this process invalidate it directly; changes made by other hub processes
+    are picked up when the TTL expires.
+
+    The map and its load time are replaced together under a lock, since
+    the request threads of the process share the cache.
+    """
+
+    def __init__(self):
+        self.data = None
+        # bumped by invalidate, so that a load that overlaps it is not kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return a map of host id to a list of channel ids"""
+        ttl = context.opts.get('HostChannelCacheTTL', 30)
+        now = time.time()
+        data = self.data
+        if data is not None and now - data[0] < ttl:
+            return data[1]
+        generation = self.generation
+        channels = {}
+        q = """SELECT host_id, channel_id FROM host_channels"""
+        for host_id, channel_id in _fetchMulti(q, {}):
+            channels.setdefault(host_id, []).append(channel_id)
+        self.lock.acquire()
+        try:
+            if self.generation == generation:
+                self.data = (now, channels)
+        finally:
+            self.lock.release()
+        return channels
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.data = None
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+host_channel_cache = HostChannelCache()
+
 def get_ready_hosts():
     """Return information about hosts that are ready to build.
 
@@ -1941,10 +2282,9 @@ def get_ready_hosts():
     # XXX - magic number in query
     c.execute(q)
     hosts = [dict(zip(aliases,row)) for row in c.fetchall()]
+    channels = host_channel_cache.get()
     for host in hosts:
-        q = """SELECT channel_id FROM host_channels WHERE host_id=%(id)s"""
-        c.execute(q,host)
-        host['channels'] = [row[0] for row in c.fetchall()]
+        host['channels'] = list(channels.get(host['id'], []))
     return hosts
 
 def get_all_arches():
@@ -2050,73 +2390,63 @@ def repo_init(tag, with_src=False, with_debuginfo=False, event=None):
     q = """INSERT INTO repo(id, create_event, tag_id, state)
     VALUES(%(repo_id)s, %(event_id)s, %(tag_id)s, %(state)s)"""
     _dml(q,locals())
-    # Need to pass event_id because even though this is a single transaction,
-    # it is possible to see the results of other committed transactions
-    rpms, builds = readTaggedRPMS(tag_id, event=event_id, inherit=True, latest=True)
-    groups = readTagGroups(tag_id, event=event_id, inherit=True)
-    blocks = [pkg for pkg in readPackageList(tag_id, event=event_id, inherit=True).values() \
-                  if pkg['blocked']]
     repodir = koji.pathinfo.repo(repo_id, tinfo['name'])
     os.makedirs(repodir)  #should not already exist
-    #index builds
-    builds = dict([[build['build_id'],build] for build in builds])
-    #index the packages by arch
-    packages = {}
-    for repoarch in repo_arches:
-        packages.setdefault(repoarch, [])
-    for rpminfo in rpms:
-        if not with_debuginfo and koji.is_debuginfo(rpminfo['name']):
-            continue
-        arch = rpminfo['arch']
-        repoarch = koji.canonArch(arch)
-        if arch == 'src':
-            if not with_src:
-                continue
-        elif arch == 'noarch':
-            pass
-        elif repoarch not in repo_arches:
-            # Do not create a repo for arches not in the arch list for this tag
-            continue
-        build = builds[rpminfo['build_id']]
-        rpminfo['path'] = "%s/%s" % (koji.pathinfo.build(build), koji.pathinfo.rpm(rpminfo))
-        packages.setdefault(repoarch,[]).append(rpminfo)
+    # what a later repo needs to know to be generated from this one
+    repo_opts = {'id': repo_id, 'tag_id': tag_id, 'event_id': event_id,
+                 'with_src': bool(with_src), 'with_debuginfo': bool(with_debuginfo),
+                 'arches': sorted(repo_arches.keys())}
+    if koji.jsonrpc.json is not None:
+        fo = file(os.path.join(repodir, 'repo.json'), 'w')
+        fo.write(koji.jsonrpc.json.dumps(repo_opts))
+        fo.close()
+
+    delta = None
+    if context.opts.get('IncrementalRepoInit'):
+        delta = _repo_init_delta(tinfo, repo_opts)
+    if delta:
+        prevdir, pkglists, blocks, groups_changed = delta
+        logger.info("Creating repo %i from repo %s", repo_id, os.path.basename(prevdir))
+    else:
+        # Need to pass event_id because even though this is a single transaction,
+        # it is possible to see the results of other committed transactions
+        rpms, builds = readTaggedRPMS(tag_id, event=event_id, inherit=True, latest=True)
+        pkglists = _repo_pkglists(rpms, builds, repo_arches, with_src, with_debuginfo)
+        blocks = [pkg['package_name'] for pkg in
+                  readPackageList(tag_id, event=event_id, inherit=True).values()
+                  if pkg['blocked']]
     #generate comps and groups.spec
     groupsdir = "%s/groups" % (repodir)
     koji.ensuredir(groupsdir)
-    comps = koji.generate_comps(groups, expand_groups=True)
-    fo = file("%s/comps.xml" % groupsdir,'w')
-    fo.write(comps)
-    fo.close()
+    if delta and not groups_changed:
+        shutil.copyfile(os.path.join(prevdir, 'groups', 'comps.xml'),
+                        os.path.join(groupsdir, 'comps.xml'))
+    else:
+        groups = readTagGroups(tag_id, event=event_id, inherit=True)
+        comps = koji.generate_comps(groups, expand_groups=True)
+        fo = file("%s/comps.xml" % groupsdir,'w')
+        fo.write(comps)
+        fo.close()
 
     if context.opts.get('EnableMaven') and tinfo['maven_support']:
         maven_builds = maven_tag_packages(tinfo, event_id)
 
     #link packages
-    for arch in packages.iterkeys():
-        if arch in ['src','noarch']:
-            continue
-            # src and noarch special-cased -- see below
+    for arch, lines in pkglists.iteritems():
         archdir = os.path.join(repodir, arch)
         koji.ensuredir(archdir)
         pkglist = file(os.path.join(repodir, arch, 'pkglist'), 'w')
         logger.info("Creating package list for %s" % arch)
-        for rpminfo in packages[arch]:
-            pkglist.write(rpminfo['path'].split(os.path.join(koji.pathinfo.topdir, 'packages/'))[1] + '\n')
-        #noarch packages
-        for rpminfo in packages.get('noarch',[]):
-            pkglist.write(rpminfo['path'].split(os.path.join(koji.pathinfo.topdir, 'packages/'))[1] + '\n')
-        # srpms
-        if with_src:
-            srpmdir = "%s/%s" % (repodir,'src')
-            koji.ensuredir(srpmdir)
-            for rpminfo in packages.get('src',[]):
-                pkglist.write(rpminfo['path'].split(os.path.join(koji.pathinfo.topdir, 'packages/'))[1] + '\n')
+        for line in lines:
+            pkglist.write(line + '\n')
         pkglist.close()
+        if with_src:
+            koji.ensuredir(os.path.join(repodir, 'src'))
         #write list of blocked packages
         blocklist = file(os.path.join(repodir, arch, 'blocklist'), 'w')
         logger.info("Creating blocked list for %s" % arch)
-        for pkg in blocks:
-            blocklist.write(pkg['package_name'])
+        for name in blocks:
+            blocklist.write(name)
             blocklist.write('\n')
         blocklist.close()
 
@@ -2133,8 +2463,8 @@ def repo_init(tag, with_src=False, with_debuginfo=False, event=None):
                 pkglist_fo.close()
                 blocklist = file(os.path.join(repodir, arch, 'blocklist'), 'w')
                 logger.info("Creating missing blocked list for %s" % arch)
-                for pkg in blocks:
-                    blocklist.write(pkg['package_name'])
+                for name in blocks:
+                    blocklist.write(name)
                     blocklist.write('\n')
                 blocklist.close()
 
@@ -2153,6 +2483,158 @@ def repo_init(tag, with_src=False, with_debuginfo=False, event=None):
                               event=event, repo_id=repo_id)
     return [repo_id, event_id]
 
+def _repo_pkglists(rpms, builds, repo_arches, with_src, with_debuginfo):
+    """Return the pkglist lines for each arch of a repo
+
+    The lines are the rpm paths relative to the packages directory. The
+    list for each arch also has the noarch rpms (and the srpms if
+    with_src is true).
+    """
+    #index builds
+    builds = dict([[build['build_id'],build] for build in builds])
+    #index the packages by arch
+    packages = {}
+    for repoarch in repo_arches:
+        packages.setdefault(repoarch, [])
+    for rpminfo in rpms:
+        if not with_debuginfo and koji.is_debuginfo(rpminfo['name']):
+            continue
+        arch = rpminfo['arch']
+        repoarch = koji.canonArch(arch)
+        if arch == 'src':
+            if not with_src:
+                continue
+        elif arch == 'noarch':
+            pass
+        elif repoarch not in repo_arches:
+            # Do not create a repo for arches not in the arch list for this tag
+            continue
+        build = builds[rpminfo['build_id']]
+        path = "%s/%s" % (koji.pathinfo.build(build), koji.pathinfo.rpm(rpminfo))
+        path = path.split(os.path.join(koji.pathinfo.topdir, 'packages/'))[1]
+        packages.setdefault(repoarch,[]).append(path)
+    pkglists = {}
+    for arch in packages.iterkeys():
+        if arch in ['src','noarch']:
+            continue
+            # src and noarch special-cased -- see below
+        pkglists[arch] = packages[arch] + packages.get('noarch', [])
+        # srpms
+        if with_src:
+            pkglists[arch].extend(packages.get('src', []))
+    return pkglists
+
+def _repo_init_delta(tinfo, repo_opts):
+    """Work out the content of a new repo from the previous one
+
+    The previous repo is the latest ready repo for the tag with the same
+    options. Only the packages whose tag_listing or tag_packages entries
+    changed (in any tag of the inheritance) since it was created are looked
+    up again.
+
+    Returns a tuple of (prevdir, pkglists, blocks, groups_changed), or None
+    if the repo has to be generated in full: if the inheritance, arches or
+    external repos changed, if there are more than IncrementalRepoMaxChanges
+    changed packages, or if the tag has maven support.
+    """
+    logger = logging.getLogger("koji.hub.repo_init")
+    if koji.jsonrpc.json is None:
+        return None
+    if context.opts.get('EnableMaven') and tinfo['maven_support']:
+        return None
+    tag_id = tinfo['id']
+    event_id = repo_opts['event_id']
+    values = {'tag_id': tag_id, 'event_id': event_id, 'st_ready': koji.REPO_READY}
+    q = """SELECT id, create_event FROM repo
+    WHERE tag_id = %(tag_id)i AND state = %(st_ready)i AND create_event <= %(event_id)i
+    ORDER BY create_event DESC, id DESC
+    LIMIT 1"""
+    row = _fetchSingle(q, values)
+    if not row:
+        return None
+    prev_id, prev_event = row
+    prevdir = koji.pathinfo.repo(prev_id, tinfo['name'])
+    try:
+        fo = file(os.path.join(prevdir, 'repo.json'))
+        prev_opts = koji.jsonrpc.json.loads(fo.read())
+        fo.close()
+    except (IOError, ValueError):
+        # repos from before repo.json was written
+        logger.info("Unable to read options of repo %s", prev_id)
+        return None
+    for key in ('with_src', 'with_debuginfo', 'arches'):
+        if prev_opts.get(key) != repo_opts[key]:
+            logger.info("Repo %s has different %s", prev_id, key)
+            return None
+    inheritance = readFullInheritance(tag_id, event=event_id)
+    if readFullInheritance(tag_id, event=prev_event) != inheritance:
+        logger.info("Inheritance changed since repo %s", prev_id)
+        return None
+    if get_external_repo_list(tag_id, event=prev_event) != \
+            get_external_repo_list(tag_id, event=event_id):
+        logger.info("External repos changed since repo %s", prev_id)
+        return None
+
+    taglist = [tag_id] + [link['parent_id'] for link in inheritance]
+    values['taglist'] = tuple(_uniqueTags(taglist))
+    values['prev_event'] = prev_event
+    changed = """((%(table)s.create_event > %%(prev_event)i AND %(table)s.create_event <= %%(event_id)i)
+        OR (%(table)s.revoke_event > %%(prev_event)i AND %(table)s.revoke_event <= %%(event_id)i))
+        AND %(table)s.tag_id IN %%(taglist)s"""
+    q = """SELECT DISTINCT package.name FROM tag_listing
+    JOIN build ON build.id = tag_listing.build_id
+    JOIN package ON package.id = build.pkg_id
+    WHERE """ + changed % {'table': 'tag_listing'}
+    names = [r[0] for r in _fetchMulti(q, values)]
+    q = """SELECT DISTINCT package.name FROM tag_packages
+    JOIN package ON package.id = tag_packages.package_id
+    WHERE """ + changed % {'table': 'tag_packages'}
+    listing_changes = [r[0] for r in _fetchMulti(q, values)]
+    affected = dict.fromkeys(names + listing_changes)
+    max_changes = context.opts.get('IncrementalRepoMaxChanges', 100)
+    if len(affected) > max_changes:
+        logger.info("%i packages changed since repo %s", len(affected), prev_id)
+        return None
+    groups_changed = False
+    for table in ('group_config', 'group_package_listing', 'group_req_listing'):
+        q = """SELECT 1 FROM %s WHERE %s LIMIT 1""" % (table, changed % {'table': table})
+        if _fetchSingle(q, values):
+            groups_changed = True
+            break
+
+    if not os.path.isfile(os.path.join(prevdir, 'groups', 'comps.xml')):
+        groups_changed = True
+
+    # previous lists, without the changed packages
+    pkglists = {}
+    blocks = None
+    for arch in repo_opts['arches']:
+        try:
+            fo = file(os.path.join(prevdir, arch, 'pkglist'))
+            lines = [l.rstrip('\n') for l in fo.readlines()]
+            fo.close()
+            if blocks is None and not listing_changes:
+                fo = file(os.path.join(prevdir, arch, 'blocklist'))
+                blocks = [l.rstrip('\n') for l in fo.readlines()]
+                fo.close()
+        except IOError:
+            logger.info("Unable to read package lists of repo %s", prev_id)
+            return None
+        pkglists[arch] = [l for l in lines if not affected.has_key(l.split('/', 1)[0])]
+    if blocks is None:
+        blocks = [pkg['package_name'] for pkg in
+                  readPackageList(tag_id, event=event_id, inherit=True).values()
+                  if pkg['blocked']]
+
+    # and the current builds of those
+    arches = dict.fromkeys(repo_opts['arches'])
+    for name in affected:
+        rpms, builds = readTaggedRPMS(tag_id, package=name, event=event_id, inherit=True, latest=True)
+        for arch, lines in _repo_pkglists(rpms, builds, arches, repo_opts['with_src'],
+                                          repo_opts['with_debuginfo']).iteritems():
+            pkglists[arch].extend(lines)
+    return prevdir, pkglists, blocks, groups_changed
+
 def _populate_maven_repodir(buildinfo, maveninfo, archiveinfo, repodir, artifact_dirs):
     maven_pi = koji.PathInfo(topdir=repodir)
     srcdir = koji.pathinfo.mavenbuild(buildinfo, maveninfo)
@@ -2197,6 +2679,33 @@ def _write_maven_repo_metadata(destdir, artifact_dict):
 """
     _generate_maven_metadata(artifactinfo, destdir, contents=contents)
 
+def _repo_link_dirs(repodir):
+    """Return the directories of a repo that rpms are linked into
+
+    The result has the form {'RPMS': {arch: dir, ...}, 'SRPMS': {arch: dir, ...}}
+    """
+    ret = {'RPMS': {}, 'SRPMS': {}}
+    for fn in os.listdir(repodir):
+        if fn == 'groups':
+            continue
+        for subdir in 'RPMS', 'SRPMS':
+            dir = "%s/%s/%s" % (repodir, fn, subdir)
+            if os.path.isdir(dir):
+                ret[subdir][fn] = dir
+    return ret
+
+def _repo_rpm_dirs(linkdirs, arch, sourcepackage):
+    """Return the directories an rpm should be linked into (see _repo_link_dirs)"""
+    if sourcepackage:
+        return linkdirs['SRPMS'].values()
+    elif arch == 'noarch':
+        #noarch and srpms linked for all arches
+        return linkdirs['RPMS'].values()
+    dir = linkdirs['RPMS'].get(koji.canonArch(arch))
+    if dir:
+        return [dir]
+    return []
+
 def repo_set_state(repo_id, state, check=True):
     """Set repo state"""
     if check:
@@ -2683,6 +3192,7 @@ def edit_tag(tagInfo, **kwargs):
         SET name = %(name)s
         WHERE id = %(tagID)i"""
         _dml(update, values)
+        inheritance_cache.invalidate()
 
     #check for changes
     data = tag.copy()
@@ -2731,6 +3241,7 @@ def delete_tag(tagInfo):
     #these remaining revocations are more for cleanup.
     _tagDelete('tag_inheritance', tagID)
     _tagDelete('tag_inheritance', tagID, 'parent_id')
+    inheritance_cache.invalidate()
     _tagDelete('build_target_config', tagID, 'build_tag')
     _tagDelete('build_target_config', tagID, 'dest_tag')
     _tagDelete('tag_listing', tagID)
@@ -3686,8 +4197,31 @@ def _dml(operation, values):
     logger.debug("Operation affected %s row(s)", ret)
     c.close()
     context.commit_pending = True
+    # earlier policy test results may no longer hold
+    context.policy_cache = None
     return ret
 
+def _bulk_insert(table, rows, chunksize=1000):
+    """Insert rows (a list of maps with the same keys) into table
+
+    The rows are inserted with one statement per chunksize rows.
+    """
+    if not rows:
+        return
+    columns = rows[0].keys()
+    for start in xrange(0, len(rows), chunksize):
+        values = {}
+        parts = []
+        for i, row in enumerate(rows[start:start+chunksize]):
+            keys = []
+            for col in columns:
+                key = '%s%i' % (col, i)
+                values[key] = row[col]
+                keys.append('%%(%s)s' % key)
+            parts.append('(%s)' % ', '.join(keys))
+        insert = 'INSERT INTO %s (%s) VALUES %s' % (table, ', '.join(columns), ',\n'.join(parts))
+        _dml(insert, values)
+
 def get_host(hostInfo, strict=False):
     """Get information about the given host.  hostInfo may be
     either a string (hostname) or int (host id).  A map will be returned
@@ -3751,6 +4285,7 @@ def edit_host(hostInfo, **kw):
     data = kw.copy()
     data['id'] = host['id']
     _dml(update, data)
+    host_channel_cache.invalidate()
     return True
 
 def get_channel(channelInfo, strict=False):
@@ -4114,11 +4649,125 @@ def import_rpm(fn,buildinfo=None,brootid=None,wrapper=False):
     """
     _dml(q, rpminfo)
 
+    if context.opts.get('RPMHeaderCache', True):
+        store_rpm_headers(rpminfo['id'], hdr)
+
     koji.plugin.run_callbacks('postImport', type='rpm', rpm=rpminfo, build=buildinfo,
                               filepath=fn)
 
     return rpminfo
 
+# text headers kept in the rpmheaders table for getRPMHeaders
+RPM_CACHED_HEADERS = ('summary', 'description', 'url', 'license')
+
+RPM_FILE_FIELDS = (('filenames', 'name'), ('filemd5s', 'digest'), ('filesizes', 'size'),
+                   ('fileflags', 'flags'), ('fileusername', 'username'),
+                   ('filegroupname', 'groupname'), ('filemtimes', 'mtime'),
+                   ('filemodes', 'mode'))
+
+def _rpm_header_data(hdr):
+    """Extract the cached data from an rpm header
+
+    Returns a tuple of (headers, files, deps), where headers is a map of
+    the RPM_CACHED_HEADERS and the file digest algorithm, and files and
+    deps are lists of rows for the rpmfiles and rpmdeps tables, in header
+    order.
+    """
+    headers = {'digest_algo': koji.util.filedigestAlgo(hdr)}
+    for name in RPM_CACHED_HEADERS:
+        value = koji.get_header_field(hdr, name)
+        if isinstance(value, basestring):
+            value = koji.fixEncoding(value)
+        else:
+            value = None
+        headers[name] = value
+    fields = koji.get_header_fields(hdr, [f[0] for f in RPM_FILE_FIELDS])
+    columns = [fields[f[0]] or [] for f in RPM_FILE_FIELDS]
+    files = []
+    for idx, values in enumerate(zip(*columns)):
+        row = dict(zip([f[1] for f in RPM_FILE_FIELDS], values))
+        row['idx'] = idx
+        # the database wants valid utf8
+        row['name'] = koji.fixEncoding(row['name'])
+        row['username'] = koji.fixEncoding(row['username'])
+        row['groupname'] = koji.fixEncoding(row['groupname'])
+        files.append(row)
+    deps = []
+    for dep_name in ['REQUIRE','PROVIDE','CONFLICT','OBSOLETE']:
+        dep_id = getattr(koji, 'DEP_' + dep_name)
+        fields = koji.get_header_fields(hdr, [dep_name + 'NAME',
+                                              dep_name + 'VERSION',
+                                              dep_name + 'FLAGS'])
+        for (name, version, flags) in zip(fields[dep_name + 'NAME'] or [],
+                                          fields[dep_name + 'VERSION'] or [],
+                                          fields[dep_name + 'FLAGS'] or []):
+            deps.append({'idx': len(deps), 'type': dep_id, 'name': koji.fixEncoding(name),
+                         'version': koji.fixEncoding(version), 'flags': flags})
+    return headers, files, deps
+
+def store_rpm_headers(rpm_id, hdr):
+    """Store the file, dependency and text header data of an rpm
+
+    This data is what listRPMFiles, getRPMFile, getRPMDeps and (for
+    RPM_CACHED_HEADERS) getRPMHeaders return, so that they do not have to
+    read the rpm.
+    """
+    headers, files, deps = _rpm_header_data(hdr)
+    headers['rpm_id'] = rpm_id
+    InsertProcessor('rpmheaders', data=headers).execute()
+    for row in files:
+        row['rpm_id'] = rpm_id
+    _bulk_insert('rpmfiles', files)
+    for row in deps:
+        row['rpm_id'] = rpm_id
+    _bulk_insert('rpmdeps', deps)
+
+def _rpm_path(rpm_info):
+    """Return the path of an internal rpm, or None if it is not on disk"""
+    if not rpm_info or not rpm_info['build_id']:
+        return None
+    build_info = get_build(rpm_info['build_id'])
+    rpm_path = os.path.join(koji.pathinfo.build(build_info), koji.pathinfo.rpm(rpm_info))
+    if not os.path.exists(rpm_path):
+        return None
+    return rpm_path
+
+def check_rpm_headers(rpm_info):
+    """Make sure the header data of an rpm has been stored
+
+    Rpms imported before the data was stored at import time have it added
+    the first time it is asked for. Returns True if the data is in the
+    database. Otherwise returns the rpm header (read from disk) for the
+    caller to use directly, or None if the rpm is not on disk.
+    """
+    if not rpm_info or not rpm_info['build_id']:
+        return None
+    enabled = context.opts.get('RPMHeaderCache', True)
+    if enabled:
+        q = """SELECT 1 FROM rpmheaders WHERE rpm_id=%(id)i"""
+        if _singleValue(q, rpm_info, strict=False):
+            return True
+    rpm_path = _rpm_path(rpm_info)
+    if not rpm_path:
+        return None
+    hdr = koji.get_rpm_header(rpm_path)
+    if not enabled or getattr(context, 'readonly', False):
+        # (the transaction of a parallel read-only call is rolled back)
+        return hdr
+    c = context.cnx.cursor()
+    c.execute('SAVEPOINT rpm_headers')
+    try:
+        store_rpm_headers(rpm_info['id'], hdr)
+    except Exception:
+        # most likely another call stored them at the same time
+        logger.warning("Unable to store headers of rpm %(id)i", rpm_info, exc_info=True)
+        c.execute('ROLLBACK TO SAVEPOINT rpm_headers')
+        c.close()
+        return hdr
+    c.execute('RELEASE SAVEPOINT rpm_headers')
+    c.close()
+    return True
+
 def add_external_rpm(rpminfo, external_repo, strict=True):
     """Add an external rpm entry to the rpminfo table
 
@@ -5190,6 +5839,7 @@ def _delete_build(binfo):
     #   rpminfo KEEP
     #           buildroot_listing KEEP (but should ideally be empty anyway)
     #           rpmsigs DELETE
+    #           rpmheaders, rpmfiles, rpmdeps DELETE
     #   archiveinfo KEEP
     #               buildroot_archives KEEP (but should ideally be empty anyway)
     #   files on disk: DELETE
@@ -5201,6 +5851,7 @@ def _delete_build(binfo):
     for (rpm_id,) in rpm_ids:
         delete = """DELETE FROM rpmsigs WHERE rpm_id=%(rpm_id)i"""
         _dml(delete, locals())
+        _delete_rpm_headers(rpm_id)
     update = UpdateProcessor('tag_listing', clauses=["build_id=%(build_id)i"], values=locals())
     update.make_revoke()
     update.execute()
@@ -5226,6 +5877,12 @@ def _delete_build(binfo):
             raise koji.GenericError, 'directory removal failed (code %r) for %s' % (rv, filedir)
     koji.plugin.run_callbacks('postBuildStateChange', attribute='state', old=binfo['state'], new=st_deleted, info=binfo)
 
+def _delete_rpm_headers(rpm_id):
+    """Delete the stored header data of an rpm"""
+    for table in ('rpmfiles', 'rpmdeps', 'rpmheaders'):
+        delete = """DELETE FROM %s WHERE rpm_id=%%(rpm_id)i""" % table
+        _dml(delete, locals())
+
 def reset_build(build):
     """Reset a build so that it can be reimported
 
@@ -5257,6 +5914,7 @@ def reset_build(build):
         _dml(delete, locals())
         delete = """DELETE FROM buildroot_listing WHERE rpm_id=%(rpm_id)i"""
         _dml(delete, locals())
+        _delete_rpm_headers(rpm_id)
     delete = """DELETE FROM rpminfo WHERE build_id=%(id)i"""
     _dml(delete, binfo)
     q = """SELECT id FROM archiveinfo WHERE build_id=%(id)i"""
@@ -5483,6 +6141,7 @@ def add_group_member(group, user, strict=True):
     insert = InsertProcessor(table, data)
     insert.make_create()
     insert.execute()
+    koji.auth.session_cache.invalidate(user_id=user['id'])
 
 def drop_group_member(group, user):
     """Drop user from group"""
@@ -5496,6 +6155,7 @@ def drop_group_member(group, user):
     update = UpdateProcessor('user_groups', values=data, clauses=clauses)
     update.make_revoke()
     update.execute()
+    koji.auth.session_cache.invalidate(user_id=user['id'])
 
 def get_group_members(group):
     """Get the members of a group"""
@@ -5523,6 +6183,7 @@ def set_user_status(user, status):
     # sanity check
     if rows == 0:
         raise koji.GenericError, 'invalid user ID: %i' % user_id
+    koji.auth.session_cache.invalidate(user_id=user_id)
 
 
 def get_event():
@@ -5836,6 +6497,41 @@ SELECT %(col_str)s
                 return None
         return results
 
+def _rpm_file_info(row, digest_algo):
+    """Convert a row of rpm file data to the map listRPMFiles returns"""
+    return {'name': row['name'], 'digest': row['digest'], 'digest_algo': digest_algo,
+            'md5': row['digest'], 'size': row['size'], 'flags': row['flags'],
+            'user': row['username'], 'group': row['groupname'], 'mtime': row['mtime'],
+            'mode': row['mode']}
+
+def _query_rpm_headers(table, fields, clauses, values, queryOpts):
+    """Query stored rpm file or dependency data
+
+    Results are in header order unless queryOpts gives another order.
+    """
+    opts = queryOpts.copy()
+    columns = [f[0] for f in fields]
+    aliases = [f[1] for f in fields]
+    default_order = not opts.get('order')
+    if default_order:
+        columns.append('%s.idx' % table)
+        aliases.append('idx')
+        opts['order'] = 'idx'
+    joins = None
+    if table == 'rpmfiles':
+        joins = ['rpmheaders ON rpmfiles.rpm_id = rpmheaders.rpm_id']
+    query = QueryProcessor(columns=columns, aliases=aliases, tables=[table], joins=joins,
+                           clauses=clauses, values=values, opts=opts)
+    results = query.execute()
+    if default_order and not opts.get('countOnly'):
+        # drop the idx column again
+        if opts.get('asList'):
+            results = [list(row[:-1]) for row in results]
+        else:
+            for row in results:
+                del row['idx']
+    return results
+
 def _applyQueryOpts(results, queryOpts):
     """
     Apply queryOpts to results in the same way QueryProcessor would.
@@ -5912,6 +6608,7 @@ def policy_get_pkg(data):
 class NewPackageTest(koji.policy.BaseSimpleTest):
     """Checks to see if a package exists yet"""
     name = 'is_new_package'
+    keys = ('package', 'build')
     def run(self, data):
         return (policy_get_pkg(data)['id'] is None)
 
@@ -5919,6 +6616,7 @@ class PackageTest(koji.policy.MatchTest):
     """Checks package against glob patterns"""
     name = 'package'
     field = '_package'
+    keys = ('package', 'build')
     def run(self, data):
         #we need to find the package name from the base data
         data[self.field] = policy_get_pkg(data)['name']
@@ -5927,6 +6625,7 @@ class PackageTest(koji.policy.MatchTest):
 class TagTest(koji.policy.MatchTest):
     name = 'tag'
     field = '_tagname'
+    keys = ('tag',)
 
     def get_tag(self, data):
         """extract the tag to test against from the data
@@ -5948,6 +6647,7 @@ class TagTest(koji.policy.MatchTest):
 
 class FromTagTest(TagTest):
     name = 'fromtag'
+    keys = ('fromtag',)
     def get_tag(self, data):
         tag = data.get('fromtag')
         if tag is None:
@@ -5957,6 +6657,7 @@ class FromTagTest(TagTest):
 class HasTagTest(koji.policy.BaseSimpleTest):
     """Check to see if build (currently) has a given tag"""
     name = 'hastag'
+    keys = ('build',)
     def run(self, data):
         tags = context.handlers.call('listTags', build=data['build'])
         #True if any of these tags match any of the patterns
@@ -5984,6 +6685,7 @@ class BuildTagTest(koji.policy.BaseSimpleTest):
     buildroots of the component rpms
     """
     name = 'buildtag'
+    keys = ('build_tag', 'build')
     def run(self, data):
         args = self.str.split()[1:]
         if data.has_key('build_tag'):
@@ -6021,6 +6723,7 @@ class ImportedTest(koji.policy.BaseSimpleTest):
     This is determined by checking the buildroots of the rpms and archives
     True if any of them lack a buildroot (strict)"""
     name = 'imported'
+    keys = ('build',)
     def run(self, data):
         rpms = context.handlers.call('listRPMs', buildID=data['build'])
         #no test args
@@ -6045,6 +6748,7 @@ class UserTest(koji.policy.MatchTest):
     """Checks username against glob patterns"""
     name = 'user'
     field = '_username'
+    keys = ('user_id',)
     def run(self, data):
         user = policy_get_user(data)
         if not user:
@@ -6060,6 +6764,7 @@ class VMTest(koji.policy.MatchTest):
 class IsBuildOwnerTest(koji.policy.BaseSimpleTest):
     """Check if user owns the build"""
     name = "is_build_owner"
+    keys = ('build', 'user_id')
     def run(self, data):
         build = get_build(data['build'])
         owner = get_user(build['owner_id'])
@@ -6082,6 +6787,7 @@ class UserInGroupTest(koji.policy.BaseSimpleTest):
     true is user is in /any/ matching group
     """
     name = "user_in_group"
+    keys = ('user_id',)
     def run(self, data):
         user = policy_get_user(data)
         if not user:
@@ -6102,6 +6808,7 @@ class HasPermTest(koji.policy.BaseSimpleTest):
     true is user has /any/ matching permission
     """
     name = "has_perm"
+    keys = ('user_id',)
     def run(self, data):
         user = policy_get_user(data)
         if not user:
@@ -6123,6 +6830,7 @@ class SourceTest(koji.policy.MatchTest):
     """
     name = "source"
     field = '_source'
+    keys = ('source', 'build')
     def run(self, data):
         if data.has_key('source'):
             data[self.field] = data['source']
@@ -6168,14 +6876,48 @@ class PolicyTest(koji.policy.BaseSimpleTest):
         if not ruleset:
             raise koji.GenericError, "no such policy: %s" % args[0]
         self.depth += 1
-        result = ruleset.apply(data)
-        self.depth -= 1
+        try:
+            result = ruleset.apply(data, cache=policy_cache())
+        finally:
+            self.depth -= 1
         if result is None:
             return False
         else:
             return result.lower() in ('yes', 'true', 'allow')
 
 
+def policy_cache():
+    """Return the dict of policy test results for the current call
+
+    Tests that declare the data fields they depend on (see
+    koji.policy.BaseSimpleTest.cached_run) only run once per call for the
+    same values of those fields. Any database write drops the results (see
+    _dml). Returns None if the PolicyTestCache option is off.
+    """
+    if not context.opts.get('PolicyTestCache', True):
+        return None
+    cache = getattr(context, 'policy_cache', None)
+    if cache is None:
+        cache = context.policy_cache = {}
+    return cache
+
+policy_input_logger = logging.getLogger('koji.policy.input')
+
+def log_policy_input(name, data):
+    """Log the data a policy is checked with, for replay by bench_policy.py
+
+    Enabled by setting the koji.policy.input logger to DEBUG (see LogLevel).
+    """
+    if not policy_input_logger.isEnabledFor(logging.DEBUG):
+        return
+    if koji.jsonrpc.json is None:
+        return
+    try:
+        line = koji.jsonrpc.json.dumps([name, data])
+    except (TypeError, ValueError):
+        return
+    policy_input_logger.debug("policy-input: %s", line)
+
 def check_policy(name, data, default='deny', strict=False):
     """Check data against the named policy
 
@@ -6197,7 +6939,8 @@ def check_policy(name, data, default='deny', strict=False):
             result = "deny"
         reason = "missing policy"
     else:
-        result = ruleset.apply(data)
+        log_policy_input(name, data)
+        result = ruleset.apply(data, cache=policy_cache())
         if result is None:
             result = default
         reason = ruleset.last_rule()
@@ -6332,6 +7075,35 @@ def moveImageResults(task_id, image_id, arch, mediatype):
 #
 # XMLRPC Methods
 #
+
+# RootExports calls that have no side effects, so that a read-only multiCall
+# may run them in parallel. Only add calls that never write to the database
+# or filesystem.
+READONLY_CALLS = [
+    'buildReferences', 'checkTagPackage', 'downloadTaskOutput', 'findBuildID',
+    'getAPIVersion', 'getActiveRepos', 'getAllArches', 'getAllPerms',
+    'getArchive', 'getArchiveFile', 'getArchiveType', 'getArchiveTypes',
+    'getAverageBuildDuration', 'getBuild', 'getBuildConfig',
+    'getBuildNotification', 'getBuildNotifications', 'getBuildTarget',
+    'getBuildTargets', 'getBuildroot', 'getBuildrootListing',
+    'getCallbackStats', 'getChangelogEntries', 'getChannel', 'getEvent',
+    'getExternalRepo', 'getExternalRepoList', 'getFullInheritance',
+    'getGlobalInheritance', 'getGroupMembers', 'getHost',
+    'getInheritanceData', 'getLastEvent', 'getLastHostUpdate',
+    'getLatestBuilds', 'getLatestRPMS', 'getLoggedInUser', 'getMavenArchive',
+    'getMavenBuild', 'getPackage', 'getPackageID', 'getPerms', 'getRPM',
+    'getRPMDeps', 'getRPMFile', 'getRPMHeaders', 'getRepo', 'getTag',
+    'getTagExternalRepos', 'getTagGroups', 'getTagID', 'getTaskChildren',
+    'getTaskDescendents', 'getTaskInfo', 'getTaskRequest', 'getTaskResult',
+    'getUser', 'getUserPerms', 'getWinArchive', 'getWinBuild', 'hasPerm',
+    'listArchiveFiles', 'listArchives', 'listBuildroots', 'listBuilds',
+    'listChannels', 'listExternalRepos', 'listHosts', 'listPackages',
+    'listRPMFiles',
+    'listRPMs', 'listTagged', 'listTaggedArchives', 'listTaggedRPMS',
+    'listTags', 'listTaskOutput', 'listTasks', 'listUsers', 'mavenEnabled',
+    'queryHistory', 'queryRPMSigs', 'repoInfo', 'tagHistory', 'winEnabled',
+]
+
 class RootExports(object):
     '''Contains functions that are made available via XMLRPC'''
 
@@ -6585,9 +7357,63 @@ class RootExports(object):
     def getAPIVersion(self):
         return koji.API_VERSION
 
+    def checkUpload(self, path, name):
+        """Return the size and md5sum of an uploaded file
+
+        This is used by clients to verify an upload that was sent in pieces.
+        Returns None if the file does not exist.
+        """
+        context.session.assertLogin()
+        fn = get_upload_path(path, name, create=False)
+        try:
+            fd = os.open(fn, os.O_RDONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            sum = md5_constructor()
+            size = 0
+            fcntl.lockf(fd, fcntl.LOCK_SH|fcntl.LOCK_NB)
+            try:
+                while True:
+                    block = os.read(fd, 819200)
+                    if not block:
+                        break
+                    size += len(block)
+                    sum.update(block)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        return {'size': koji.encode_int(size), 'hexdigest': sum.hexdigest()}
+
+    def rawUploadEnabled(self):
+        """Return whether files may be uploaded with raw POST requests"""
+        return bool(context.opts.get('EnableRawUpload'))
+
+    def jsonEnabled(self):
+        """Return whether calls may be encoded as JSON (see koji.jsonrpc)"""
+        return json_enabled()
+
     def mavenEnabled(self):
         return bool(context.opts.get('EnableMaven'))
 
+    def getCallbackStats(self):
+        """Return the counters of the async callback queue
+
+        The counters are for the hub process that serves the call. They are:
+            queued: callbacks queued
+            run: callbacks run
+            failed: callbacks that raised an error
+            dropped: callbacks dropped because the queue stayed full
+            wait_time: total seconds calls spent waiting for room in the queue
+            max_depth: the most callbacks waiting at once
+            depth: callbacks waiting now
+            size: the queue size (0 if not started)
+        """
+        return koji.plugin.callback_queue.stats()
+
     def winEnabled(self):
         return bool(context.opts.get('EnableWin'))
 
@@ -6603,6 +7429,21 @@ class RootExports(object):
         context.session.assertPerm('admin')
         return "%r" % context.opts
 
+    def getDBStats(self):
+        """Return database connection pool and statement cache counters
+
+        The counters are kept per hub process, so successive calls may
+        report different values.
+        """
+        return koji.db.getPoolStats()
+
+    def getSchedulerStats(self):
+        """Return counters and timings for the task scheduler
+
+        Like getDBStats, these are kept per hub process.
+        """
+        return scheduler_stats.copy()
+
     def getEvent(self, id):
         """
         Get information about the event with the given id.
@@ -6679,31 +7520,7 @@ class RootExports(object):
             if md5sum is not None:
                 if md5sum != md5_constructor(contents).hexdigest():
                     return False
-        uploadpath = koji.pathinfo.work()
-        #XXX - have an incoming dir and move after upload complete
-        # SECURITY - ensure path remains under uploadpath
-        path = os.path.normpath(path)
-        if path.startswith('..'):
-            raise koji.GenericError, "Upload path not allowed: %s" % path
-        udir = "%s/%s" % (uploadpath,path)
-        koji.ensuredir(udir)
-        fn = "%s/%s" % (udir,name)
-        try:
-            st = os.lstat(fn)
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                pass
-            else:
-                raise
-        else:
-            if not stat.S_ISREG(st.st_mode):
-                raise koji.GenericError, "destination not a file: %s" % fn
-            elif offset == 0:
-                #first chunk, so file should not exist yet
-                if not fn.endswith('.log'):
-                    # but we allow .log files to be uploaded multiple times to support
-                    # realtime log-file viewing
-                    raise koji.GenericError, "file already exists: %s" % fn
+        fn = get_upload_path(path, name, first=(offset == 0))
         fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0666)
         # log_error("fd=%r" %fd)
         try:
@@ -7597,30 +8414,25 @@ class RootExports(object):
         if queryOpts is None:
             queryOpts = {}
         rpm_info = get_rpm(rpmID)
-        if not rpm_info or not rpm_info['build_id']:
+        cached = check_rpm_headers(rpm_info)
+        if not cached:
             return _applyQueryOpts([], queryOpts)
-        build_info = get_build(rpm_info['build_id'])
-        rpm_path = os.path.join(koji.pathinfo.build(build_info), koji.pathinfo.rpm(rpm_info))
-        if not os.path.exists(rpm_path):
-            return _applyQueryOpts([], queryOpts)
-
-        results = []
-
-        for dep_name in ['REQUIRE','PROVIDE','CONFLICT','OBSOLETE']:
-            dep_id = getattr(koji, 'DEP_' + dep_name)
-            if depType is None or depType == dep_id:
-                fields = koji.get_header_fields(rpm_path, [dep_name + 'NAME',
-                                                           dep_name + 'VERSION',
-                                                           dep_name + 'FLAGS'])
-                for (name, version, flags) in zip(fields[dep_name + 'NAME'],
-                                                  fields[dep_name + 'VERSION'],
-                                                  fields[dep_name + 'FLAGS']):
-                    if queryOpts.get('asList'):
-                        results.append([name, version, flags, dep_id])
-                    else:
-                        results.append({'name': name, 'version': version, 'flags': flags, 'type': dep_id})
+        elif cached is not True:
+            results = [row for row in _rpm_header_data(cached)[2]
+                       if depType is None or depType == row['type']]
+            if queryOpts.get('asList'):
+                results = [[r['name'], r['version'], r['flags'], r['type']] for r in results]
+            else:
+                for row in results:
+                    del row['idx']
+            return _applyQueryOpts(results, queryOpts)
 
-        return _applyQueryOpts(results, queryOpts)
+        fields = (('name', 'name'), ('version', 'version'), ('flags', 'flags'), ('type', 'type'))
+        clauses = ['rpm_id = %(rpm_id)i']
+        if depType is not None:
+            clauses.append('type = %(depType)i')
+        return _query_rpm_headers('rpmdeps', fields, clauses,
+                                  {'rpm_id': rpm_info['id'], 'depType': depType}, queryOpts)
 
     def listRPMFiles(self, rpmID, queryOpts=None):
         """List files associated with the RPM with the given ID.  A list of maps
@@ -7637,31 +8449,28 @@ class RootExports(object):
         if queryOpts is None:
             queryOpts = {}
         rpm_info = get_rpm(rpmID)
-        if not rpm_info or not rpm_info['build_id']:
-            return _applyQueryOpts([], queryOpts)
-        build_info = get_build(rpm_info['build_id'])
-        rpm_path = os.path.join(koji.pathinfo.build(build_info), koji.pathinfo.rpm(rpm_info))
-        if not os.path.exists(rpm_path):
+        cached = check_rpm_headers(rpm_info)
+        if not cached:
             return _applyQueryOpts([], queryOpts)
+        elif cached is not True:
+            headers, files = _rpm_header_data(cached)[:2]
+            results = []
+            for row in files:
+                if queryOpts.get('asList'):
+                    results.append([row['name'], row['digest'], row['size'], row['flags'],
+                                    headers['digest_algo'], row['username'], row['groupname'],
+                                    row['mtime'], row['mode']])
+                else:
+                    results.append(_rpm_file_info(row, headers['digest_algo']))
+            return _applyQueryOpts(results, queryOpts)
 
-        results = []
-        hdr = koji.get_rpm_header(rpm_path)
-        fields = koji.get_header_fields(hdr, ['filenames', 'filemd5s', 'filesizes', 'fileflags',
-                                              'fileusername', 'filegroupname', 'filemtimes', 'filemodes'])
-        digest_algo = koji.util.filedigestAlgo(hdr)
-
-        for (name, digest, size, flags, user, group, mtime, mode) in zip(fields['filenames'], fields['filemd5s'],
-                                                                         fields['filesizes'], fields['fileflags'],
-                                                                         fields['fileusername'], fields['filegroupname'],
-                                                                         fields['filemtimes'], fields['filemodes']):
-            if queryOpts.get('asList'):
-                results.append([name, digest, size, flags, digest_algo, user, group, mtime, mode])
-            else:
-                results.append({'name': name, 'digest': digest, 'digest_algo': digest_algo,
-                                'md5': digest, 'size': size, 'flags': flags,
-                                'user': user, 'group': group, 'mtime': mtime, 'mode': mode})
-
-        return _applyQueryOpts(results, queryOpts)
+        fields = (('rpmfiles.name', 'name'), ('digest', 'digest'), ('size', 'size'),
+                  ('flags', 'flags'), ('digest_algo', 'digest_algo'), ('username', 'user'),
+                  ('groupname', 'group'), ('mtime', 'mtime'), ('mode', 'mode'))
+        if not queryOpts.get('asList'):
+            fields += (('digest', 'md5'),)
+        return _query_rpm_headers('rpmfiles', fields, ['rpmfiles.rpm_id = %(rpm_id)i'],
+                                  {'rpm_id': rpm_info['id']}, queryOpts)
 
     def getRPMFile(self, rpmID, filename):
         """
@@ -7678,28 +8487,28 @@ class RootExports(object):
         If no such file exists, an empty map will be returned.
         """
         rpm_info = get_rpm(rpmID)
-        if not rpm_info or not rpm_info['build_id']:
+        cached = check_rpm_headers(rpm_info)
+        if not cached:
             return {}
-        build_info = get_build(rpm_info['build_id'])
-        rpm_path = os.path.join(koji.pathinfo.build(build_info), koji.pathinfo.rpm(rpm_info))
-        if not os.path.exists(rpm_path):
+        filename = koji.fixEncoding(filename)
+        if cached is not True:
+            headers, files = _rpm_header_data(cached)[:2]
+            for row in files:
+                if row['name'] == filename:
+                    ret = _rpm_file_info(row, headers['digest_algo'])
+                    ret['rpm_id'] = rpm_info['id']
+                    return ret
             return {}
 
-        hdr = koji.get_rpm_header(rpm_path)
-        # use filemd5s for backward compatibility
-        fields = koji.get_header_fields(hdr, ['filenames', 'filemd5s', 'filesizes', 'fileflags',
-                                              'fileusername', 'filegroupname', 'filemtimes', 'filemodes'])
-        digest_algo = koji.util.filedigestAlgo(hdr)
-
-        i = 0
-        for name in fields['filenames']:
-            if name == filename:
-                return {'rpm_id': rpm_info['id'], 'name': name, 'digest': fields['filemd5s'][i],
-                        'digest_algo': digest_algo, 'md5': fields['filemd5s'][i],
-                        'size': fields['filesizes'][i], 'flags': fields['fileflags'][i],
-                        'user': fields['fileusername'][i], 'group': fields['filegroupname'][i],
-                        'mtime': fields['filemtimes'][i], 'mode': fields['filemodes'][i]}
-            i += 1
+        fields = (('rpmfiles.rpm_id', 'rpm_id'), ('rpmfiles.name', 'name'),
+                  ('digest', 'digest'), ('digest_algo', 'digest_algo'), ('digest', 'md5'),
+                  ('size', 'size'), ('flags', 'flags'), ('username', 'user'),
+                  ('groupname', 'group'), ('mtime', 'mtime'), ('mode', 'mode'))
+        ret = _query_rpm_headers('rpmfiles', fields,
+                                 ['rpmfiles.rpm_id = %(rpm_id)i', 'rpmfiles.name = %(filename)s'],
+                                 {'rpm_id': rpm_info['id'], 'filename': filename}, {'limit': 1})
+        if ret:
+            return ret[0]
         return {}
 
     def getRPMHeaders(self, rpmID=None, taskID=None, filepath=None, headers=None):
@@ -7714,24 +8523,35 @@ class RootExports(object):
             headers = []
         if rpmID:
             rpm_info = get_rpm(rpmID)
-            if not rpm_info or not rpm_info['build_id']:
-                return {}
-            build_info = get_build(rpm_info['build_id'])
-            rpm_path = os.path.join(koji.pathinfo.build(build_info), koji.pathinfo.rpm(rpm_info))
-            if not os.path.exists(rpm_path):
-                return {}
+            src = None
+            if not [h for h in headers if h.lower() not in RPM_CACHED_HEADERS]:
+                # all the headers asked for are stored
+                src = check_rpm_headers(rpm_info)
+                if src is None:
+                    return {}
+                elif src is True:
+                    columns = [h.lower() for h in headers]
+                    q = """SELECT %s FROM rpmheaders WHERE rpm_id=%%(id)i""" % \
+                            ', '.join(['rpm_id'] + columns)
+                    row = _singleRow(q, rpm_info, ['rpm_id'] + columns, strict=True)
+                    return dict([(h, row[h.lower()]) for h in headers])
+            if src is None:
+                src = _rpm_path(rpm_info)
+                if not src:
+                    return {}
         elif taskID:
             if not filepath:
                 raise koji.GenericError, 'filepath must be specified with taskID'
             if filepath.startswith('/') or '../' in filepath:
                 raise koji.GenericError, 'invalid filepath: %s' % filepath
-            rpm_path = os.path.join(koji.pathinfo.work(),
-                                    koji.pathinfo.taskrelpath(taskID),
-                                    filepath)
+            src = os.path.join(koji.pathinfo.work(),
+                               koji.pathinfo.taskrelpath(taskID),
+                               filepath)
         else:
             raise koji.GenericError, 'either rpmID or taskID and filepath must be specified'
 
-        headers = koji.get_header_fields(rpm_path, headers)
+        # src is either the rpm header or the path to the rpm
+        headers = koji.get_header_fields(src, headers)
         for key, value in headers.items():
             if isinstance(value, basestring):
                 headers[key] = koji.fixEncoding(value)
@@ -7848,6 +8668,7 @@ class RootExports(object):
         insert.set(user_id=user_id, perm_id=perm_id)
         insert.make_create()
         insert.execute()
+        koji.auth.session_cache.invalidate(user_id=user_id)
 
     def revokePermission(self, userinfo, permission):
         """Revoke a permission from a user"""
@@ -7861,6 +8682,7 @@ class RootExports(object):
                     clauses=["user_id = %(user_id)i", "perm_id = %(perm_id)i"])
         update.make_revoke()
         update.execute()
+        koji.auth.session_cache.invalidate(user_id=user_id)
 
     def createUser(self, username, status=None, krb_principal=None):
         """Add a user to the database"""
@@ -8230,6 +9052,7 @@ class RootExports(object):
         insert = """INSERT INTO host_channels (host_id, channel_id)
         VALUES (%(hostID)i, %(default_channel)i)"""
         _dml(insert, locals())
+        host_channel_cache.invalidate()
         return hostID
 
     def enableHost(self, hostname):
@@ -8801,6 +9624,62 @@ class BuildRoot(object):
         for archive_id in archive_ids:
             _dml(insert, locals())
 
+# per-process counters for the SetBasedScheduler, see getSchedulerStats
+scheduler_stats = {}
+
+def _scheduler_stat(name, incr=1):
+    scheduler_stats[name] = scheduler_stats.get(name, 0) + incr
+
+# per process state for the hub scheduler
+_hub_scheduler = {'last_run': 0, 'last_assigned': {}}
+
+def schedule_tasks():
+    """Assign free tasks to ready hosts (the HubScheduler mode)
+
+    The hub has no background thread, so batches are run from host.getTask
+    calls, at most once per HubSchedulerInterval seconds in each hub process.
+    A transaction level advisory lock keeps concurrent batches from
+    different processes apart. Tasks in the HubSchedulerSkipChannels
+    channels are left for the builders to take themselves.
+
+    Returns the number of tasks assigned.
+    """
+    now = time.time()
+    interval = context.opts.get('HubSchedulerInterval', 5)
+    if now - _hub_scheduler['last_run'] < interval:
+        return 0
+    _hub_scheduler['last_run'] = now
+    # the lock key is arbitrary, but must not clash with other advisory locks
+    if not _singleValue("SELECT pg_try_advisory_xact_lock(%(key)i)", {'key': 0x6b6f6a69}):
+        _scheduler_stat('batches_locked')
+        return 0
+    skip_channels = []
+    for name in context.opts.get('HubSchedulerSkipChannels', 'vm').split():
+        chan = get_channel(name)
+        if chan:
+            skip_channels.append(chan['id'])
+    hosts = get_ready_hosts()
+    fields = ['id', 'state', 'channel_id', 'host_id', 'arch', 'weight']
+    q = """
+    SELECT %s FROM task
+    WHERE state IN (%%(FREE)s,%%(ASSIGNED)s)
+    ORDER BY priority,create_time
+    LIMIT 1000
+    """ % ','.join(fields)
+    tasks = _multiRow(q, koji.TASK_STATES, fields)
+    assignments = koji.scheduler.assign_tasks(hosts, tasks,
+                        last_assigned=_hub_scheduler['last_assigned'],
+                        skip_channels=skip_channels)
+    count = 0
+    for task_id, host_id in assignments:
+        if Task(task_id).assign(host_id):
+            count += 1
+    _scheduler_stat('batches')
+    _scheduler_stat('batch_assigned', count)
+    _scheduler_stat('batch_time', time.time() - now)
+    return count
+
+
 class Host(object):
 
     def __init__(self,id=None):
@@ -8923,14 +9802,87 @@ class Host(object):
         """  % (",".join(fields))
         c.execute(q,locals())
         tasks = [ dict(zip(fields,x)) for x in c.fetchall() ]
-        for task in tasks:
-            id = task['id']
-            if task['waiting']:
-                finished, unfinished = self.taskWaitCheck(id)
-                if finished:
+        if [task for task in tasks if task['waiting']]:
+            alerts = dict.fromkeys(self.getTaskAlerts())
+            for task in tasks:
+                if task['waiting'] and alerts.has_key(task['id']):
                     task['alert'] = True
         return tasks
 
+    def getTaskAlerts(self, ignore=()):
+        """Return the ids of our waiting tasks that have finished subtasks
+
+        This is the same check as taskWaitCheck, for all of the host's
+        waiting tasks in one query. Task ids in ignore are left out.
+        """
+        host_id = self.id
+        st_open = koji.TASK_STATES['OPEN']
+        finished = [koji.TASK_STATES[s] for s in ('CLOSED', 'CANCELED', 'FAILED')]
+        q = """
+        SELECT DISTINCT parent.id FROM task AS parent
+            JOIN task AS child ON child.parent = parent.id
+        WHERE parent.host_id = %(host_id)i AND parent.state = %(st_open)i
+            AND parent.waiting = TRUE
+            AND child.awaited = TRUE AND child.state IN %(finished)s
+        """
+        ignore = dict.fromkeys(ignore)
+        return [row[0] for row in _fetchMulti(q, locals()) if not ignore.has_key(row[0])]
+
+    def waitForTaskEvents(self, timeout=None, ignore=()):
+        """Wait for subtasks of our waiting tasks to finish
+
+        Returns the ids of the waiting tasks that should be woken up, as soon
+        as there are any, or an empty list after timeout seconds (capped by
+        the TaskEventsTimeout hub option). Task ids in ignore are not
+        reported, so the caller can pass the tasks it has already woken.
+
+        Task state changes are signalled with LISTEN/NOTIFY, so the database
+        is only queried again when a task has actually finished. If the db
+        driver cannot receive notifications, we check once a second instead.
+        We listen on a connection of our own, since waiting for notifications
+        ends its transaction and ours may be part of a multicall.
+        """
+        max_timeout = context.opts.get('TaskEventsTimeout', 30)
+        if timeout is None or timeout > max_timeout:
+            timeout = max_timeout
+        end = time.time() + timeout
+        cnx = None
+        if context.cnx.canNotify():
+            cnx = koji.db.connect()
+            try:
+                # start listening before we look, so that nothing is missed
+                cnx.cursor().execute('LISTEN koji_task_events')
+                cnx.commit()
+            except:
+                cnx.close()
+                raise
+        notify = cnx is not None
+        try:
+            alerts = self.getTaskAlerts(ignore)
+            while not alerts:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                # older drivers keep a transaction open, which holds back
+                # notifications, so wake up at least once a second
+                wait = min(remaining, 1.0)
+                if notify:
+                    if not cnx.waitForNotify(wait):
+                        continue
+                else:
+                    time.sleep(wait)
+                alerts = self.getTaskAlerts(ignore)
+        finally:
+            if notify:
+                # the connection goes back to the pool, so stop listening
+                try:
+                    cnx.rollback()
+                    cnx.cursor().execute('UNLISTEN koji_task_events')
+                    cnx.commit()
+                finally:
+                    cnx.close()
+        return alerts
+
     def updateHost(self,task_load,ready):
         host_data = get_host(self.id)
         if task_load != host_data['task_load'] or ready != host_data['ready']:
@@ -8949,6 +9901,10 @@ class Host(object):
 
     def getTask(self):
         """Open next available task and return it"""
+        if context.opts.get('HubScheduler'):
+            return self.openAssignedTask()
+        if context.opts.get('SetBasedScheduler'):
+            return self.claimTask()
         c = context.cnx.cursor()
         id = self.id
         #get arch and channel info for host
@@ -8993,6 +9949,82 @@ class Host(object):
         #else no appropriate tasks
         return None
 
+    def openAssignedTask(self):
+        """Open the next task the hub scheduler assigned to this host
+
+        This is the HubScheduler version of getTask. Hosts only get tasks that
+        were assigned to them, either by schedule_tasks or explicitly.
+        """
+        schedule_tasks()
+        id = self.id
+        st_assigned = koji.TASK_STATES['ASSIGNED']
+        q = """SELECT id FROM task
+        WHERE state = %(st_assigned)i AND host_id = %(id)i
+        ORDER BY priority,create_time"""
+        for (task_id,) in _fetchMulti(q, locals()):
+            ret = Task(task_id).open(self.id)
+            if ret is not None:
+                return ret
+        return None
+
+    def claimTask(self, max_tries=5):
+        """Open the next available task, letting the database do the filtering
+
+        This is the SetBasedScheduler version of getTask. Arch and channel
+        filtering happen in the query, which stops at the first match and
+        skips rows locked by other hosts (SKIP LOCKED needs PostgreSQL 9.5).
+        Timings are recorded in scheduler_stats.
+        """
+        start = time.time()
+        id = self.id
+        q = """SELECT arches FROM host WHERE id = %(id)i"""
+        arches = _singleValue(q, locals()).split()
+        q = """SELECT channel_id FROM host_channels WHERE host_id = %(id)i"""
+        channels = [row[0] for row in _fetchMulti(q, locals())]
+        st_free = koji.TASK_STATES['FREE']
+        st_assigned = koji.TASK_STATES['ASSIGNED']
+        # NOTE: channels ignored for explicit assignments
+        clauses = ['(state = %(st_assigned)i AND host_id = %(id)i)']
+        if channels:
+            clauses.append('(state = %(st_free)i AND channel_id IN %(channels)s)')
+        q = """SELECT id FROM task
+        WHERE (%s) AND arch IN %%(arches)s
+        """ % ' OR '.join(clauses)
+        tried = []
+        ret = None
+        while arches and len(tried) < max_tries:
+            query = q
+            if tried:
+                query += """AND id NOT IN %(tried)s
+                """
+            query += """ORDER BY priority, create_time
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED"""
+            qstart = time.time()
+            row = _fetchSingle(query, locals())
+            _scheduler_stat('query_time', time.time() - qstart)
+            if not row:
+                break
+            ret = Task(row[0]).open(self.id)
+            if ret is not None:
+                break
+            #should not happen since we hold the row lock, but the task
+            #may not be in a state we can open
+            _scheduler_stat('retries')
+            tried.append(row[0])
+        elapsed = time.time() - start
+        _scheduler_stat('polls')
+        _scheduler_stat('poll_time', elapsed)
+        if elapsed > scheduler_stats.get('max_poll_time', 0):
+            scheduler_stats['max_poll_time'] = elapsed
+        if ret is None:
+            _scheduler_stat('empty_polls')
+        else:
+            _scheduler_stat('claimed')
+        logger.debug("Host %i scheduler poll took %.4f seconds (task: %s)", self.id, elapsed,
+                     ret and ret['id'])
+        return ret
+
     def isEnabled(self):
         """Return whether this host is enabled or not."""
         query = """SELECT enabled FROM host WHERE id = %(id)i"""
@@ -9082,6 +10114,11 @@ class HostExports(object):
         host.verify()
         return host.taskWait(parent)
 
+    def waitForTaskEvents(self, timeout=None, ignore=()):
+        host = Host()
+        host.verify()
+        return host.waitForTaskEvents(timeout, ignore)
+
     def taskWaitResults(self,parent,tasks):
         host = Host()
         host.verify()
@@ -9693,23 +10730,7 @@ class HostExports(object):
         if not os.path.exists(filepath):
             raise koji.GenericError, "no such file: %s" % filepath
         rpminfo = koji.get_header_fields(filepath, ('arch','sourcepackage'))
-        dirs = []
-        if not rpminfo['sourcepackage'] and rpminfo['arch'] != 'noarch':
-            arch = koji.canonArch(rpminfo['arch'])
-            dir = "%s/%s/RPMS" % (repodir, arch)
-            if os.path.isdir(dir):
-                dirs.append(dir)
-        else:
-            #noarch and srpms linked for all arches
-            for fn in os.listdir(repodir):
-                if fn == 'groups':
-                    continue
-                if rpminfo['sourcepackage']:
-                    dir = "%s/%s/SRPMS" % (repodir, fn)
-                else:
-                    dir = "%s/%s/RPMS" % (repodir, fn)
-                if os.path.isdir(dir):
-                    dirs.append(dir)
+        dirs = _repo_rpm_dirs(_repo_link_dirs(repodir), rpminfo['arch'], rpminfo['sourcepackage'])
         for dir in dirs:
             fn = os.path.basename(filepath)
             dst = "%s/%s" % (dir, fn)
@@ -9722,6 +10743,79 @@ class HostExports(object):
             else:
                 os.link(filepath, dst)
 
+    def repoAddRPMs(self, repo_id, manifest):
+        """Add uploaded rpms to a repo
+
+        manifest is a list of (path, arch, sourcepackage) entries, one per rpm.
+        path is relative to the work directory, as for repoAddRPM, and arch and
+        sourcepackage are the values from the rpm header. The entries are
+        checked against the rpm file names rather than by reading the headers.
+        Nothing is linked unless all of the entries are valid, and all of the
+        problems found are reported in a single error.
+
+        Returns the number of links made.
+        """
+        host = Host()
+        host.verify()
+        rinfo = repo_info(repo_id, strict=True)
+        repodir = koji.pathinfo.repo(repo_id, rinfo['tag_name'])
+        if rinfo['state'] != koji.REPO_INIT:
+            raise koji.GenericError, "Repo %(id)s not in INIT state (got %(state)s)" % rinfo
+        linkdirs = _repo_link_dirs(repodir)
+        uploadpath = koji.pathinfo.work()
+        errors = []
+        links = {}
+        for entry in manifest:
+            try:
+                path, arch, sourcepackage = entry
+            except (TypeError, ValueError):
+                errors.append("invalid manifest entry: %r" % (entry,))
+                continue
+            # SECURITY - ensure path remains under uploadpath
+            path = os.path.normpath(path)
+            if path.startswith('..') or path.startswith('/'):
+                errors.append("path not allowed: %s" % path)
+                continue
+            filepath = "%s/%s" % (uploadpath, path)
+            fn = os.path.basename(filepath)
+            try:
+                nvra = koji.parse_NVRA(fn)
+            except koji.GenericError:
+                nvra = None
+            if sourcepackage:
+                valid = nvra and nvra['arch'] in ('src', 'nosrc')
+            else:
+                valid = nvra and nvra['arch'] == arch
+            if not fn.endswith('.rpm') or not valid:
+                errors.append("%s does not match arch=%s, sourcepackage=%s"
+                              % (fn, arch, sourcepackage))
+                continue
+            try:
+                s_st = os.stat(filepath)
+            except OSError:
+                errors.append("no such file: %s" % filepath)
+                continue
+            for dir in _repo_rpm_dirs(linkdirs, arch, sourcepackage):
+                dst = "%s/%s" % (dir, fn)
+                if links.has_key(dst):
+                    if links[dst] != filepath:
+                        errors.append("Conflicting files for %s: %s, %s" % (dst, links[dst], filepath))
+                    continue
+                try:
+                    d_st = os.stat(dst)
+                except OSError:
+                    links[dst] = filepath
+                    continue
+                if s_st.st_ino != d_st.st_ino:
+                    errors.append("File already in repo: %s" % dst)
+                #otherwise the desired hardlink already exists
+        if errors:
+            raise koji.GenericError, "Unable to add rpms to repo %s:\n  %s" \
+                    % (repo_id, '\n  '.join(errors))
+        for dst, filepath in links.iteritems():
+            os.link(filepath, dst)
+        return len(links)
+
     def repoDone(self, repo_id, data, expire=False):
         """Move repo data into place, mark as ready, and expire earlier repos
 
@@ -9739,19 +10833,34 @@ class HostExports(object):
             raise koji.GenericError, "Repo %(id)s not in INIT state (got %(state)s)" % rinfo
         repodir = koji.pathinfo.repo(repo_id, rinfo['tag_name'])
         workdir = koji.pathinfo.work()
+        # check everything before moving anything
+        errors = []
+        datadirs = []
+        moves = []
         for arch, (uploadpath, files) in data.iteritems():
             archdir = "%s/%s" % (repodir, arch)
             if not os.path.isdir(archdir):
-                raise koji.GenericError, "Repo arch directory missing: %s" % archdir
+                errors.append("Repo arch directory missing: %s" % archdir)
+                continue
             datadir = "%s/repodata" % archdir
-            koji.ensuredir(datadir)
+            datadirs.append(datadir)
             for fn in files:
                 src = "%s/%s/%s" % (workdir,uploadpath, fn)
                 dst = "%s/%s" % (datadir, fn)
                 if not os.path.exists(src):
-                    raise koji.GenericError, "uploaded file missing: %s" % src
-                os.link(src, dst)
-                os.unlink(src)
+                    errors.append("uploaded file missing: %s" % src)
+                elif os.path.lexists(dst):
+                    errors.append("File already in repo: %s" % dst)
+                else:
+                    moves.append((src, dst))
+        if errors:
+            raise koji.GenericError, "Unable to add repodata to repo %s:\n  %s" \
+                    % (repo_id, '\n  '.join(errors))
+        for datadir in datadirs:
+            koji.ensuredir(datadir)
+        for src, dst in moves:
+            # the work and repo dirs are both under topdir
+            os.rename(src, dst)
         if expire:
             repo_expire(repo_id)
             koji.plugin.run_callbacks('postRepoDone', repo=rinfo, data=data, expire=expire)
@@ -9776,10 +10885,126 @@ class HostExports(object):
         host.verify()
         return host.isEnabled()
 
-# XXX - not needed anymore?
+def get_upload_path(reldir, name, first=False, overwrite=False, create=True):
+    """Return the full path for an uploaded file
+
+    reldir is relative to the work directory. If first is true, this is the
+    start of a new upload, so the file should not exist yet (unless overwrite
+    is set or it is a log file). If create is true, the directory is created.
+    """
+    uploadpath = koji.pathinfo.work()
+    #XXX - have an incoming dir and move after upload complete
+    # SECURITY - ensure path remains under uploadpath
+    reldir = os.path.normpath(reldir)
+    if reldir.startswith('..'):
+        raise koji.GenericError, "Upload path not allowed: %s" % reldir
+    udir = os.path.normpath("%s/%s" % (uploadpath, reldir))
+    fn = os.path.normpath("%s/%s" % (udir, name))
+    if not fn.startswith(udir + '/'):
+        raise koji.GenericError, "Upload name not allowed: %s" % name
+    if create:
+        koji.ensuredir(os.path.dirname(fn))
+    try:
+        st = os.lstat(fn)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            pass
+        else:
+            raise
+    else:
+        if not stat.S_ISREG(st.st_mode):
+            raise koji.GenericError, "destination not a file: %s" % fn
+        elif first and not overwrite:
+            #first chunk, so file should not exist yet
+            if not fn.endswith('.log'):
+                # but we allow .log files to be uploaded multiple times to support
+                # realtime log-file viewing
+                raise koji.GenericError, "file already exists: %s" % fn
+    return fn
+
+def json_enabled():
+    """Return True if the hub accepts calls encoded as JSON"""
+    return bool(context.opts.get('EnableJSON') and koji.jsonrpc.json)
+
 def handle_upload(req):
-    """Handle file upload via POST request"""
-    pass
+    """Handle file upload via POST request
+
+    The request body is the raw file data, written at the given offset. The
+    query string has the session args plus:
+        filepath: directory to upload to, relative to the work directory
+        filename: the name of the file
+        offset: where the data belongs in the file (default 0)
+        md5: optional md5 hexdigest of the data, checked after writing
+        size: optional total file size, set on the last chunk of a file
+        overwrite: if set, replace an existing file when offset is 0
+
+    The data is streamed to disk and hashed as it arrives, so neither the
+    chunk nor the file are read back. Chunks can be resent or sent out of
+    order, since each one is written at its own offset.
+    Returns a dict with the offset, size and md5 hexdigest of the data.
+    """
+    context.session.assertLogin()
+    if not context.opts.get('EnableRawUpload'):
+        raise koji.GenericError, "raw uploads are disabled"
+    args = cgi.parse_qs(req.args or '', keep_blank_values=True)
+    def getarg(name, default=None):
+        return args.get(name, [default])[0]
+    reldir = getarg('filepath')
+    name = getarg('filename')
+    if not reldir or not name:
+        raise koji.GenericError, "filepath and filename are required"
+    try:
+        offset = int(getarg('offset', 0))
+        size = getarg('size')
+        if size is not None:
+            size = int(size)
+        length = int(req.headers_in.get('Content-Length'))
+    except (TypeError, ValueError):
+        raise koji.GenericError, "invalid upload size or offset"
+    if offset < 0 or length < 0 or (size is not None and size < offset + length):
+        raise koji.GenericError, "invalid upload size or offset"
+    md5sum = getarg('md5')
+    fn = get_upload_path(reldir, name, first=(offset == 0),
+                         overwrite=bool(getarg('overwrite')))
+    fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        if offset == 0:
+            #truncate file
+            fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            try:
+                os.ftruncate(fd, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        os.lseek(fd, offset, 0)
+        sum = md5_constructor()
+        remaining = length
+        fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB, length, offset, 0)
+        try:
+            while remaining > 0:
+                block = req.read(min(remaining, 65536))
+                if not block:
+                    break
+                sum.update(block)
+                os.write(fd, block)
+                remaining -= len(block)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, length, offset, 0)
+        if remaining:
+            raise koji.GenericError, "upload of %s truncated at %i bytes" \
+                    % (fn, length - remaining)
+        hexdigest = sum.hexdigest()
+        if md5sum is not None and md5sum != hexdigest:
+            raise koji.GenericError, "md5sum mismatch uploading %s at offset %i" % (fn, offset)
+        if size is not None:
+            #last chunk, drop anything left from an earlier upload
+            fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+    return {'offset': koji.encode_int(offset), 'size': length, 'hexdigest': hexdigest}
 
 #koji.add_sys_logger("koji")
 
@@ -21,18 +21,24 @@
 #       Mike McLean <mikem@redhat.com>
 
 from ConfigParser import ConfigParser
+import gzip
 import logging
 import sys
 import time
 import traceback
 import types
 import pprint
+import Queue
+import threading
+from cStringIO import StringIO
 from xmlrpclib import loads,dumps,Fault
 from mod_python import apache
 
 import koji
 import koji.auth
 import koji.db
+import koji.fastxmlrpc
+import koji.jsonrpc
 import koji.plugin
 import koji.policy
 import kojihub
@@ -46,18 +52,31 @@ class HandlerRegistry(object):
 
     def __init__(self):
         self.funcs = {}
+        self.readonly = {}
         #introspection functions
-        self.register_function(self.list_api, name="_listapi")
-        self.register_function(self.system_listMethods, name="system.listMethods")
-        self.register_function(self.system_methodSignature, name="system.methodSignature")
-        self.register_function(self.system_methodHelp, name="system.methodHelp")
+        self.register_function(self.list_api, name="_listapi", readonly=True)
+        self.register_function(self.system_listMethods, name="system.listMethods", readonly=True)
+        self.register_function(self.system_methodSignature, name="system.methodSignature", readonly=True)
+        self.register_function(self.system_methodHelp, name="system.methodHelp", readonly=True)
 
-    def register_function(self, function, name = None):
+    def register_function(self, function, name = None, readonly=None):
+        """Register a function
+
+        If readonly is true the function is known to have no side effects,
+        so a read-only multiCall may run it. If it is None, this is taken
+        from the readonly attribute of the function (see koji.plugin.readonly).
+        """
         if name is None:
             name = function.__name__
+        if readonly is None:
+            readonly = getattr(function, 'readonly', False)
         self.funcs[name] = function
+        if readonly:
+            self.readonly[name] = True
+        else:
+            self.readonly.pop(name, None)
 
-    def register_module(self, instance, prefix=None):
+    def register_module(self, instance, prefix=None, readonly=()):
         """Register all the public functions in an instance with prefix prepended
 
         For example
@@ -66,19 +85,24 @@ class HandlerRegistry(object):
             pub.sys.method1
             pub.sys.method2
             ...etc
+
+        readonly is a list of the (unprefixed) names of methods that have
+        no side effects.
         """
+        readonly = dict.fromkeys(readonly)
         for name in dir(instance):
             if name.startswith('_'):
                 continue
             function = getattr(instance, name)
             if not callable(function):
                 continue
+            ro = readonly.has_key(name) or None
             if prefix is not None:
                 name = "%s.%s" %(prefix,name)
-            self.register_function(function, name=name)
+            self.register_function(function, name=name, readonly=ro)
 
-    def register_instance(self,instance):
-        self.register_module(instance)
+    def register_instance(self, instance, readonly=()):
+        self.register_module(instance, readonly=readonly)
 
     def register_plugin(self, plugin):
         """Scan a given plugin for handlers
@@ -150,6 +174,9 @@ class HandlerRegistry(object):
             raise koji.GenericError, "Invalid method: %s" % name
         return func
 
+    def is_readonly(self, name):
+        return self.readonly.has_key(name)
+
 
 class HandlerAccess(object):
     """This class is used to grant access to the rpc handlers"""
@@ -171,6 +198,12 @@ class ModXMLRPCRequestHandler(object):
         self.traceback = False
         self.handlers = handlers  #expecting HandlerRegistry instance
         self.logger = logging.getLogger('koji.xmlrpc')
+        if context.opts.get('FastMarshaller', True):
+            self.xml_dumps = koji.fastxmlrpc.dumps
+        else:
+            self.xml_dumps = dumps
+        self.dumps = self.xml_dumps
+        self.content_type = "text/xml"
 
     def _get_handler(self, name):
         # just a wrapper so we can handle multicall ourselves
@@ -184,17 +217,37 @@ class ModXMLRPCRequestHandler(object):
         """Dispatches an XML-RPC method from marshalled (XML) data."""
 
         params, method = loads(data)
+        return self._wrap_response(self._dispatch, method, params)
+
+    def _json_dispatch(self, data):
+        """Dispatches a method call from JSON data (see koji.jsonrpc)"""
+
+        params, method = koji.jsonrpc.loads(data)
+        self.dumps = self._json_dumps
+        return self._wrap_response(self._dispatch, method, params)
+
+    def _json_dumps(self, params, **kwargs):
+        """Encode a response as JSON, or as XML-RPC if JSON cannot carry it"""
+        try:
+            response = koji.jsonrpc.dumps(params, **kwargs)
+        except (TypeError, ValueError):
+            self.content_type = "text/xml"
+            return self.xml_dumps(params, **kwargs)
+        self.content_type = koji.jsonrpc.CONTENT_TYPE
+        return response
+
+    def _wrap_response(self, func, *args):
+        """Call func and return its result (or error) as an XML-RPC response"""
 
-        start = time.time()
         # generate response
         try:
-            response = self._dispatch(method, params)
+            response = func(*args)
             # wrap response in a singleton tuple
             response = (response,)
-            response = dumps(response, methodresponse=1, allow_none=1)
+            response = self.dumps(response, methodresponse=1, allow_none=1)
         except Fault, fault:
             self.traceback = True
-            response = dumps(fault)
+            response = self.dumps(fault)
         except:
             self.traceback = True
             # report exception back to server
@@ -218,27 +271,14 @@ class ModXMLRPCRequestHandler(object):
                 else:
                     faultString = "%s: %s" % (e_class,e)
             self.logger.warning(tb_str)
-            response = dumps(Fault(faultCode, faultString))
+            response = self.dumps(Fault(faultCode, faultString))
 
         return response
 
     def _dispatch(self,method,params):
         func = self._get_handler(method)
         context.method = method
-        if not hasattr(context,"session"):
-            #we may be called again by one of our meta-calls (like multiCall)
-            #so we should only create a session if one does not already exist
-            context.session = koji.auth.Session()
-            try:
-                context.session.validate()
-            except koji.AuthLockError:
-                #might be ok, depending on method
-                if method not in ('exclusiveSession','login', 'krbLogin', 'logout'):
-                    raise
-            if context.opts.get('LockOut') and \
-                   method not in ('login', 'krbLogin', 'sslLogin', 'logout'):
-                if not context.session.hasPerm('admin'):
-                    raise koji.ServerOffline, "Server disabled for maintenance"
+        self._check_session(method)
         # handle named parameters
         params,opts = koji.decode_args(*params)
 
@@ -259,30 +299,132 @@ class ModXMLRPCRequestHandler(object):
 
         return ret
 
-    def multiCall(self, calls):
-        """Execute a multicall.  Execute each method call in the calls list, collecting
-        results and errors, and return those as a list."""
-        results = []
-        for call in calls:
+    def _check_session(self, method):
+        if not hasattr(context,"session"):
+            #we may be called again by one of our meta-calls (like multiCall)
+            #so we should only create a session if one does not already exist
+            context.session = koji.auth.Session()
             try:
-                result = self._dispatch(call['methodName'], call['params'])
-            except Fault, fault:
-                results.append({'faultCode': fault.faultCode, 'faultString': fault.faultString})
-            except:
-                # transform unknown exceptions into XML-RPC Faults
-                # don't create a reference to full traceback since this creates
-                # a circular reference.
-                exc_type, exc_value = sys.exc_info()[:2]
-                faultCode = getattr(exc_type, 'faultCode', 1)
-                faultString = ', '.join(exc_value.args)
-                trace = traceback.format_exception(*sys.exc_info())
-                # traceback is not part of the multicall spec, but we include it for debugging purposes
-                results.append({'faultCode': faultCode, 'faultString': faultString, 'traceback': trace})
+                context.session.validate()
+            except koji.AuthLockError:
+                #might be ok, depending on method
+                if method not in ('exclusiveSession','login', 'krbLogin', 'logout'):
+                    raise
+            if context.opts.get('LockOut') and \
+                   method not in ('login', 'krbLogin', 'sslLogin', 'logout'):
+                if not context.session.hasPerm('admin'):
+                    raise koji.ServerOffline, "Server disabled for maintenance"
+
+    def _handle_upload(self, req):
+        context.method = 'rawUpload'
+        self._check_session('rawUpload')
+        start = time.time()
+        ret = kojihub.handle_upload(req)
+        self.logger.debug("Raw upload of %(size)i bytes at offset %(offset)i", ret)
+        self.logger.debug("Completed raw upload for session %s (#%s): %f seconds",
+                        context.session.id, context.session.callnum, time.time()-start)
+        return ret
+
+    def multiCall(self, calls, readonly=False, timing=False):
+        """Execute a multicall.  Execute each method call in the calls list, collecting
+        results and errors, and return those as a list.
+
+        If readonly is true, every call must be to a method that has no side
+        effects (see HandlerRegistry.register_function). The calls are then
+        spread over up to MultiCallWorkers threads, each with its own
+        database connection, which is always rolled back. The results are
+        in the same order as the calls either way.
+
+        If timing is true, the time each call took (in seconds) is added
+        to its result: as a second element for successful calls, and as
+        a 'time' field for faults."""
+        if readonly:
+            bad = [call['methodName'] for call in calls
+                   if not self.handlers.is_readonly(call['methodName'])]
+            if bad:
+                raise koji.GenericError, "not read-only methods: %s" % ', '.join(bad)
+            workers = min(context.opts.get('MultiCallWorkers', 4), len(calls))
+            if workers > 1:
+                return self._parallel_multiCall(calls, workers, timing)
+        return [self._multiCall_one(call, timing) for call in calls]
+
+    def _multiCall_one(self, call, timing=False):
+        """Execute one call of a multicall and return its result entry"""
+        start = time.time()
+        try:
+            result = self._dispatch(call['methodName'], call['params'])
+        except Fault, fault:
+            ret = {'faultCode': fault.faultCode, 'faultString': fault.faultString}
+        except:
+            # transform unknown exceptions into XML-RPC Faults
+            # don't create a reference to full traceback since this creates
+            # a circular reference.
+            exc_type, exc_value = sys.exc_info()[:2]
+            faultCode = getattr(exc_type, 'faultCode', 1)
+            faultString = ', '.join(exc_value.args)
+            trace = traceback.format_exception(*sys.exc_info())
+            # traceback is not part of the multicall spec, but we include it for debugging purposes
+            ret = {'faultCode': faultCode, 'faultString': faultString, 'traceback': trace}
+        else:
+            ret = [result]
+        if timing:
+            elapsed = time.time() - start
+            if isinstance(ret, dict):
+                ret['time'] = elapsed
             else:
-                results.append([result])
+                ret.append(elapsed)
+        return ret
 
+    def _parallel_multiCall(self, calls, workers, timing):
+        """Run read-only calls in worker threads"""
+        todo = Queue.Queue()
+        for i, call in enumerate(calls):
+            todo.put((i, call))
+        results = [None] * len(calls)
+        # the workers share our session and options, but not our connection
+        state = context._threadcopy()
+        state.pop('cnx', None)
+        threads = []
+        for n in xrange(workers):
+            t = threading.Thread(target=self._multiCall_worker,
+                                 args=(state, todo, results, timing))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        for i, ret in enumerate(results):
+            if ret is None:
+                # the worker thread itself failed (e.g. no db connection)
+                results[i] = {'faultCode': 1, 'faultString': 'multicall worker failed'}
         return results
 
+    def _multiCall_worker(self, state, todo, results, timing):
+        for key, value in state.iteritems():
+            setattr(context, key, value)
+        # nothing written here is kept
+        context.readonly = True
+        try:
+            context.cnx = koji.db.connect()
+        except Exception:
+            self.logger.error("Unable to connect for multicall worker", exc_info=True)
+            context._threadclear()
+            return
+        try:
+            while True:
+                try:
+                    i, call = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                results[i] = self._multiCall_one(call, timing)
+        finally:
+            # read-only calls have nothing to commit
+            try:
+                context.cnx.close()
+            except Exception:
+                pass
+            context._threadclear()
+
     def handle_request(self,req):
         """Handle a single XML-RPC request"""
 
@@ -292,9 +434,21 @@ class ModXMLRPCRequestHandler(object):
             req.allow_methods(['POST'],1)
             raise apache.SERVER_RETURN, apache.HTTP_METHOD_NOT_ALLOWED
 
-        response = self._marshaled_dispatch(req.read())
-
-        req.content_type = "text/xml"
+        content_type = req.headers_in.get('Content-Type')
+        if content_type == 'application/octet-stream':
+            # a raw file upload rather than an xmlrpc call
+            response = self._wrap_response(self._handle_upload, req)
+        elif content_type == koji.jsonrpc.CONTENT_TYPE and kojihub.json_enabled():
+            response = self._json_dispatch(req.read())
+        else:
+            response = self._marshaled_dispatch(req.read())
+
+        level = context.opts.get('GzipLevel', 0)
+        if level and len(response) >= 1024 and \
+                'gzip' in req.headers_in.get('Accept-Encoding', ''):
+            response = gzip_data(response, level)
+            req.headers_out['Content-Encoding'] = 'gzip'
+        req.content_type = self.content_type
         req.set_content_length(len(response))
         req.write(response)
         self.logger.debug("Returning %d bytes after %f seconds", len(response),
@@ -302,6 +456,14 @@ class ModXMLRPCRequestHandler(object):
 
 
 
+def gzip_data(data, level):
+    sio = StringIO()
+    fo = gzip.GzipFile(fileobj=sio, mode='wb', compresslevel=level)
+    fo.write(data)
+    fo.close()
+    return sio.getvalue()
+
+
 def dump_req(req):
     data = [
         "request: %s\n" % req.the_request,
@@ -363,6 +525,9 @@ def load_config(req):
         ['DBHost', 'string', None],
         ['DBhost', 'string', None],   # alias for backwards compatibility
         ['DBPass', 'string', None],
+        ['DBPoolSize', 'integer', 1],
+        ['DBConnectionMaxAge', 'integer', 0],
+        ['DBStatementCacheSize', 'integer', 0],
         ['KojiDir', 'string', None],
 
         ['AuthPrincipal', 'string', None],
@@ -385,6 +550,7 @@ def load_config(req):
         ['KojiDebug', 'boolean', False],
         ['KojiTraceback', 'string', None],
         ['VerbosePolicy', 'boolean', False],
+        ['PolicyTestCache', 'boolean', True],
         ['EnableFunctionDebug', 'boolean', False],
 
         ['LogLevel', 'string', 'WARNING'],
@@ -393,6 +559,26 @@ def load_config(req):
         ['MissingPolicyOk', 'boolean', True],
         ['EnableMaven', 'boolean', False],
         ['EnableWin', 'boolean', False],
+        ['EnableRawUpload', 'boolean', True],
+        ['AsyncCallbacks', 'boolean', False],
+        ['AsyncCallbackQueueSize', 'integer', 1000],
+        ['AsyncCallbackTimeout', 'integer', 5],
+        ['FastMarshaller', 'boolean', True],
+        ['EnableJSON', 'boolean', True],
+        ['GzipLevel', 'integer', 1],
+        ['MultiCallWorkers', 'integer', 4],
+
+        ['SetBasedListings', 'boolean', False],
+        ['SetBasedScheduler', 'boolean', False],
+        ['HubScheduler', 'boolean', False],
+        ['HubSchedulerInterval', 'integer', 5],
+        ['HubSchedulerSkipChannels', 'string', 'vm'],
+        ['HostChannelCacheTTL', 'integer', 30],
+        ['SessionCacheTTL', 'integer', 10],
+        ['RPMHeaderCache', 'boolean', True],
+        ['IncrementalRepoInit', 'boolean', False],
+        ['IncrementalRepoMaxChanges', 'integer', 100],
+        ['TaskEventsTimeout', 'integer', 30],
 
         ['LockOut', 'boolean', False],
         ['ServerOffline', 'boolean', False],
@@ -581,6 +767,14 @@ def handler(req, profiling=False):
         firstcall = False
         opts = load_config(req)
         setup_logging(opts)
+        pool_size = opts['DBPoolSize']
+        if opts['MultiCallWorkers'] > 1:
+            # a parallel multicall needs a connection for each worker on
+            # top of the request's own, so keep that many around for reuse
+            pool_size = max(pool_size, opts['MultiCallWorkers'] + 1)
+        koji.db.setPoolOpts(size=pool_size,
+                            max_age=opts['DBConnectionMaxAge'],
+                            statement_cache_size=opts['DBStatementCacheSize'])
         plugins = load_plugins(opts)
         registry = get_registry(opts, plugins)
         policy = get_policy(opts, plugins)
@@ -627,8 +821,15 @@ def handler(req, profiling=False):
             if h.traceback:
                 #rollback
                 context.cnx.rollback()
-            elif context.commit_pending:
-                context.cnx.commit()
+                koji.plugin.discard_callbacks()
+            else:
+                if context.commit_pending:
+                    if hasattr(context, 'session'):
+                        # stored only now, so that read-only calls don't lock the session
+                        context.session.updateCallnum()
+                    context.cnx.commit()
+                # deferred callbacks only run once the changes are in
+                koji.plugin.commit_callbacks()
         finally:
             #make sure context gets cleaned up
             if hasattr(context,'cnx'):
@@ -644,7 +845,7 @@ def get_registry(opts, plugins):
     registry = HandlerRegistry()
     functions = RootExports()
     hostFunctions = HostExports()
-    registry.register_instance(functions)
+    registry.register_instance(functions, readonly=kojihub.READONLY_CALLS)
     registry.register_module(hostFunctions,"host")
     registry.register_function(koji.auth.login)
     registry.register_function(koji.auth.krbLogin)
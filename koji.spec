@@ -188,6 +188,7 @@ rm -rf $RPM_BUILD_ROOT
 %{_sbindir}/kojid
 %dir %{_libexecdir}/kojid
 %{_libexecdir}/kojid/mergerepos
+%{_libexecdir}/kojid/cachedrepo
 %{_initrddir}/kojid
 %config(noreplace) %{_sysconfdir}/sysconfig/kojid
 %dir %{_sysconfdir}/kojid
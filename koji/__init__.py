@@ -29,12 +29,15 @@ except ImportError:
 import base64
 import datetime
 from fnmatch import fnmatch
+import httplib
+import jsonrpc
 import logging
 import logging.handlers
 from koji.util import md5_constructor
 import os
 import os.path
 import pwd
+import Queue
 import random
 import re
 import rpm
@@ -43,6 +46,7 @@ import signal
 import socket
 import struct
 import tempfile
+import threading
 import time
 import traceback
 import urllib
@@ -53,6 +57,7 @@ import xmlrpclib
 from xmlrpclib import loads, Fault
 import xml.sax
 import xml.sax.handler
+import ssl.SSLCommon
 import ssl.XMLRPCServerProxy
 import OpenSSL.SSL
 import zipfile
@@ -70,6 +75,15 @@ RPM_SIGTAG_PGP = 1002
 RPM_SIGTAG_MD5 = 1004
 RPM_SIGTAG_GPG = 1005
 
+# struct formats for the char and integer header data types
+RPM_INT_FORMATS = {
+    1 : 'c',    # char
+    2 : 'B',    # int8
+    3 : 'H',    # int16
+    4 : 'I',    # int32
+    5 : 'Q',    # int64
+}
+
 RPM_FILEDIGESTALGO_IDS = {
     # Taken from RFC 4880
     # A missing algo ID means md5
@@ -478,7 +492,9 @@ def rpm_hdr_size(f, ofs=None):
         fo = file(f, 'rb')
     else:
         fo = f
-    if ofs != None:
+    if ofs is None:
+        ofs = fo.tell()
+    else:
         fo.seek(ofs, 0)
     magic = fo.read(3)
     if magic != RPM_HEADER_MAGIC:
@@ -491,9 +507,10 @@ def rpm_hdr_size(f, ofs=None):
     # now read two 4-byte integers which tell us
     #  - # of index entries
     #  - bytes of data in header
-    data = [ ord(x) for x in fo.read(8) ]
-    il = multibyte(data[0:4])
-    dl = multibyte(data[4:8])
+    data = fo.read(8)
+    if len(data) != 8:
+        raise GenericError, "Invalid rpm: truncated header"
+    il, dl = struct.unpack('>II', data)
 
     #this is what the section data says the size should be
     hdrsize = 8 + 16 * il + dl
@@ -504,7 +521,7 @@ def rpm_hdr_size(f, ofs=None):
     # add eight bytes for section header
     hdrsize = hdrsize + 8
 
-    if not isinstance(f, (str, unicode)):
+    if fo is not f:
         fo.close()
     return hdrsize
 
@@ -527,30 +544,29 @@ class RawHeader(object):
         # read two 4-byte integers which tell us
         #  - # of index entries  (each 16 bytes long)
         #  - bytes of data in header
-        data = [ ord(x) for x in self.header[8:12] ]
-        il = multibyte(data[:4])
-        dl = multibyte(data[4:8])
+        if len(self.header) < 16:
+            raise GenericError, "Invalid rpm header: truncated"
+        il, dl = struct.unpack('>II', self.header[8:16])
+        #the store follows the index (which starts at offset 16)
+        store = 16 + il * 16
+        if len(self.header) < store + dl:
+            raise GenericError, "Invalid rpm header: truncated"
 
-        #read the index (starts at offset 16)
+        #read the whole index at once, each entry is four integers:
+        #  tag, type, offset, count
+        fields = struct.unpack('>%dI' % (il * 4), self.header[16:store])
         index = {}
-        for i in xrange(il):
-            entry = []
-            for j in xrange(4):
-                ofs = 16 + i*16 + j*4
-                data = [ ord(x) for x in self.header[ofs:ofs+4] ]
-                entry.append(multibyte(data))
-            #print "Tag: %d, Type: %d, Offset: %x, Count: %d" % tuple(entry)
-            index[entry[0]] = entry
+        for i in xrange(0, il * 4, 4):
+            index[fields[i]] = list(fields[i:i+4])
         self.datalen = dl
+        self.store = store
         self.index = index
+        self._values = {}
 
     def dump(self):
         print "HEADER DUMP:"
-        #calculate start of store
-        il = len(self.index)
-        store = 16 + il * 16
-        #print "start is: %d" % start
-        #print "index length: %d" % il
+        store = self.store
+        #print "index length: %d" % len(self.index)
         print "Store at offset %d (%0x)" % (store,store)
         #sort entries by offset, dtype
         #also rearrange: tag, dtype, offset, count -> offset, dtype, tag, count
@@ -589,9 +605,9 @@ class RawHeader(object):
                 #integer
                 n = 1 << (dtype - 2)
                 for i in xrange(count):
-                    data = [ ord(x) for x in self.header[pos:pos+n] ]
-                    print "%r" % data
-                    num = multibyte(data)
+                    data = self.header[pos:pos+n]
+                    print "%r" % [ ord(x) for x in data ]
+                    num = struct.unpack('>' + RPM_INT_FORMATS[dtype], data)[0]
                     print "Int(%d): %d" % (n, num)
                     pos += n
                 next = pos
@@ -635,15 +651,12 @@ class RawHeader(object):
         return self._getitem(dtype, offset, count)
 
     def _getitem(self, dtype, offset, count):
-        #calculate start of store
-        il = len(self.index)
-        store = 16 + il * 16
-        pos = store + offset
+        # for integer types, only the first value is returned
+        pos = self.store + offset
         if dtype >= 2 and dtype <= 5:
             n = 1 << (dtype - 2)
             # n-byte integer
-            data = [ ord(x) for x in self.header[pos:pos+n] ]
-            return multibyte(data)
+            return struct.unpack('>' + RPM_INT_FORMATS[dtype], self.header[pos:pos+n])[0]
         elif dtype == 6:
             # string (null terminated)
             end = self.header.find('\0', pos)
@@ -652,9 +665,54 @@ class RawHeader(object):
             #raw data
             return self.header[pos:pos+count]
         else:
-            #XXX - not all valid data types are handled
+            return self._decode(dtype, offset, count)
+
+    def _decode(self, dtype, offset, count):
+        """Decode the full value of an entry"""
+        pos = self.store + offset
+        if dtype == 0:
+            #null
+            return None
+        elif dtype >= 1 and dtype <= 5:
+            #char or integer array
+            fmt = RPM_INT_FORMATS[dtype]
+            size = struct.calcsize(fmt) * count
+            data = self.header[pos:pos+size]
+            if len(data) != size:
+                raise GenericError, "Invalid rpm header: data overflow"
+            return list(struct.unpack('>%d%s' % (count, fmt), data))
+        elif dtype == 6 or dtype == 7:
+            return self._getitem(dtype, offset, count)
+        elif dtype == 8 or dtype == 9:
+            # (i18n) string array
+            ret = []
+            for i in xrange(count):
+                end = self.header.find('\0', pos)
+                if end == -1:
+                    raise GenericError, "Invalid rpm header: unterminated string"
+                ret.append(self.header[pos:end])
+                pos = end + 1
+            return ret
+        else:
             raise GenericError, "Unable to read header data type: %x" % dtype
 
+    def get_values(self, key, default=None):
+        """Return the full, typed value of a header entry
+
+        Unlike get(), the values of char and integer entries are returned
+        as a list even if there is only one. Strings and raw data are
+        returned as str, and string arrays as a list of str. Values are
+        only decoded when first asked for.
+        """
+        if self._values.has_key(key):
+            return self._values[key]
+        entry = self.index.get(key)
+        if entry is None:
+            return default
+        value = self._decode(*entry[1:])
+        self._values[key] = value
+        return value
+
     def get(self, key, default=None):
         entry = self.index.get(key)
         if entry is None:
@@ -720,20 +778,22 @@ def __parse_packet_header(pgp_packet):
 def __subpacket_key_ids(subs):
     """Parse v4 signature subpackets and return a list of issuer key IDs"""
     res = []
-    while len(subs) > 0:
-        byte0 = ord(subs[0])
+    pos = 0
+    while pos < len(subs):
+        byte0 = ord(subs[pos])
         if byte0 < 192:
             length = byte0
             off = 1
         elif byte0 < 255:
-            length = ((byte0 - 192) << 8) + ord(subs[1]) + 192
+            length = ((byte0 - 192) << 8) + ord(subs[pos+1]) + 192
             off = 2
         else:
-            length = struct.unpack('>I', subs[1:5])[0]
+            length = struct.unpack('>I', subs[pos+1:pos+5])[0]
             off = 5
-        if ord(subs[off]) == 16:
-            res.append(subs[off+1 : off+length])
-        subs = subs[off+length:]
+        pos += off
+        if ord(subs[pos]) == 16:
+            res.append(subs[pos+1 : pos+length])
+        pos += length
     return res
 
 def get_sigpacket_key_id(sigpacket):
@@ -1510,6 +1570,115 @@ class VirtualMethod(object):
         return self.__func(self.__name,args,opts)
 
 
+class BatchResult(object):
+    """The pending result of a call made through a BatchSession
+
+    The value is available as the result attribute. Accessing it before the
+    call has been sent flushes the batch. If the call failed, accessing it
+    raises the error (converted with convertFault).
+    """
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def _set(self, entry):
+        if isinstance(entry, dict):
+            self._error = convertFault(Fault(entry['faultCode'], entry['faultString']))
+        else:
+            self._value = entry[0]
+        self._done = True
+        self._batch = None
+
+    def _fail(self, error):
+        self._error = error
+        self._done = True
+        self._batch = None
+
+    def done(self):
+        """Return True if the call has been sent"""
+        return self._done
+
+    def _get_result(self):
+        if not self._done:
+            self._batch.flush()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    result = property(_get_result)
+
+
+class BatchSession(object):
+    """Queue calls on a ClientSession and send them in multicalls
+
+    Calls are made as on the session itself, but return BatchResult objects.
+    Once size calls are queued they are sent together with multiCall. The
+    rest are sent by flush, or as soon as one of their results is needed.
+
+        batch = session.batch()
+        results = [batch.getRPM(rpm_id) for rpm_id in rpm_ids]
+        for r in results:
+            print r.result['nvr']
+
+    If readonly is True, the multicalls are sent as read-only (see
+    ClientSession.multiCall), so all the calls must be read-only.
+    """
+
+    def __init__(self, session, size=100, readonly=False):
+        self._session = session
+        self._size = size
+        self._readonly = readonly
+        self._pending = []
+
+    def _queue(self, name, args, kwargs):
+        result = BatchResult(self)
+        self._pending.append((name, args, kwargs, result))
+        if len(self._pending) >= self._size:
+            self.flush()
+        return result
+
+    def flush(self):
+        """Send all queued calls"""
+        session = self._session
+        while self._pending:
+            if session.multicall:
+                raise GenericError, 'cannot flush a batch while a multicall is in progress'
+            chunk = self._pending[:self._size]
+            del self._pending[:self._size]
+            session.multicall = True
+            try:
+                for name, args, kwargs, result in chunk:
+                    session._callMethod(name, args, kwargs)
+                if self._readonly:
+                    ret = session.multiCall(readonly=True)
+                else:
+                    ret = session.multiCall()
+            except Exception, e:
+                session.multicall = False
+                session._calls = []
+                for name, args, kwargs, result in chunk:
+                    result._fail(e)
+                raise
+            for (name, args, kwargs, result), entry in zip(chunk, ret):
+                result._set(entry)
+
+    def __getattr__(self, name):
+        if name[:1] == '_':
+            raise AttributeError, "no attribute %r" % name
+        return VirtualMethod(self._queue, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+        return False
+
+
 class ClientSession(object):
 
     def __init__(self, baseurl, opts=None, sinfo=None):
@@ -1531,15 +1700,21 @@ class ClientSession(object):
             self.proxyOpts['timeout'] = self.opts['timeout']
         self.baseurl = baseurl
         self.origurl = None
+        self._transport = None
+        self._transport_pid = None
         self.setSession(sinfo)
         self.multicall = False
         self._calls = []
+        self._raw_upload = None
+        self._json = None
         self.logger = logging.getLogger('koji')
 
     def setSession(self,sinfo):
         """Set the session info
 
         If sinfo is None, logout."""
+        # the url, certs or timeout may be about to change
+        self._dropTransport()
         if sinfo is None:
             self.logged_in = False
             self.callnum = None
@@ -1558,7 +1733,80 @@ class ClientSession(object):
             self.callnum = 0
             url = "%s?%s" %(self.baseurl,urllib.urlencode(sinfo))
         self.sinfo = sinfo
-        self.proxy = self.proxyClass(url,**self.proxyOpts)
+        self._url = url
+        self.proxy = self._proxy(url, json=False)
+
+    def _getTransport(self):
+        """Return the persistent transport for this session
+
+        Returns None if the keepalive option is turned off. The transport
+        holds a single connection, so it must only be used from the thread
+        that makes the session's regular calls.
+        """
+        if not self.opts.get('keepalive', True):
+            return None
+        if self._transport is not None and self._transport_pid == os.getpid():
+            return self._transport
+        # never touch a connection inherited from our parent process
+        self._transport = None
+        timeout = self.opts.get('timeout')
+        if self.opts.get('certs'):
+            ctx = ssl.SSLCommon.CreateSSLContext(self.opts['certs'])
+            transport = ssl.XMLRPCServerProxy.PlgSSL_PersistentTransport(ctx, timeout=timeout)
+        elif self.baseurl.startswith('https:'):
+            transport = ssl.XMLRPCServerProxy.Plg_PersistentSafeTransport(timeout=timeout)
+        else:
+            transport = ssl.XMLRPCServerProxy.Plg_PersistentTransport(timeout=timeout)
+        self._transport = transport
+        self._transport_pid = os.getpid()
+        return transport
+
+    def _dropTransport(self):
+        """Close the persistent connection, if we have one"""
+        if self._transport is not None and self._transport_pid == os.getpid():
+            # after a fork the connection is still in use by the parent,
+            # so it is just forgotten rather than shut down
+            self._transport.close()
+        self._transport = None
+        self._transport_pid = None
+
+    def _proxy(self, url, json=True):
+        """Return a proxy for url, reusing our connection when possible
+
+        If json is true, the proxy sends calls as JSON when the session
+        has opted in and the hub supports it.
+        """
+        transport = self._getTransport()
+        if transport is None:
+            return self.proxyClass(url, **self.proxyOpts)
+        verbose = self.proxyOpts.get('verbose', 0)
+        if json and self.useJSON():
+            return jsonrpc.ServerProxy(url, transport, verbose=verbose)
+        return xmlrpclib.ServerProxy(url, transport=transport, allow_none=1,
+                                     verbose=verbose)
+
+    def useJSON(self):
+        """Return True if calls should be sent as JSON (see koji.jsonrpc)
+
+        This requires the use_json option and a persistent connection (the
+        keepalive option), and the hub must advertise support.
+        """
+        if self._json is None:
+            if not self.opts.get('use_json') or jsonrpc.json is None:
+                return False
+            if self.multicall or not self.opts.get('keepalive', True):
+                return False
+            # the check itself is made with XML-RPC
+            self._json = False
+            try:
+                self._json = bool(self.callMethod('jsonEnabled'))
+            except GenericError:
+                # older hub
+                pass
+            except:
+                self._json = None
+                raise
+        return self._json
 
     def login(self,opts=None):
         sinfo = self.callMethod('login',self.opts['user'], self.opts['password'],opts)
@@ -1667,6 +1915,7 @@ class ClientSession(object):
         # 60 second timeout during login
         # Append /login to the URL so we can only require client certs to be sent on login requests
         self.proxy = ssl.XMLRPCServerProxy.PlgXMLRPCServerProxy(self.baseurl + '/ssllogin', certs, timeout=60, **self.proxyOpts)
+        self._url = None
         sinfo = self.callMethod('sslLogin', proxyuser)
         if not sinfo:
             raise AuthError, 'unable to obtain a session'
@@ -1727,7 +1976,9 @@ class ClientSession(object):
                 sinfo['callnum'] = self.callnum
                 self.callnum += 1
                 url = "%s?%s" %(self.baseurl,urllib.urlencode(sinfo))
-                proxy = self.proxyClass(url,**self.proxyOpts)
+                proxy = self._proxy(url)
+            elif self._url:
+                proxy = self._proxy(self._url)
             else:
                 proxy = self.proxy
             tries = 0
@@ -1775,7 +2026,7 @@ class ClientSession(object):
                 time.sleep(interval)
             #not reached
 
-    def multiCall(self, strict=False):
+    def multiCall(self, strict=False, readonly=False, timing=False):
         """Execute a multicall (multiple function calls passed to the server
         and executed at the same time, with results being returned in a batch).
         Before calling this method, the self.multicall field must have
@@ -1787,7 +2038,13 @@ class ClientSession(object):
         for each method added to the multicall, in the order it was added to the multicall.
         Each element of the list will be either a one-element list containing the result of the
         method call, or a map containing "faultCode" and "faultString" keys, describing the
-        error that occurred during the method call."""
+        error that occurred during the method call.
+
+        If readonly is True, the hub may run the calls in parallel. Every
+        call must then be to a method the hub lists as read-only, or the
+        whole multicall fails. If timing is True, the time each call took
+        on the hub is appended to its result list (or added to the fault map
+        as 'time')."""
         if not self.multicall:
             raise GenericError, 'ClientSession.multicall must be set to True before calling multiCall()'
         self.multicall = False
@@ -1796,7 +2053,12 @@ class ClientSession(object):
 
         calls = self._calls
         self._calls = []
-        ret = self._callMethod('multiCall', (calls,), {})
+        kwargs = {}
+        if readonly:
+            kwargs['readonly'] = True
+        if timing:
+            kwargs['timing'] = True
+        ret = self._callMethod('multiCall', (calls,), kwargs)
         if strict:
             #check for faults and raise first one
             for entry in ret:
@@ -1806,13 +2068,300 @@ class ClientSession(object):
                     raise err
         return ret
 
+    def batch(self, size=None, readonly=False):
+        """Return a BatchSession for queueing calls on this session
+
+        size is the number of calls sent in each multicall, by default the
+        batch_size option (or 100)."""
+        if size is None:
+            size = self.opts.get('batch_size', 100)
+        return BatchSession(self, size, readonly)
+
     def __getattr__(self,name):
         #if name[:1] == '_':
         #    raise AttributeError, "no attribute %r" % name
         return VirtualMethod(self._callMethod,name)
 
-    def uploadWrapper(self, localfile, path, name=None, callback=None, blocksize=1048576):
-        """upload a file in chunks using the uploadFile call"""
+    def useRawUpload(self):
+        """Return True if the hub accepts raw uploads (see rawUpload)"""
+        if self._raw_upload is None:
+            if self.multicall or not self.logged_in:
+                return False
+            try:
+                self._raw_upload = bool(self.callMethod('rawUploadEnabled'))
+            except GenericError:
+                # older hub
+                self._raw_upload = False
+        return self._raw_upload
+
+    def _rawConnection(self):
+        """Return a new http(s) connection to the hub"""
+        scheme, netloc = urlparse.urlsplit(self.baseurl)[:2]
+        host, port = urllib.splitport(netloc)
+        if port:
+            port = int(port)
+        if scheme == 'https':
+            if self.opts.get('certs'):
+                ctx = ssl.SSLCommon.CreateSSLContext(self.opts['certs'])
+                return ssl.SSLCommon.PlgHTTPSConnection(host, port or 443, ssl_context=ctx,
+                                                        timeout=self.opts.get('timeout'))
+            return httplib.HTTPSConnection(host, port)
+        return httplib.HTTPConnection(host, port)
+
+    def rawUploadChunk(self, data, path, name, offset, size=None, overwrite=False):
+        """Upload a chunk of a file as raw POST data
+
+        data is written to the file at offset. On the last chunk of a file,
+        size gives the total file size. The md5sum of the chunk is checked by
+        the hub; a GenericError is raised if the upload fails.
+        Returns the hub's reply (a dict with offset, size and hexdigest).
+
+        Chunk uploads can be safely repeated or reordered, so no callnum is
+        sent. This allows several to be in flight at once (see parallelUpload).
+        """
+        if not self.logged_in:
+            raise ActionNotAllowed, 'you must be logged in to upload'
+        args = self.sinfo.copy()
+        args['filepath'] = path
+        args['filename'] = name
+        args['offset'] = str(offset)
+        args['md5'] = md5_constructor(data).hexdigest()
+        if size is not None:
+            args['size'] = str(size)
+        if overwrite:
+            args['overwrite'] = '1'
+        handler = urlparse.urlsplit(self.baseurl)[2] or '/'
+        handler = "%s?%s" % (handler, urllib.urlencode(args))
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Content-Length': str(len(data))}
+        cnx = self._rawConnection()
+        try:
+            cnx.request('POST', handler, data, headers)
+            response = cnx.getresponse()
+            body = response.read()
+        finally:
+            cnx.close()
+        if response.status != 200:
+            raise GenericError, "Error uploading %s/%s at offset %i: HTTP %s %s" \
+                    % (path, name, offset, response.status, response.reason)
+        try:
+            result = loads(body)[0][0]
+        except Fault, fault:
+            raise convertFault(fault)
+        if result['hexdigest'] != args['md5'] or result['size'] != len(data):
+            raise GenericError, "Error uploading %s/%s at offset %i: verification failed" \
+                    % (path, name, offset)
+        return result
+
+    def _sessionProxy(self):
+        """Return a new proxy that makes calls without a callnum
+
+        This is only safe for calls that can be repeated or reordered
+        harmlessly, such as chunk uploads.
+        """
+        url = "%s?%s" % (self.baseurl, urllib.urlencode(self.sinfo))
+        return self.proxyClass(url, **self.proxyOpts)
+
+    def _sendChunk(self, proxy, path, name, offset, contents, totalsize):
+        """Upload one chunk of a file, retrying on failure
+
+        If proxy is None, the chunk is sent raw. Otherwise it is sent with an
+        uploadFile call through the proxy. Since chunks are written at their
+        own offsets, a retry simply overwrites the earlier attempt.
+        """
+        retries = self.opts.get('upload_retries', 3)
+        size = len(contents)
+        tries = 0
+        while True:
+            try:
+                if proxy is None:
+                    if offset + size >= totalsize:
+                        # last chunk, tell the hub the final size
+                        final = offset + size
+                    else:
+                        final = None
+                    # a retried first chunk replaces our own partial file
+                    self.rawUploadChunk(contents, path, name, offset, size=final,
+                                        overwrite=(offset == 0 and tries > 0))
+                    return
+                digest = md5_constructor(contents).hexdigest()
+                data = base64.encodestring(contents)
+                if proxy.uploadFile(path, name, encode_int(size), digest, encode_int(offset), data):
+                    return
+                err = GenericError("Error uploading file %s, offset %d" % (path, offset))
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Fault, fault:
+                err = convertFault(fault)
+            except Exception, e:
+                err = e
+            if tries >= retries:
+                raise err
+            tries += 1
+            self.logger.debug("Try #%d for %s at offset %d failed: %s" % (tries, name, offset, err))
+            time.sleep(self.opts.get('retry_interval', 20))
+
+    def rawUpload(self, localfile, path, name=None, callback=None, blocksize=8388608):
+        """upload a file in chunks of raw POST data
+
+        Each chunk is retried on failure.
+        """
+        start = time.time()
+        if name is None:
+            name = os.path.basename(localfile)
+        debug = self.opts.get('debug',False)
+        totalsize = os.path.getsize(localfile)
+        fo = file(localfile, "rb")
+        ofs = 0
+        if callback:
+            callback(0, totalsize, 0, 0, 0)
+        try:
+            while True:
+                lap = time.time()
+                contents = fo.read(blocksize)
+                size = len(contents)
+                # the last chunk may be empty
+                final = (ofs + size >= totalsize)
+                self._sendChunk(None, path, name, ofs, contents, totalsize)
+                ofs += size
+                now = time.time()
+                t1 = max(now - lap, 0.001)
+                t2 = max(now - start, 0.001)
+                if debug:
+                    self.logger.debug("Uploaded %d bytes in %f seconds (%f kbytes/sec)" % (size,t1,size/t1/1024))
+                    self.logger.debug("Total: %d bytes in %f seconds (%f kbytes/sec)" % (ofs,t2,ofs/t2/1024))
+                if callback:
+                    callback(ofs, totalsize, size, t1, t2)
+                if final:
+                    break
+        finally:
+            fo.close()
+
+    def parallelUpload(self, localfile, path, name=None, callback=None, blocksize=None, threads=4):
+        """upload a file with several chunks in flight at once
+
+        The first chunk is sent on its own, since it (re)creates the file.
+        The rest are handed to a pool of threads, each with its own
+        connection, and may complete in any order. Chunks are sent raw if the
+        hub supports it, otherwise with uploadFile calls. Each chunk is
+        retried on failure. Finally, the size and md5sum of the whole file
+        are checked with checkUpload.
+        """
+        start = time.time()
+        if name is None:
+            name = os.path.basename(localfile)
+        raw = self.useRawUpload()
+        if blocksize is None:
+            if raw:
+                blocksize = 8388608
+            else:
+                blocksize = 1048576
+        debug = self.opts.get('debug',False)
+        totalsize = os.path.getsize(localfile)
+        md5sum = md5_constructor()
+        # the file is read here, so at most this many chunks wait in memory
+        todo = Queue.Queue(threads * 2)
+        done = Queue.Queue()
+        errors = []
+        def newProxy():
+            if raw:
+                return None
+            return self._sessionProxy()
+        def worker():
+            proxy = newProxy()
+            while True:
+                item = todo.get()
+                if item is None:
+                    break
+                if errors:
+                    # give up, but keep taking chunks so the reader cannot block
+                    continue
+                offset, contents = item
+                lap = time.time()
+                try:
+                    self._sendChunk(proxy, path, name, offset, contents, totalsize)
+                except Exception, e:
+                    errors.append(e)
+                    continue
+                done.put((len(contents), time.time() - lap))
+        uploaded = [0]
+        def report():
+            # callbacks are only made from this thread
+            while True:
+                try:
+                    size, t1 = done.get(False)
+                except Queue.Empty:
+                    return
+                uploaded[0] += size
+                t2 = max(time.time() - start, 0.001)
+                if debug:
+                    self.logger.debug("Total: %d bytes in %f seconds (%f kbytes/sec)"
+                                      % (uploaded[0], t2, uploaded[0]/t2/1024))
+                if callback:
+                    callback(uploaded[0], totalsize, size, t1, t2)
+        if callback:
+            callback(0, totalsize, 0, 0, 0)
+        fo = file(localfile, "rb")
+        try:
+            contents = fo.read(blocksize)
+            md5sum.update(contents)
+            lap = time.time()
+            self._sendChunk(newProxy(), path, name, 0, contents, totalsize)
+            done.put((len(contents), time.time() - lap))
+            report()
+            ofs = len(contents)
+            pool = []
+            for i in xrange(threads):
+                thread = threading.Thread(target=worker)
+                thread.setDaemon(True)
+                thread.start()
+                pool.append(thread)
+            try:
+                while not errors:
+                    contents = fo.read(blocksize)
+                    if not contents:
+                        break
+                    md5sum.update(contents)
+                    todo.put((ofs, contents))
+                    ofs += len(contents)
+                    report()
+            finally:
+                for thread in pool:
+                    todo.put(None)
+                for thread in pool:
+                    thread.join()
+        finally:
+            fo.close()
+        report()
+        if errors:
+            raise errors[0]
+        result = self.callMethod('checkUpload', path, name)
+        if not result or decode_int(result['size']) != totalsize \
+                or result['hexdigest'] != md5sum.hexdigest():
+            raise GenericError, "Error uploading file %s/%s: verification failed" % (path, name)
+
+    def uploadWrapper(self, localfile, path, name=None, callback=None, blocksize=None,
+                      parallel=None):
+        """upload a file in chunks
+
+        If the hub supports it, the file is sent as raw data (see rawUpload).
+        Otherwise it is sent with base64 encoded uploadFile calls.
+        If parallel (or the upload_threads option) is more than 1, that many
+        chunks are uploaded at once (see parallelUpload).
+        """
+        if parallel is None:
+            parallel = self.opts.get('upload_threads', 1)
+        if parallel > 1:
+            self.parallelUpload(localfile, path, name, callback, blocksize, threads=parallel)
+            return
+        if self.useRawUpload():
+            if blocksize is None:
+                self.rawUpload(localfile, path, name, callback)
+            else:
+                self.rawUpload(localfile, path, name, callback, blocksize)
+            return
+        if blocksize is None:
+            blocksize = 1048576
         # XXX - stick in a config or something
         start=time.time()
         retries=3
@@ -2065,6 +2614,9 @@ def taskLabel(taskInfo):
         if taskInfo.has_key('request'):
             arch = taskInfo['request'][1]
             extra = arch
+    elif method == 'createrepoMulti':
+        if taskInfo.has_key('request'):
+            extra = ', '.join(taskInfo['request'][1])
     elif method == 'dependantTask':
         if taskInfo.has_key('request'):
             extra = ', '.join([subtask[0] for subtask in taskInfo['request'][1]])
@@ -22,6 +22,8 @@ import socket
 import string
 import random
 import base64
+import threading
+import time
 import krbV
 import koji
 import cgi      #for parse_qs
@@ -36,6 +38,68 @@ from mod_python import apache
 #       - maybe in two steps
 #       -
 
+class SessionCache(object):
+    """Process-wide cache of validated sessions
+
+    Loading a session takes a locked read of the session row, a user lookup,
+    an exclusive session lookup and an update of the session timestamp. Once
+    a session has been loaded, later calls within SessionCacheTTL seconds
+    (0 disables the cache) only re-read the parts of the session row that
+    change between calls (callnum, expired and exclusive) and which session
+    of the user holds the exclusive lock, in a single query. The rest, along
+    with the perms, groups and host id looked up for the session, is reused.
+
+    Changes made through this process invalidate the entries affected.
+    Permission, group and user status changes made by other hub processes
+    are picked up when the TTL expires. The request threads of the process
+    share the cache, so changes to it are made under a lock.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, id, key, hostip):
+        """Return the cache entry for a session, or None"""
+        opts = getattr(context, 'opts', None) or {}
+        ttl = opts.get('SessionCacheTTL', 10)
+        entry = self.sessions.get(id)
+        if entry is None or entry['key'] != key or entry['hostip'] != hostip:
+            return None
+        if time.time() - entry['loaded'] >= ttl:
+            return None
+        return entry
+
+    def set(self, id, entry):
+        entry['loaded'] = time.time()
+        self.lock.acquire()
+        try:
+            self.sessions[id] = entry
+        finally:
+            self.lock.release()
+
+    def invalidate(self, session_id=None, user_id=None):
+        """Drop cached sessions
+
+        With session_id, drop that session and its subsessions. With user_id,
+        drop the sessions of that user. With neither, drop everything."""
+        self.lock.acquire()
+        try:
+            if session_id is None and user_id is None:
+                self.sessions.clear()
+                return
+            for id, entry in self.sessions.items():
+                data = entry['session_data']
+                if session_id is not None and session_id in (id, data['master']):
+                    del self.sessions[id]
+                elif user_id is not None and data['user_id'] == user_id:
+                    del self.sessions[id]
+        finally:
+            self.lock.release()
+
+session_cache = SessionCache()
+
+
 class Session(object):
 
     def __init__(self,args=None,hostip=None):
@@ -50,6 +114,8 @@ class Session(object):
         self.exclusive = False
         self.lockerror = None
         self.callnum = None
+        self._callnum_saved = False
+        self._cached = None
         #get session data from request
         if args is None:
             req = getattr(context,'req',None)
@@ -71,8 +137,26 @@ class Session(object):
             callnum = args['callnum'][0]
         except:
             callnum = None
-        #lookup the session
         c = context.cnx.cursor()
+        entry = session_cache.get(id, key, hostip)
+        if entry is not None:
+            #only re-read what changes from call to call, including the
+            #exclusive session of the user (other hub processes may change it)
+            q = """SELECT callnum, expired, "exclusive",
+                (SELECT excl.id FROM sessions AS excl WHERE excl.user_id = sessions.user_id
+                    AND excl."exclusive" = TRUE AND excl.expired = FALSE)
+            FROM sessions WHERE id = %(id)i"""
+            c.execute(q, locals())
+            row = c.fetchone()
+            if not row:
+                session_cache.invalidate(session_id=id)
+                raise koji.AuthError, 'Invalid session or bad credentials'
+            session_data = entry['session_data'].copy()
+            session_data['callnum'], session_data['expired'], session_data['exclusive'], excl_id = row
+            callnum = self._checkSessionData(id, session_data, callnum)
+            self._load(id, key, hostip, callnum, session_data, excl_id, entry)
+            return
+        #lookup the session
         fields = {
             'authtype': 'authtype',
             'callnum': 'callnum',
@@ -98,32 +182,7 @@ class Session(object):
         if not row:
             raise koji.AuthError, 'Invalid session or bad credentials'
         session_data = dict(zip(aliases, row))
-        #check for expiration
-        if session_data['expired']:
-            raise koji.AuthExpired, 'session "%i" has expired' % id
-        #check for callnum sanity
-        if callnum is not None:
-            try:
-                callnum = int(callnum)
-            except (ValueError,TypeError):
-                raise koji.AuthError, "Invalid callnum: %r" % callnum
-            lastcall = session_data['callnum']
-            if lastcall is not None:
-                if lastcall > callnum:
-                    raise koji.SequenceError, "%d > %d (session %d)" \
-                            % (lastcall,callnum,id)
-                elif lastcall == callnum:
-                    #Some explanation:
-                    #This function is one of the few that performs its own commit.
-                    #However, our storage of the current callnum is /after/ that
-                    #commit. This means the the current callnum only gets commited if
-                    #a commit happens afterward.
-                    #We only schedule a commit for dml operations, so if we find the
-                    #callnum in the db then a previous attempt succeeded but failed to
-                    #return. Data was changed, so we cannot simply try the call again.
-                    raise koji.RetryError, \
-                        "unable to retry call %d (method %s) for session %d" \
-                        % (callnum, getattr(context, 'method', 'UNKNOWN'), id)
+        callnum = self._checkSessionData(id, session_data, callnum)
 
         # read user data
         #historical note:
@@ -137,12 +196,9 @@ class Session(object):
 
         if user_data['status'] != koji.USER_STATUS['NORMAL']:
             raise koji.AuthError, 'logins by %s are not allowed' % user_data['name']
-        #check for exclusive sessions
-        if session_data['exclusive']:
-            #we are the exclusive session for this user
-            self.exclusive = True
-        else:
-            #see if an exclusive session exists
+        #see if another session holds the exclusive lock (see _load)
+        excl_id = None
+        if not session_data['exclusive']:
             q = """SELECT id FROM sessions WHERE user_id=%(user_id)s
             AND "exclusive" = TRUE AND expired = FALSE"""
             #should not return multiple rows (unique constraint)
@@ -150,16 +206,6 @@ class Session(object):
             row = c.fetchone()
             if row:
                 (excl_id,) = row
-                if excl_id == session_data['master']:
-                    #(note excl_id cannot be None)
-                    #our master session has the lock
-                    self.exclusive = True
-                else:
-                    #a session unrelated to us has the lock
-                    self.lockerror = "User locked by another session"
-                    # we don't enforce here, but rely on the dispatcher to enforce
-                    # if appropriate (otherwise it would be impossible to steal
-                    # an exclusive session with the force option).
 
         # update timestamp
         q = """UPDATE sessions SET update_time=NOW() WHERE id = %(id)i"""
@@ -167,13 +213,65 @@ class Session(object):
         #save update time
         context.cnx.commit()
 
-        #update callnum (this is deliberately after the commit)
-        #see earlier note near RetryError
+        entry = {'key': key, 'hostip': hostip, 'session_data': session_data.copy(),
+                 'user_data': user_data,
+                 'perms': None, 'groups': None, 'host_id': ''}
+        session_cache.set(id, entry)
+        self._load(id, key, hostip, callnum, session_data, excl_id, entry)
+
+    def _checkSessionData(self, id, session_data, callnum):
+        """Check a session row for expiration and callnum sanity
+
+        Returns the callnum as an int (or None)"""
+        #check for expiration
+        if session_data['expired']:
+            raise koji.AuthExpired, 'session "%i" has expired' % id
+        #check for callnum sanity
         if callnum is not None:
-            q = """UPDATE sessions SET callnum=%(callnum)i WHERE id = %(id)i"""
-            c.execute(q,locals())
+            try:
+                callnum = int(callnum)
+            except (ValueError,TypeError):
+                raise koji.AuthError, "Invalid callnum: %r" % callnum
+            lastcall = session_data['callnum']
+            if lastcall is not None:
+                if lastcall > callnum:
+                    raise koji.SequenceError, "%d > %d (session %d)" \
+                            % (lastcall,callnum,id)
+                elif lastcall == callnum:
+                    #Some explanation:
+                    #The current callnum is only stored when the call commits
+                    #(see updateCallnum).
+                    #We only schedule a commit for dml operations, so if we find the
+                    #callnum in the db then a previous attempt succeeded but failed to
+                    #return. Data was changed, so we cannot simply try the call again.
+                    raise koji.RetryError, \
+                        "unable to retry call %d (method %s) for session %d" \
+                        % (callnum, getattr(context, 'method', 'UNKNOWN'), id)
+        return callnum
+
+    def _load(self, id, key, hostip, callnum, session_data, excl_id, entry):
+        """Record the login data for a validated session
+
+        excl_id is the id of the session holding the exclusive lock for the
+        user, if any."""
+        #check for exclusive sessions
+        if session_data['exclusive']:
+            #we are the exclusive session for this user
+            self.exclusive = True
+        elif excl_id is not None:
+            if excl_id == session_data['master']:
+                #(note excl_id cannot be None)
+                #our master session has the lock
+                self.exclusive = True
+            else:
+                #a session unrelated to us has the lock
+                self.lockerror = "User locked by another session"
+                # we don't enforce here, but rely on the dispatcher to enforce
+                # if appropriate (otherwise it would be impossible to steal
+                # an exclusive session with the force option).
 
         # record the login data
+        # the callnum is stored when the call commits, see updateCallnum
         self.id = id
         self.key = key
         self.hostip = hostip
@@ -182,11 +280,13 @@ class Session(object):
         self.authtype = session_data['authtype']
         self.master = session_data['master']
         self.session_data = session_data
-        self.user_data = user_data
+        self.user_data = entry['user_data']
         # we look up perms, groups, and host_id on demand, see __getattr__
-        self._perms = None
-        self._groups = None
-        self._host_id = ''
+        # (and keep them in the cache entry)
+        self._cached = entry
+        self._perms = entry['perms']
+        self._groups = entry['groups']
+        self._host_id = entry['host_id']
         self.logged_in = True
 
     def __getattr__(self, name):
@@ -195,14 +295,20 @@ class Session(object):
             if self._perms is None:
                 #in a dict for quicker lookup
                 self._perms = dict([[name,1] for name in get_user_perms(self.user_id)])
+                if self._cached is not None:
+                    self._cached['perms'] = self._perms
             return self._perms
         elif name == 'groups':
             if self._groups is None:
                 self._groups = get_user_groups(self.user_id)
+                if self._cached is not None:
+                    self._cached['groups'] = self._groups
             return self._groups
         elif name == 'host_id':
             if self._host_id == '':
                 self._host_id = self._getHostId()
+                if self._cached is not None:
+                    self._cached['host_id'] = self._host_id
             return self._host_id
         else:
             raise AttributeError, "%s" % name
@@ -222,6 +328,19 @@ class Session(object):
             raise koji.AuthLockError, self.lockerror
         return True
 
+    def updateCallnum(self):
+        """Store the callnum of the current call
+
+        This is called just before the changes made by the call are
+        committed, so that calls which change nothing never write to (or
+        lock) the session row. See the note near RetryError."""
+        if not self.logged_in or self.callnum is None or self._callnum_saved:
+            return
+        q = """UPDATE sessions SET callnum=%(callnum)i WHERE id = %(id)i"""
+        c = context.cnx.cursor()
+        c.execute(q, {'callnum': self.callnum, 'id': self.id})
+        self._callnum_saved = True
+
     def checkLoginAllowed(self, user_id):
         """Verify that the user is allowed to login"""
         cursor = context.cnx.cursor()
@@ -435,7 +554,9 @@ class Session(object):
         #mark this session exclusive
         q = """UPDATE sessions SET "exclusive"=TRUE WHERE id=%(session_id)s"""
         c.execute(q,locals())
+        self.updateCallnum()
         context.cnx.commit()
+        session_cache.invalidate(user_id=user_id)
 
     def makeShared(self):
         """Drop out of exclusive mode"""
@@ -443,7 +564,9 @@ class Session(object):
         session_id = self.id
         q = """UPDATE sessions SET "exclusive"=NULL WHERE id=%(session_id)s"""
         c.execute(q,locals())
+        self.updateCallnum()
         context.cnx.commit()
+        session_cache.invalidate(user_id=self.user_id)
 
     def logout(self):
         """expire a login session"""
@@ -457,6 +580,7 @@ class Session(object):
         c = context.cnx.cursor()
         c.execute(update, {'id': self.id})
         context.cnx.commit()
+        session_cache.invalidate(session_id=self.id)
         self.logged_in = False
 
     def logoutChild(self, session_id):
@@ -470,7 +594,9 @@ class Session(object):
         master = self.id
         c = context.cnx.cursor()
         c.execute(update, locals())
+        self.updateCallnum()
         context.cnx.commit()
+        session_cache.invalidate(session_id=session_id)
 
     def createSession(self, user_id, hostip, authtype, master=None):
         """Create a new session for the given user.
@@ -497,6 +623,7 @@ class Session(object):
         VALUES (%(session_id)i, %(user_id)i, %(key)s, %(hostip)s, %(authtype)i, %(master)s)
         """
         c.execute(q,locals())
+        self.updateCallnum()
         context.cnx.commit()
 
         #return session info
@@ -602,6 +729,7 @@ class Session(object):
         insert = """INSERT INTO users (id, name, usertype, status, krb_principal)
         VALUES (%(user_id)i, %(name)s, %(usertype)i, %(status)i, %(krb_principal)s)"""
         cursor.execute(insert, locals())
+        self.updateCallnum()
         context.cnx.commit()
 
         return user_id
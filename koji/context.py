@@ -65,6 +65,14 @@ class ThreadLocal(object):
             ", ".join([ "%s : %s" %(k,v.__dict__) for (k,v) in tdict.iteritems() ]) + \
             "}"
 
+    def _threadcopy(self):
+        """Return a copy of the current thread's data as a dict"""
+        id = thread.get_ident()
+        tdict = object.__getattribute__(self, '_tdict')
+        if not tdict.has_key(id):
+            return {}
+        return tdict[id].__dict__.copy()
+
     def _threadclear(self):
         id = thread.get_ident()
         tdict = object.__getattribute__(self, '_tdict')
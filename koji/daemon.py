@@ -21,6 +21,7 @@
 #       Mike Bonnet <mikeb@redhat.com>
 
 import koji
+import koji.scheduler
 import koji.tasks
 from koji.tasks import safe_rmtree
 from koji.util import md5_constructor, parseStatus
@@ -37,6 +38,20 @@ import errno
 import xmlrpclib
 
 
+def _upload_chunk(session, fname, path, offset, contents):
+    """Upload a chunk, raw if the hub supports it. Returns True on success"""
+    if session.useRawUpload():
+        try:
+            session.rawUploadChunk(contents, path, fname, offset)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            return False
+        return True
+    data = base64.encodestring(contents)
+    digest = md5_constructor(contents).hexdigest()
+    return session.uploadFile(path, fname, len(contents), digest, offset, data)
+
 def incremental_upload(session, fname, fd, path, retries=5, logger=None):
     if not fd:
         return
@@ -48,13 +63,9 @@ def incremental_upload(session, fname, fd, path, retries=5, logger=None):
         if size == 0:
             break
 
-        data = base64.encodestring(contents)
-        digest = md5_constructor(contents).hexdigest()
-        del contents
-
         tries = 0
         while True:
-            if session.uploadFile(path, fname, size, digest, offset, data):
+            if _upload_chunk(session, fname, path, offset, contents):
                 break
 
             if tries <= retries:
@@ -68,9 +79,9 @@ def incremental_upload(session, fname, fd, path, retries=5, logger=None):
                     sys.stderr.write("Error uploading file %s to %s at offset %d\n" % (fname, path, offset))
                 break
 
-def log_output(session, path, args, outfile, uploadpath, cwd=None, logerror=0, append=0, chroot=None, env=None):
-    """Run command with output redirected.  If chroot is not None, chroot to the directory specified
-    before running the command."""
+def spawn_output(session, path, args, outfile, cwd=None, logerror=0, append=0, chroot=None, env=None):
+    """Start a command with output redirected and return its pid.  If chroot is not None,
+    chroot to the directory specified before running the command."""
     pid = os.fork()
     fd = None
     if not pid:
@@ -103,31 +114,37 @@ def log_output(session, path, args, outfile, uploadpath, cwd=None, logerror=0, a
                     pass
             print msg
             os._exit(1)
-    else:
-        if chroot:
-            outfile = os.path.normpath(chroot + outfile)
-        outfd = None
-        remotename = os.path.basename(outfile)
-        while True:
-            status = os.waitpid(pid, os.WNOHANG)
-            time.sleep(1)
+    return pid
 
-            if not outfd:
-                try:
-                    outfd = file(outfile, 'r')
-                except IOError:
-                    # will happen if the forked process has not created the logfile yet
-                    continue
-                except:
-                    print 'Error reading log file: %s' % outfile
-                    print ''.join(traceback.format_exception(*sys.exc_info()))
+def log_output(session, path, args, outfile, uploadpath, cwd=None, logerror=0, append=0, chroot=None, env=None):
+    """Run command with output redirected.  If chroot is not None, chroot to the directory specified
+    before running the command."""
+    pid = spawn_output(session, path, args, outfile, cwd=cwd, logerror=logerror, append=append,
+                       chroot=chroot, env=env)
+    if chroot:
+        outfile = os.path.normpath(chroot + outfile)
+    outfd = None
+    remotename = os.path.basename(outfile)
+    while True:
+        status = os.waitpid(pid, os.WNOHANG)
+        time.sleep(1)
 
-            incremental_upload(session, remotename, outfd, uploadpath)
+        if not outfd:
+            try:
+                outfd = file(outfile, 'r')
+            except IOError:
+                # will happen if the forked process has not created the logfile yet
+                continue
+            except:
+                print 'Error reading log file: %s' % outfile
+                print ''.join(traceback.format_exception(*sys.exc_info()))
+
+        incremental_upload(session, remotename, outfd, uploadpath)
 
-            if status[0] != 0:
-                if outfd:
-                    outfd.close()
-                return status[1]
+        if status[0] != 0:
+            if outfd:
+                outfd.close()
+            return status[1]
 
 
 ## BEGIN kojikamid dup
@@ -441,6 +458,7 @@ class TaskManager(object):
         self.ready = False
         self.hostdata = {}
         self.task_load = 0.0
+        self.task_events = getattr(options, 'task_events', False)
         self.host_id = self.session.host.getID()
         self.start_time = self.session.getSessionInfo()['start_time']
         self.logger = logging.getLogger("koji.TaskManager")
@@ -692,32 +710,61 @@ class TaskManager(object):
                 else:
                     self.logger.info("Lingering task %r (pid %r)" % (id,pid))
 
+    def waitForEvents(self, timeout):
+        """Sleep for timeout seconds, waking waiting tasks as needed
+
+        With the task_events option, the hub tells us as soon as subtasks of
+        our waiting tasks finish, so they do not have to wait for the next
+        updateTasks. Otherwise this just sleeps.
+        """
+        end = time.time() + timeout
+        woken = {}
+        while self.task_events:
+            remaining = int(end - time.time())
+            if remaining <= 0:
+                return
+            try:
+                alerts = self.session.host.waitForTaskEvents(remaining, woken.keys())
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                # e.g. an older hub, fall back to polling
+                self.logger.warn("Error waiting for task events, disabling them", exc_info=True)
+                self.task_events = False
+                break
+            for id in alerts:
+                woken[id] = 1
+                if self.pids.has_key(id):
+                    self.logger.info("Waking up task: %r" % id)
+                    os.kill(self.pids[id], signal.SIGUSR2)
+        remaining = end - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
     def getNextTask(self):
         self.ready = self.readyForTask()
         self.session.host.updateHost(self.task_load,self.ready)
         if not self.ready:
             self.logger.info("Not ready for task")
             return False
+        if getattr(self.options, 'hub_scheduler', False):
+            return self.getAssignedTask()
         hosts, tasks = self.session.host.getLoadData()
         self.logger.debug("Load Data:")
         self.logger.debug("  hosts: %r" % hosts)
         self.logger.debug("  tasks: %r" % tasks)
         #now we organize this data into channel-arch bins
-        bin_hosts = {}  #hosts indexed by bin
+        #(see koji.scheduler for the model)
+        bin_hosts = koji.scheduler.index_bins(hosts)
         bins = {}       #bins for this host
         our_avail = None
         for host in hosts:
-            host['bins'] = []
             if host['id'] == self.host_id:
                 #note: task_load reported by server might differ from what we
                 #sent due to precision variation
-                our_avail = host['capacity'] - host['task_load']
-            for chan in host['channels']:
-                for arch in host['arches'].split() + ['noarch']:
-                    bin = "%s:%s" % (chan,arch)
-                    bin_hosts.setdefault(bin,[]).append(host)
-                    if host['id'] == self.host_id:
-                        bins[bin] = 1
+                our_avail = koji.scheduler.host_avail(host)
+                for bin in koji.scheduler.host_bins(host):
+                    bins[bin] = 1
         self.logger.debug("bins: %r" % bins)
         if our_avail is None:
             self.logger.info("Server did not report this host. Are we disabled?")
@@ -728,9 +775,7 @@ class TaskManager(object):
         #sort available capacities for each of our bins
         avail = {}
         for bin in bins.iterkeys():
-            avail[bin] = [host['capacity'] - host['task_load'] for host in bin_hosts[bin]]
-            avail[bin].sort()
-            avail[bin].reverse()
+            avail[bin] = koji.scheduler.bin_avail(bin_hosts[bin])
         for task in tasks:
             # note: tasks are in priority order
             self.logger.debug("task: %r" % task)
@@ -750,7 +795,7 @@ class TaskManager(object):
                     if self.takeTask(task):
                         return True
             elif task['state'] == koji.TASK_STATES['FREE']:
-                bin = "%(channel_id)s:%(arch)s" % task
+                bin = koji.scheduler.task_bin(task)
                 self.logger.debug("task is free, bin=%r" % bin)
                 if not bins.has_key(bin):
                     continue
@@ -779,12 +824,28 @@ class TaskManager(object):
         """
         median = bin_avail[(len(bin_avail)-1)/2]
         self.logger.debug("ours: %.2f, median: %.2f" % (avail, median))
-        if avail >= median:
+        if koji.scheduler.check_rel_avail(bin_avail, avail):
             return True
         else:
             self.logger.debug("Skipping - available capacity in lower half")
             return False
 
+    def getAssignedTask(self):
+        """Take the next task the hub has assigned to us
+
+        This is used instead of the load data crunching in getNextTask when
+        the hub does the scheduling (the hub_scheduler option).
+        Returns True if a task was started, False otherwise.
+        """
+        data = self.session.host.getTask()
+        if data is None:
+            return False
+        if not self.handlers.has_key(data['method']):
+            self.logger.warn("No handler for method %(method)s, freeing task %(id)i", data)
+            self.session.host.freeTasks([data['id']])
+            return False
+        return self.startTask(data)
+
     def _waitTask(self, task_id, pid=None):
         """Wait (nohang) on the task, return true if finished"""
         if pid is None:
@@ -1057,8 +1118,15 @@ class TaskManager(object):
         if data is None:
             self.logger.warn("Could not open")
             return False
+        return self.startTask(data)
+
+    def startTask(self, data):
+        """Start running a task that has been opened for us
+
+        Returns True if successful, False otherwise
+        """
         if not data.has_key('request') or data['request'] is None:
-            self.logger.warn("Task '%s' has no request" % task['id'])
+            self.logger.warn("Task '%s' has no request" % data['id'])
             return False
         id = data['id']
         request = data['request']
@@ -22,29 +22,257 @@
 
 
 import logging
+import re
+import select
 import sys
 import pgdb
+import thread
 import time
 import traceback
 from pgdb import _quoteparams
 assert pgdb.threadsafety >= 1
-import context
 
 ## Globals ##
 _DBopts = None
-# A persistent connection to the database.
-# A new connection will be created whenever
-# Apache forks a new worker, and that connection
-# will be used to service all requests handled
-# by that worker.
-# This probably doesn't need to be a ThreadLocal
-# since Apache is not using threading,
-# but play it safe anyway.
-_DBconn = context.ThreadLocal()
+_PoolOpts = {
+    # maximum number of idle connections kept per process
+    'size': 1,
+    # maximum age of a connection in seconds (0 means no limit)
+    'max_age': 0,
+    # number of prepared statements cached per connection (0 disables)
+    'statement_cache_size': 0,
+    # how many times a query must be seen before it is prepared
+    'prepare_threshold': 2,
+}
+
+
+class StatementCache(object):
+    """Per-connection cache of server-side prepared statements
+
+    Statements are keyed by their SQL text. pyformat parameters are mapped
+    to positional ($n) parameters, and the values are passed to EXECUTE.
+    Queries that cannot be expressed this way (e.g. list parameters for IN
+    clauses) are run normally, as are queries that fail to prepare.
+    """
+
+    param_re = re.compile(r'%(?:\((\w+)\)[sdi]|%)')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.size = pool.opts['statement_cache_size']
+        self.threshold = pool.opts['prepare_threshold']
+        self.statements = {}    # sql -> (name, params)
+        self.seen = {}          # sql -> count
+        self.used = {}          # sql -> last use
+        self.unpreparable = {}
+        self.counter = 0
+
+    def execute(self, cursor, operation, parameters):
+        """Execute operation via a prepared statement if we can
+
+        Returns True if the operation was handled, False if the caller
+        should execute it normally.
+        """
+        if self.size <= 0 or not hasattr(parameters, 'has_key'):
+            return False
+        if self.unpreparable.has_key(operation):
+            return False
+        self.counter += 1
+        entry = self.statements.get(operation)
+        if entry is None:
+            count = self.seen.get(operation, 0) + 1
+            if count < self.threshold:
+                if len(self.seen) > self.size * 10:
+                    # just a hint, so no need for anything smarter
+                    self.seen.clear()
+                self.seen[operation] = count
+                self.pool.stat('statement_misses')
+                return False
+            entry = self.prepare(cursor, operation, parameters)
+            if entry is None:
+                self.pool.stat('statement_misses')
+                return False
+        else:
+            self.pool.stat('statement_hits')
+        name, params = entry
+        values = []
+        for key in params:
+            value = parameters[key]
+            if isinstance(value, (list, tuple, dict)):
+                return False
+            values.append(_quoteparams('%s', (value,)))
+        self.used[operation] = self.counter
+        if values:
+            cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(values)))
+        else:
+            cursor.execute('EXECUTE %s' % name)
+        return True
+
+    def prepare(self, cursor, operation, parameters):
+        params = []
+        def _param(match):
+            key = match.group(1)
+            if key is None:
+                # a literal %%
+                return '%'
+            if key not in params:
+                params.append(key)
+            return '$%i' % (params.index(key) + 1)
+        if not operation.lstrip()[:6].upper() == 'SELECT':
+            self.unpreparable[operation] = 1
+            return None
+        sql = self.param_re.sub(_param, operation)
+        if '%' in self.param_re.sub('', operation):
+            # some other format we don't understand
+            self.unpreparable[operation] = 1
+            return None
+        for key in params:
+            if isinstance(parameters.get(key), (list, tuple, dict)):
+                self.unpreparable[operation] = 1
+                return None
+        if len(self.statements) >= self.size:
+            self.evict(cursor)
+        name = 'koji_stmt_%i' % self.counter
+        # a failed PREPARE would abort the transaction, hence the savepoint
+        cursor.execute('SAVEPOINT koji_prepare')
+        try:
+            cursor.execute('PREPARE %s AS %s' % (name, sql))
+        except pgdb.Error:
+            cursor.execute('ROLLBACK TO SAVEPOINT koji_prepare')
+            self.unpreparable[operation] = 1
+            self.pool.stat('statement_failures')
+            return None
+        cursor.execute('RELEASE SAVEPOINT koji_prepare')
+        self.pool.stat('statements_prepared')
+        self.seen.pop(operation, None)
+        entry = (name, params)
+        self.statements[operation] = entry
+        return entry
+
+    def evict(self, cursor):
+        """Deallocate the least recently used statement"""
+        oldest = None
+        for operation in self.statements:
+            if oldest is None or self.used.get(operation, 0) < self.used.get(oldest, 0):
+                oldest = operation
+        if oldest is None:
+            return
+        name = self.statements.pop(oldest)[0]
+        self.used.pop(oldest, None)
+        cursor.execute('DEALLOCATE %s' % name)
+        self.pool.stat('statements_evicted')
+
+
+class PooledConnection(object):
+    """A pgdb connection along with its pool bookkeeping"""
+
+    def __init__(self, pool, cnx):
+        self.cnx = cnx
+        self.created = time.time()
+        self.statements = StatementCache(pool)
+
+    def expired(self, max_age):
+        return max_age > 0 and time.time() - self.created > max_age
+
+    def check(self):
+        """Make sure the connection is usable and has no open transaction"""
+        try:
+            # Under normal circumstances, the last use of this connection
+            # will have issued a raw ROLLBACK to close the transaction. To
+            # avoid 'no transaction in progress' warnings (depending on postgres
+            # configuration) we open a new one here.
+            # Should there somehow be a transaction in progress, a second
+            # BEGIN will be a harmless no-op, though there may be a warning.
+            self.cnx.cursor().execute('BEGIN')
+            self.cnx.rollback()
+        except pgdb.Error:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.cnx.close()
+        except pgdb.Error:
+            pass
+
+
+class ConnectionPool(object):
+    """A per-process pool of database connections
+
+    Under mod_python each Apache worker process has its own pool, so the
+    stats reported are per process as well.
+    """
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.idle = []
+        self.lock = thread.allocate_lock()
+        self.stats = {}
+        self.logger = logging.getLogger('koji.db')
+
+    def stat(self, name, incr=1):
+        self.stats[name] = self.stats.get(name, 0) + incr
+
+    def get(self):
+        """Return a healthy connection, reusing an idle one if possible"""
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.idle:
+                    break
+                pooled = self.idle.pop()
+            finally:
+                self.lock.release()
+            if pooled.expired(self.opts['max_age']):
+                self.stat('expired')
+                pooled.close()
+                continue
+            if not pooled.check():
+                self.stat('failed_checks')
+                pooled.close()
+                continue
+            self.stat('hits')
+            return pooled
+        self.stat('misses')
+        opts = _DBopts
+        if opts is None:
+            opts = {}
+        try:
+            cnx = pgdb.connect(**opts)
+        except Exception:
+            self.logger.error(''.join(traceback.format_exception(*sys.exc_info())))
+            raise
+        return PooledConnection(self, cnx)
+
+    def put(self, pooled):
+        """Return a connection to the pool (it must not be in a transaction)"""
+        if pooled.expired(self.opts['max_age']):
+            self.stat('expired')
+            pooled.close()
+            return
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.opts['size']:
+                self.idle.append(pooled)
+                return
+        finally:
+            self.lock.release()
+        self.stat('overflow')
+        pooled.close()
+
+    def getStats(self):
+        ret = self.stats.copy()
+        ret['idle'] = len(self.idle)
+        return ret
+
+# created on first use, so that pool options can be set first
+_DBpool = None
+
 
 class DBWrapper:
-    def __init__(self, cnx):
+    def __init__(self, cnx, pooled=None):
         self.cnx = cnx
+        self.pooled = pooled
 
     def __getattr__(self, key):
         if not self.cnx:
@@ -54,22 +282,72 @@ class DBWrapper:
     def cursor(self, *args, **kw):
         if not self.cnx:
             raise StandardError, 'connection is closed'
-        return CursorWrapper(self.cnx.cursor(*args, **kw))
+        statements = None
+        if self.pooled is not None:
+            statements = self.pooled.statements
+        return CursorWrapper(self.cnx.cursor(*args, **kw), statements)
+
+    def _rawcnx(self):
+        # the PyGreSQL connection under the DB-API one, which handles
+        # notifications (the attribute name depends on the PyGreSQL version)
+        for attr in ('_cnx', '_pgdbCnx__cnx'):
+            raw = getattr(self.cnx, attr, None)
+            if raw is not None and hasattr(raw, 'getnotify'):
+                return raw
+        return None
+
+    def canNotify(self):
+        """Return True if waitForNotify is supported by the db driver"""
+        return self._rawcnx() is not None
+
+    def waitForNotify(self, timeout):
+        """Wait up to timeout seconds for notifications on LISTENed channels
+
+        Notifications are only delivered between transactions, so this commits
+        the current transaction. Returns a list of the channel names that were
+        notified, which may be empty.
+        """
+        if not self.cnx:
+            raise StandardError, 'connection is closed'
+        raw = self._rawcnx()
+        if raw is None:
+            raise StandardError, 'notifications not supported by db driver'
+        self.cnx.commit()
+        ret = []
+        while True:
+            notify = raw.getnotify()
+            if notify is None:
+                break
+            ret.append(notify[0])
+        if ret:
+            return ret
+        select.select([raw.fileno()], [], [], timeout)
+        self.cnx.commit()
+        while True:
+            notify = raw.getnotify()
+            if notify is None:
+                break
+            ret.append(notify[0])
+        return ret
 
     def close(self):
         # Rollback any uncommitted changes and clear the connection so
         # this DBWrapper is no longer usable after close()
         if not self.cnx:
             raise StandardError, 'connection is closed'
-        self.cnx.cursor().execute('ROLLBACK')
+        cnx = self.cnx
+        self.cnx = None
+        cnx.cursor().execute('ROLLBACK')
         #We do this rather than cnx.rollback to avoid opening a new transaction
         #If our connection gets recycled cnx.rollback will be called then.
-        self.cnx = None
+        if self.pooled is not None:
+            _DBpool.put(self.pooled)
 
 
 class CursorWrapper:
-    def __init__(self, cursor):
+    def __init__(self, cursor, statements=None):
         self.cursor = cursor
+        self.statements = statements
         self.logger = logging.getLogger('koji.db')
 
     def __getattr__(self, key):
@@ -92,7 +370,11 @@ class CursorWrapper:
         if debug:
             self.logger.debug(_quoteparams(operation,parameters))
             start = time.time()
-        ret = self.cursor.execute(operation, parameters)
+        if self.statements is not None and \
+                self.statements.execute(self.cursor, operation, parameters):
+            ret = None
+        else:
+            ret = self.cursor.execute(operation, parameters)
         if debug:
             self.logger.debug("Execute operation completed in %.4f seconds", time.time() - start)
         return ret
@@ -111,39 +393,28 @@ def setDBopts(**opts):
 def getDBopts():
     return _DBopts
 
+def setPoolOpts(**opts):
+    """Set connection pool options (see _PoolOpts)
+
+    This only has an effect before the first connection is made.
+    """
+    for key in opts:
+        if not _PoolOpts.has_key(key):
+            raise KeyError, 'unknown pool option: %s' % key
+    _PoolOpts.update(opts)
+
+def getPoolStats():
+    """Return connection pool and statement cache counters for this process"""
+    if _DBpool is None:
+        return {}
+    return _DBpool.getStats()
+
 def connect():
-    logger = logging.getLogger('koji.db')
-    global _DBconn
-    if hasattr(_DBconn, 'conn'):
-        # Make sure the previous transaction has been
-        # closed.  This is safe to call multiple times.
-        conn = _DBconn.conn
-        try:
-            # Under normal circumstances, the last use of this connection
-            # will have issued a raw ROLLBACK to close the transaction. To
-            # avoid 'no transaction in progress' warnings (depending on postgres
-            # configuration) we open a new one here.
-            # Should there somehow be a transaction in progress, a second
-            # BEGIN will be a harmless no-op, though there may be a warning.
-            conn.cursor().execute('BEGIN')
-            conn.rollback()
-            return DBWrapper(conn)
-        except pgdb.Error:
-            del _DBconn.conn
-    #create a fresh connection
-    opts = _DBopts
-    if opts is None:
-        opts = {}
-    try:
-        conn = pgdb.connect(**opts)
-    except Exception:
-        logger.error(''.join(traceback.format_exception(*sys.exc_info())))
-        raise
-    # XXX test
-    # return conn
-    _DBconn.conn = conn
-
-    return DBWrapper(conn)
+    global _DBpool
+    if _DBpool is None:
+        _DBpool = ConnectionPool(_PoolOpts.copy())
+    pooled = _DBpool.get()
+    return DBWrapper(pooled.cnx, pooled)
 
 if __name__ == "__main__":
     setDBopts( database = "test", user = "test")
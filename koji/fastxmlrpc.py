@@ -0,0 +1,175 @@
+# Faster XML-RPC marshalling for large responses
+# Copyright (c) 2010 Red Hat, Inc.
+#
+#    Koji is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation;
+#    version 2.1 of the License.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this software; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""A drop-in replacement for xmlrpclib.dumps
+
+Most large hub responses are lists of flat dicts (rpms, builds, buildroot
+listings) whose values are strings, ints, bools or None. The stock
+Marshaller makes several method calls and writes per value. FastMarshaller
+encodes those simple values inline, one write per struct member, and
+remembers the encoded member names, since the same keys repeat in every
+dict. Anything else is handed to the stock code, so the output is byte for
+byte the same as xmlrpclib.dumps.
+"""
+
+import xmlrpclib
+from xmlrpclib import escape, Fault, MAXINT, MININT
+
+
+def _nil(m, value):
+    if not m.allow_none:
+        raise TypeError, "cannot marshal None unless allow_none is enabled"
+    return "<value><nil/></value>"
+
+def _int(m, value):
+    if value > MAXINT or value < MININT:
+        raise OverflowError, "int exceeds XML-RPC limits"
+    return "<value><int>%s</int></value>\n" % value
+
+def _long(m, value):
+    if value > MAXINT or value < MININT:
+        raise OverflowError, "long int exceeds XML-RPC limits"
+    return "<value><int>%s</int></value>\n" % int(value)
+
+def _bool(m, value):
+    if value:
+        return "<value><boolean>1</boolean></value>\n"
+    return "<value><boolean>0</boolean></value>\n"
+
+def _double(m, value):
+    return "<value><double>%r</double></value>\n" % value
+
+def _string(m, value):
+    return "<value><string>%s</string></value>\n" % escape(value)
+
+def _unicode(m, value):
+    return "<value><string>%s</string></value>\n" % \
+                escape(value).encode(m.encoding, 'xmlcharrefreplace')
+
+# values that can be encoded without recursion
+SIMPLE = {
+    type(None): _nil,
+    int: _int,
+    long: _long,
+    bool: _bool,
+    float: _double,
+    str: _string,
+    unicode: _unicode,
+}
+
+
+class FastMarshaller(xmlrpclib.Marshaller):
+    """Marshaller with inline encoding of simple values in arrays and structs"""
+
+    dispatch = xmlrpclib.Marshaller.dispatch.copy()
+
+    def __init__(self, encoding=None, allow_none=0):
+        xmlrpclib.Marshaller.__init__(self, encoding, allow_none)
+        self.names = {}
+
+    def _dump(self, value, write):
+        """Dump a value the way the stock Marshaller does"""
+        self._Marshaller__dump(value, write)
+
+    def member_name(self, key):
+        """Return the start of a struct member for key"""
+        if type(key) is str:
+            key = escape(key)
+        elif type(key) is unicode:
+            key = escape(key).encode(self.encoding, 'xmlcharrefreplace')
+        else:
+            raise TypeError, "dictionary key must be string"
+        return "<member>\n<name>%s</name>\n" % key
+
+    def dump_array(self, value, write, simple=SIMPLE):
+        i = id(value)
+        if i in self.memo:
+            raise TypeError, "cannot marshal recursive sequences"
+        self.memo[i] = None
+        write("<value><array><data>\n")
+        for v in value:
+            f = simple.get(type(v))
+            if f is None:
+                self._dump(v, write)
+            else:
+                write(f(self, v))
+        write("</data></array></value>\n")
+        del self.memo[i]
+    dispatch[tuple] = dump_array
+    dispatch[list] = dump_array
+
+    def dump_struct(self, value, write, simple=SIMPLE):
+        i = id(value)
+        if i in self.memo:
+            raise TypeError, "cannot marshal recursive dictionaries"
+        self.memo[i] = None
+        names = self.names
+        write("<value><struct>\n")
+        for k, v in value.items():
+            if type(k) is str:
+                name = names.get(k)
+                if name is None:
+                    name = names[k] = self.member_name(k)
+            else:
+                name = self.member_name(k)
+            t = type(v)
+            # strings and ints are by far the most common, so skip the lookup
+            if t is str:
+                write("%s<value><string>%s</string></value>\n</member>\n" % (name, escape(v)))
+                continue
+            elif t is int and MININT <= v <= MAXINT:
+                write("%s<value><int>%i</int></value>\n</member>\n" % (name, v))
+                continue
+            f = simple.get(t)
+            if f is None:
+                write(name)
+                self._dump(v, write)
+                write("</member>\n")
+            else:
+                write(name + f(self, v) + "</member>\n")
+        write("</struct></value>\n")
+        del self.memo[i]
+    dispatch[dict] = dump_struct
+
+
+def dumps(params, methodname=None, methodresponse=None, encoding=None,
+          allow_none=0):
+    """Same as xmlrpclib.dumps, but using FastMarshaller"""
+
+    assert isinstance(params, tuple) or isinstance(params, Fault),\
+           "argument must be tuple or Fault instance"
+    if isinstance(params, Fault):
+        methodresponse = 1
+    elif methodresponse and isinstance(params, tuple):
+        assert len(params) == 1, "response tuple must be a singleton"
+    if not encoding:
+        encoding = "utf-8"
+    data = FastMarshaller(encoding, allow_none).dumps(params)
+    if encoding != "utf-8":
+        xmlheader = "<?xml version='1.0' encoding='%s'?>\n" % str(encoding)
+    else:
+        xmlheader = "<?xml version='1.0'?>\n"
+    if methodname:
+        if not isinstance(methodname, str):
+            methodname = methodname.encode(encoding, 'xmlcharrefreplace')
+        data = (xmlheader, "<methodCall>\n<methodName>", methodname,
+                "</methodName>\n", data, "</methodCall>\n")
+    elif methodresponse:
+        data = (xmlheader, "<methodResponse>\n", data, "</methodResponse>\n")
+    else:
+        return data
+    return ''.join(data)
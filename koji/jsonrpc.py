@@ -0,0 +1,138 @@
+# JSON encoding for hub calls
+# Copyright (c) 2010 Red Hat, Inc.
+#
+#    Koji is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation;
+#    version 2.1 of the License.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this software; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""A JSON alternative to the XML-RPC encoding of hub calls
+
+The hub accepts calls POSTed with a Content-Type of application/json and
+answers them in kind. Calls, responses and faults are encoded as
+
+    {"method": name, "params": [...]}
+    {"params": [result]}
+    {"fault": {"faultCode": code, "faultString": string}}
+
+so that dumps and loads can be used in place of their xmlrpclib
+counterparts. Strings are decoded the way xmlrpclib does it: plain str when
+they are ascii, unicode otherwise.
+
+JSON has no equivalent of xmlrpclib.Binary or DateTime, and cannot carry
+strings that are not valid utf-8. dumps raises TypeError or ValueError for
+those, and both ends then fall back to XML-RPC for that one call or
+response. The client always checks the Content-Type of a response, so
+either encoding can come back.
+"""
+
+import urllib
+import xmlrpclib
+from xmlrpclib import Fault
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+CONTENT_TYPE = 'application/json'
+
+
+def dumps(params, methodname=None, methodresponse=None, allow_none=1):
+    """Encode a call, response or Fault, like xmlrpclib.dumps"""
+    if isinstance(params, Fault):
+        data = {'fault': {'faultCode': params.faultCode,
+                          'faultString': params.faultString}}
+    elif methodname:
+        data = {'method': methodname, 'params': params}
+    else:
+        if methodresponse:
+            assert len(params) == 1, "response tuple must be a singleton"
+        data = {'params': params}
+    return json.dumps(data, separators=(',', ':'))
+
+
+def _stringify(value):
+    """Convert ascii unicode to str, throughout value"""
+    t = type(value)
+    if t is unicode:
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    elif t is list:
+        return [_stringify(v) for v in value]
+    elif t is dict:
+        ret = {}
+        for k, v in value.iteritems():
+            ret[_stringify(k)] = _stringify(v)
+        return ret
+    return value
+
+
+def loads(data):
+    """Decode a call or response, like xmlrpclib.loads
+
+    Returns (params, methodname), where methodname is None for responses.
+    Raises Fault if data holds a fault.
+    """
+    data = json.loads(data)
+    if not isinstance(data, dict):
+        raise ValueError, "invalid JSON call or response"
+    if data.has_key('fault'):
+        fault = data['fault']
+        raise Fault(fault['faultCode'], _stringify(fault['faultString']))
+    return tuple(_stringify(data['params'])), data.get('method')
+
+
+class ServerProxy(object):
+    """A stand-in for xmlrpclib.ServerProxy that sends calls as JSON
+
+    The transport must have a post method, as the persistent transports in
+    koji.ssl.XMLRPCServerProxy do.
+    """
+
+    def __init__(self, uri, transport, verbose=0):
+        scheme, uri = urllib.splittype(uri)
+        self.__host, self.__handler = urllib.splithost(uri)
+        if not self.__handler:
+            self.__handler = '/RPC2'
+        self.__transport = transport
+        self.__verbose = verbose
+
+    def __request(self, methodname, params):
+        try:
+            request = dumps(params, methodname)
+            content_type = CONTENT_TYPE
+        except (TypeError, ValueError):
+            request = xmlrpclib.dumps(params, methodname, allow_none=1)
+            content_type = 'text/xml'
+        transport = self.__transport
+        transport.verbose = self.__verbose
+        content_type, response = transport.post(self.__host, self.__handler,
+                                                request, content_type)
+        if content_type.split(';')[0].strip() == CONTENT_TYPE:
+            params, method = loads(response)
+        else:
+            p, u = transport.getparser()
+            p.feed(response)
+            p.close()
+            params = u.close()
+        if len(params) == 1:
+            params = params[0]
+        return params
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__request, name)
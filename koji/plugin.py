@@ -18,11 +18,16 @@
 # Authors:
 #       Mike McLean <mikem@redhat.com>
 
+import copy
 import imp
 import koji
 import logging
+import Queue
 import sys
+import threading
+import time
 import traceback
+from context import context
 
 # set this up for use by the plugins
 # we want log output to go to Apache's error_log
@@ -130,6 +135,14 @@ def export_in(module, alias=None):
         return f
     return dec
 
+def readonly(f):
+    """a decorator that marks an exported function as free of side effects
+
+    such functions may be run in parallel by a read-only multiCall
+    """
+    setattr(f, 'readonly', True)
+    return f
+
 def callback(*cbtypes):
     """A decorator that indicates a function is a callback.
     cbtypes is a list of callback types to register for.  Valid
@@ -158,9 +171,20 @@ def register_callback(cbtype, func):
     callbacks[cbtype].append(func)
 
 def run_callbacks(cbtype, *args, **kws):
+    """Run the callbacks registered for cbtype
+
+    If the AsyncCallbacks hub option is set, callbacks marked with
+    ignore_error are not run here. They are held until the current call
+    commits (see commit_callbacks) and then run by a background thread,
+    outside of the call and its context.
+    """
     if not cbtype in callbacks:
         raise koji.PluginError, '"%s" is not a valid callback type' % cbtype
+    defer = getattr(context, 'opts', {}).get('AsyncCallbacks', False)
     for func in callbacks[cbtype]:
+        if defer and getattr(func, 'failure_is_an_option', False):
+            _defer_callback(func, cbtype, args, kws)
+            continue
         try:
             func(cbtype, *args, **kws)
         except:
@@ -170,3 +194,118 @@ def run_callbacks(cbtype, *args, **kws):
                 logging.getLogger('koji.plugin').warn('%s: %s' % (msg, tb))
             else:
                 raise koji.CallbackError, msg
+
+def _defer_callback(func, cbtype, args, kws):
+    # the data may still be changed by the rest of the call
+    try:
+        args, kws = copy.deepcopy((args, kws))
+    except Exception:
+        pass
+    pending = getattr(context, 'pending_callbacks', None)
+    if pending is None:
+        pending = context.pending_callbacks = []
+    pending.append((func, cbtype, args, kws))
+
+def commit_callbacks():
+    """Queue the callbacks deferred by the current call
+
+    The hub calls this once the call has been committed."""
+    pending = getattr(context, 'pending_callbacks', None)
+    if not pending:
+        return
+    context.pending_callbacks = []
+    opts = getattr(context, 'opts', {})
+    callback_queue.start(opts.get('AsyncCallbackQueueSize', 1000))
+    timeout = opts.get('AsyncCallbackTimeout', 5)
+    for entry in pending:
+        callback_queue.put(entry, timeout)
+
+def discard_callbacks():
+    """Drop the callbacks deferred by the current call (e.g. on rollback)"""
+    context.pending_callbacks = []
+
+
+class CallbackQueue(object):
+    """A bounded queue of callbacks, run by a background thread
+
+    When the queue is full, put waits up to timeout seconds for room and
+    then drops the callback. The counters returned by stats show how far
+    the thread is keeping up.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counts = {'queued': 0, 'run': 0, 'failed': 0, 'dropped': 0,
+                       'max_depth': 0, 'wait_time': 0.0}
+        self.logger = logging.getLogger('koji.plugin')
+
+    def start(self, maxsize):
+        """Start the worker thread, if it is not running"""
+        if self.thread is not None and self.thread.isAlive():
+            return
+        self.lock.acquire()
+        try:
+            if self.queue is None:
+                self.queue = Queue.Queue(maxsize)
+            if self.thread is None or not self.thread.isAlive():
+                # (a forked child does not inherit the thread)
+                self.thread = threading.Thread(target=self._worker, name='koji-callbacks')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def put(self, entry, timeout):
+        start = time.time()
+        try:
+            self.queue.put(entry, True, timeout)
+        except Queue.Full:
+            self._count('wait_time', time.time() - start)
+            self._count('dropped')
+            func, cbtype = entry[:2]
+            self.logger.warn('Callback queue full, dropped %s callback from %s',
+                             cbtype, func.__module__)
+            return
+        self._count('wait_time', time.time() - start)
+        self._count('queued')
+        depth = self.queue.qsize()
+        if depth > self.counts['max_depth']:
+            self.counts['max_depth'] = depth
+
+    def _count(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counts[name] += value
+        finally:
+            self.lock.release()
+
+    def _worker(self):
+        while True:
+            func, cbtype, args, kws = self.queue.get()
+            try:
+                func(cbtype, *args, **kws)
+                self._count('run')
+            except:
+                self._count('failed')
+                tb = ''.join(traceback.format_exception(*sys.exc_info()))
+                self.logger.warn('Error running %s callback from %s: %s'
+                                 % (cbtype, func.__module__, tb))
+
+    def stats(self):
+        """Return the queue counters, along with the current depth and size"""
+        self.lock.acquire()
+        try:
+            ret = self.counts.copy()
+        finally:
+            self.lock.release()
+        if self.queue is None:
+            ret['depth'] = 0
+            ret['size'] = 0
+        else:
+            ret['depth'] = self.queue.qsize()
+            ret['size'] = self.queue.maxsize
+        return ret
+
+callback_queue = CallbackQueue()
@@ -24,6 +24,10 @@ class BaseSimpleTest(object):
     #Provide the name of the test
     name = None
 
+    #The data fields the result depends on. If set, results may be reused
+    #for data with the same values in these fields (see cached_run).
+    keys = None
+
     def __init__(self, str):
         """Read the test parameters from string"""
         self.str = str
@@ -32,6 +36,27 @@ class BaseSimpleTest(object):
         """Run the test against data provided"""
         raise NotImplementedError
 
+    def cached_run(self, data, cache):
+        """Run the test, reusing an earlier result from cache if possible
+
+        cache is a dict shared by all the tests run for a request. Results
+        are stored by test class, test string and the values of the data
+        fields named in keys, so tests without keys are always run.
+        """
+        if cache is None or self.keys is None:
+            return self.run(data)
+        values = tuple([(data.has_key(k), data.get(k)) for k in self.keys])
+        key = (self.__class__, self.str, values)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            #unhashable data
+            return self.run(data)
+        ret = cache[key] = self.run(data)
+        return ret
+
     def __str__(self):
         return self.str
 
@@ -174,6 +199,7 @@ class SimpleRuleSet(object):
     def __init__(self, rules, tests):
         self.tests = tests
         self.rules = self.parse_rules(rules)
+        self.program = self.compile_rules(self.ruleset)
         self.lastrule = None
         self.lastaction = None
 
@@ -287,36 +313,63 @@ class SimpleRuleSet(object):
         _recurse(self.ruleset, index)
         return index.keys()
 
-    def _apply(self, rules, data, top=False):
-        for tests, negate, action in rules:
-            if top:
-                self.lastrule = []
-            value = False
+    def compile_rules(self, rules):
+        """Flatten the ruleset into a list of steps
+
+        Each step is a tuple
+            (tests, negate, action, depth, skip)
+        with the rules in the order they appear. A nested ruleset is followed
+        directly by its subrules, and has an action of None. skip is the
+        index of the step to go to if the rule does not match, which is past
+        any subrules. If none of the subrules match, evaluation simply
+        carries on with the step after them, so apply never has to recurse.
+        """
+        steps = []
+        def _recurse(rules, depth):
+            for tests, negate, action in rules:
+                index = len(steps)
+                steps.append(None)
+                if isinstance(action, list):
+                    _recurse(action, depth + 1)
+                    action = None
+                steps[index] = (tuple(tests), negate, action, depth, len(steps))
+        _recurse(rules, 0)
+        return steps
+
+    def apply(self, data, cache=None):
+        """Return the action for data, or None if no rule matches
+
+        If cache is given, it is passed to the tests (see
+        BaseSimpleTest.cached_run).
+        """
+        steps = self.program
+        count = len(steps)
+        # the matching rules leading to the current step
+        path = []
+        action = None
+        i = 0
+        while i < count:
+            tests, negate, action, depth, skip = steps[i]
+            del path[depth:]
+            value = True
             for test in tests:
-                if not test.run(data):
+                if not test.cached_run(data, cache):
+                    value = False
                     break
-            else:
-                #all tests in current rule passed
-                value = True
             if negate:
                 value = not value
-            if value:
-                self.lastrule.append([tests, negate])
-                if isinstance(action, list):
-                    # action is a list of subrules
-                    ret = self._apply(action, data)
-                    if ret is not None:
-                        return ret
-                    # if ret is None, then none of the subrules matched,
-                    # so we keep going
-                else:
-                    return action
-        return None
-
-    def apply(self, data):
-        self.lastrule = []
-        self.lastaction = self._apply(self.ruleset, data, top=True)
-        return self.lastaction
+            if not value:
+                action = None
+                i = skip
+                continue
+            path.append([tests, negate])
+            if action is not None:
+                break
+            # a nested ruleset, go on to its subrules
+            i += 1
+        self.lastrule = path
+        self.lastaction = action
+        return action
 
     def last_rule(self):
         if self.lastrule is None:
@@ -0,0 +1,214 @@
+# Local cache of the repodata of external repos
+# Copyright (c) 2010 Red Hat, Inc.
+#
+#    Koji is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation;
+#    version 2.1 of the License.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this software; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Local cache of the repodata of external repos
+
+The metadata files of a repo are stored under the checksum that its
+repomd.xml gives for them, so a file is only downloaded when it changes and
+is shared by every url (tag, arch) that serves the same content. The last
+repomd.xml of each url is kept too, and is only fetched again when the
+server says it has changed (If-Modified-Since/If-None-Match).
+
+Layout of the cache directory:
+
+    objects/<xx>/<checksum>     metadata files
+    repos/<sha1 of url>         last repomd.xml of a url, with its http validators
+
+Files are written to a temporary name and renamed into place, so the cache
+can be shared by concurrent tasks and by builders mounting the same volume.
+Nothing is updated in place, so old entries can be removed by age (e.g.
+with tmpwatch).
+"""
+
+import cPickle
+import os
+import re
+import tempfile
+import urllib2
+import xml.dom.minidom
+import koji
+from koji.util import sha1_constructor
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+    import md5
+
+HEX_RE = re.compile(r'^[0-9a-fA-F]+$')
+
+
+def new_checksum(sumtype):
+    """Return a hash object for a repomd checksum type, or None if unsupported"""
+    if sumtype == 'sha':
+        sumtype = 'sha1'
+    if hashlib is None:
+        if sumtype == 'sha1':
+            return sha1_constructor()
+        elif sumtype == 'md5':
+            return md5.new()
+        return None
+    try:
+        return hashlib.new(sumtype)
+    except ValueError:
+        return None
+
+
+class RepodataCache(object):
+    """A directory of cached repodata files, see the module docstring"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def _write(self, path, data):
+        """Write data to path, atomically"""
+        dirname = os.path.dirname(path)
+        koji.ensuredir(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            fo = os.fdopen(fd, 'wb')
+            try:
+                fo.write(data)
+            finally:
+                fo.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _repo_state(self, url):
+        path = os.path.join(self.path, 'repos', sha1_constructor(url).hexdigest())
+        try:
+            fo = file(path, 'rb')
+        except IOError:
+            return path, None
+        try:
+            try:
+                return path, cPickle.load(fo)
+            finally:
+                fo.close()
+        except (EOFError, cPickle.UnpicklingError, ValueError, TypeError):
+            return path, None
+
+    def get_repomd(self, url):
+        """Return the repomd.xml of a repo, and whether it came from the cache"""
+        statepath, state = self._repo_state(url)
+        request = urllib2.Request(url + 'repodata/repomd.xml')
+        if state:
+            if state.get('last_modified'):
+                request.add_header('If-Modified-Since', state['last_modified'])
+            if state.get('etag'):
+                request.add_header('If-None-Match', state['etag'])
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and state:
+                return state['repomd'], True
+            raise
+        try:
+            repomd = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        state = {'repomd': repomd,
+                 'last_modified': headers.getheader('Last-Modified'),
+                 'etag': headers.getheader('ETag')}
+        self._write(statepath, cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+        return repomd, False
+
+    def _download(self, url, dest, sumtype, checksum):
+        """Download url to dest, checking its checksum if we can"""
+        csum = new_checksum(sumtype)
+        dirname = os.path.dirname(dest)
+        koji.ensuredir(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            fo = os.fdopen(fd, 'wb')
+            src = urllib2.urlopen(url)
+            try:
+                while True:
+                    chunk = src.read(65536)
+                    if not chunk:
+                        break
+                    if csum is not None:
+                        csum.update(chunk)
+                    fo.write(chunk)
+            finally:
+                src.close()
+                fo.close()
+            if csum is not None and csum.hexdigest() != checksum:
+                raise koji.GenericError, "Checksum mismatch for %s: expected %s, got %s" \
+                      % (url, checksum, csum.hexdigest())
+            os.chmod(tmp, 0644)
+            os.rename(tmp, dest)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def mirror(self, url, destdir, types=None):
+        """Make a local copy of the repodata of a repo
+
+        The repodata files are linked from the cache into destdir, along with
+        the repomd.xml of the repo. Only the metadata types listed in types
+        are copied (all of them if types is None).
+
+        Returns (hits, total), the number of files found in the cache and
+        the number of files copied.
+        """
+        if not url.endswith('/'):
+            url += '/'
+        repomd = self.get_repomd(url)[0]
+        hits = 0
+        total = 0
+        doc = xml.dom.minidom.parseString(repomd)
+        try:
+            for data in doc.getElementsByTagName('data'):
+                if types is not None and data.getAttribute('type') not in types:
+                    continue
+                href = data.getElementsByTagName('location')[0].getAttribute('href')
+                checksum = data.getElementsByTagName('checksum')[0]
+                sumtype = checksum.getAttribute('type')
+                value = ''.join([n.data for n in checksum.childNodes]).strip()
+                dest = os.path.normpath(os.path.join(destdir, href))
+                if not dest.startswith(os.path.normpath(destdir) + '/'):
+                    raise koji.GenericError, "Invalid location in %srepodata/repomd.xml: %s" \
+                          % (url, href)
+                koji.ensuredir(os.path.dirname(dest))
+                total += 1
+                if new_checksum(sumtype) is None or not HEX_RE.match(value):
+                    # we cannot verify it, so do not cache it
+                    self._download(url + href, dest, sumtype, value)
+                    continue
+                objpath = os.path.join(self.path, 'objects', value[:2], value)
+                if os.path.exists(objpath):
+                    hits += 1
+                else:
+                    self._download(url + href, objpath, sumtype, value)
+                os.symlink(objpath, dest)
+        finally:
+            doc.unlink()
+        fo = file(os.path.join(destdir, 'repodata', 'repomd.xml'), 'w')
+        fo.write(repomd)
+        fo.close()
+        self.hits += hits
+        self.misses += total - hits
+        return hits, total
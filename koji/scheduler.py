@@ -0,0 +1,129 @@
+# Task scheduling model shared by the hub and the build daemons
+# Copyright (c) 2010 Red Hat, Inc.
+#
+#    Koji is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation;
+#    version 2.1 of the License.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this software; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Load balancing model for task assignment
+
+Hosts are sorted into channel:arch bins. A free task can go to any host in
+its bin, and a host should only take a task if its available capacity is in
+the upper half of the hosts in that bin.
+
+TaskManager.getNextTask applies this model from the point of view of a
+single builder. assign_tasks applies it to the whole fleet at once, for
+hub-side scheduling.
+"""
+
+import koji
+
+
+def task_bin(task):
+    """Return the bin name for a task"""
+    return "%(channel_id)s:%(arch)s" % task
+
+def host_bins(host):
+    """Return the bin names a host belongs to"""
+    bins = []
+    for chan in host['channels']:
+        for arch in host['arches'].split() + ['noarch']:
+            bins.append("%s:%s" % (chan, arch))
+    return bins
+
+def index_bins(hosts):
+    """Return a map of bin name to the hosts in that bin"""
+    bin_hosts = {}
+    for host in hosts:
+        for bin in host_bins(host):
+            bin_hosts.setdefault(bin, []).append(host)
+    return bin_hosts
+
+def host_avail(host):
+    """Return the available capacity of a host"""
+    return host['capacity'] - host['task_load']
+
+def bin_avail(hosts):
+    """Return the available capacities of hosts, largest first"""
+    avail = [host_avail(host) for host in hosts]
+    avail.sort()
+    avail.reverse()
+    return avail
+
+def check_rel_avail(bin_avail, avail):
+    """Should a host with avail capacity take a task from a bin?
+
+    bin_avail is the sorted list of capacities from bin_avail(). We accept
+    if we are at or above the median, giving the upper half a chance first.
+    """
+    median = bin_avail[(len(bin_avail)-1)/2]
+    return avail >= median
+
+
+def assign_tasks(hosts, tasks, max_per_host=1, last_assigned=None, skip_channels=()):
+    """Assign a batch of tasks to hosts
+
+    hosts: ready hosts, as returned by the hub's get_ready_hosts
+    tasks: free and assigned tasks in priority order, with id, state,
+           channel_id, arch, host_id and weight fields
+    max_per_host: the most new tasks a host may get in one batch
+    last_assigned: optional map of host id to a sequence number recording
+                   when that host last received a task, used to break ties.
+                   It is updated in place, so pass the same map each batch.
+    skip_channels: channel ids that are left for the builders to handle
+
+    Returns a list of (task_id, host_id) pairs.
+
+    Each free task goes to the host with the most available capacity in its
+    bin, which is always in the upper half that check_rel_avail requires.
+    The projected load of that host is raised by the task weight, so the
+    rest of the batch sees the change. Hosts stop receiving tasks once they
+    reach capacity or max_per_host.
+    """
+    if last_assigned is None:
+        last_assigned = {}
+    load = {}
+    for host in hosts:
+        load[host['id']] = host['task_load']
+    # tasks that are already assigned count against their host
+    for task in tasks:
+        if task['state'] == koji.TASK_STATES['ASSIGNED'] and load.has_key(task['host_id']):
+            load[task['host_id']] += task.get('weight') or 1.0
+    bin_hosts = index_bins(hosts)
+    counts = {}
+    seq = max([0] + last_assigned.values())
+    ret = []
+    for task in tasks:
+        if task['state'] != koji.TASK_STATES['FREE']:
+            continue
+        if task['channel_id'] in skip_channels:
+            continue
+        best = None
+        for host in bin_hosts.get(task_bin(task), []):
+            host_id = host['id']
+            avail = host['capacity'] - load[host_id]
+            if avail <= 0 or counts.get(host_id, 0) >= max_per_host:
+                continue
+            # most capacity first, then least recently assigned
+            key = (-avail, last_assigned.get(host_id, 0), host_id)
+            if best is None or key < best[0]:
+                best = (key, host_id)
+        if best is None:
+            continue
+        host_id = best[1]
+        load[host_id] += task.get('weight') or 1.0
+        counts[host_id] = counts.get(host_id, 0) + 1
+        seq += 1
+        last_assigned[host_id] = seq
+        ret.append((task['id'], host_id))
+    return ret
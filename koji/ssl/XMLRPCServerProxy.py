@@ -17,8 +17,13 @@
 
 import os, sys
 import SSLCommon
+import errno
+import gzip
+import httplib
+import socket
 import urllib
 import xmlrpclib
+from cStringIO import StringIO
 
 __version__='0.12'
 
@@ -72,6 +77,132 @@ class Plg_ClosableTransport(xmlrpclib.Transport):
             self._http = None
 
 
+class Plg_PersistentTransport(xmlrpclib.Transport):
+    """Keep one HTTP/1.1 connection open across calls
+
+    The same transport can be passed to several ServerProxy instances (e.g.
+    for urls that only differ in the query string), as long as they are
+    used from a single thread. If a reused connection turns out to have
+    been closed by the server before the request could be sent, the request
+    is sent again on a new one. Other failures (timeouts in particular) are
+    not retried, as the server may already be running the call.
+    """
+
+    def __init__(self, timeout=None, use_datetime=0):
+        if sys.version_info[:3] >= (2, 5, 0):
+            xmlrpclib.Transport.__init__(self, use_datetime)
+        self._timeout = timeout
+        self._cnx = None
+        self._cnx_host = None
+
+    def _new_connection(self, host):
+        if self._timeout is not None and sys.version_info[:2] >= (2, 6):
+            return httplib.HTTPConnection(host, timeout=self._timeout)
+        return httplib.HTTPConnection(host)
+
+    def _get_connection(self, host):
+        """Return (connection, reused)"""
+        if self._cnx is not None and self._cnx_host == host:
+            return self._cnx, True
+        self.close()
+        self._cnx = self._new_connection(host)
+        self._cnx_host = host
+        return self._cnx, False
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.verbose = verbose
+        content_type, body = self.post(host, handler, request_body, 'text/xml')
+        p, u = self.getparser()
+        p.feed(body)
+        p.close()
+        return u.close()
+
+    def post(self, host, handler, request_body, content_type):
+        """Send a POST request and return (content type, body) of the response
+
+        The response body is decompressed if the server gzipped it.
+        """
+        verbose = getattr(self, 'verbose', 0)
+        chost, extra_headers, x509 = self.get_host_info(host)
+        headers = {'Content-Type': content_type,
+                   'Accept-Encoding': 'gzip',
+                   'User-Agent': self.user_agent,
+                   'Connection': 'keep-alive'}
+        if extra_headers:
+            headers.update(dict(extra_headers))
+        while True:
+            cnx, reused = self._get_connection(chost)
+            cnx.set_debuglevel(verbose)
+            # a server may close an idle connection at any time, so a reused
+            # connection gets one more try if it was found closed
+            retry = False
+            try:
+                try:
+                    cnx.request('POST', handler, request_body, headers)
+                except httplib.CannotSendRequest:
+                    retry = reused
+                    raise
+                except socket.error, e:
+                    retry = reused and not isinstance(e, socket.timeout) \
+                            and e.args[:1] in ((errno.ECONNRESET,), (errno.EPIPE,))
+                    raise
+                try:
+                    response = cnx.getresponse()
+                except httplib.BadStatusLine:
+                    # closed without a reply, which is how a connection the
+                    # server had already closed shows up if sending worked
+                    retry = reused
+                    raise
+            except:
+                self.close()
+                if retry:
+                    continue
+                raise
+            break
+        try:
+            body = response.read()
+        except:
+            self.close()
+            raise
+        if response.status != 200:
+            self.close()
+            raise xmlrpclib.ProtocolError(chost + handler, response.status,
+                                          response.reason, response.msg)
+        if response.will_close:
+            self.close()
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return response.getheader('Content-Type', 'text/xml'), body
+
+    def close(self):
+        if self._cnx is not None:
+            self._cnx.close()
+            self._cnx = None
+            self._cnx_host = None
+
+
+class Plg_PersistentSafeTransport(Plg_PersistentTransport):
+    """Persistent https transport, without client certificates"""
+
+    def _new_connection(self, host):
+        if self._timeout is not None and sys.version_info[:2] >= (2, 6):
+            return httplib.HTTPSConnection(host, timeout=self._timeout)
+        return httplib.HTTPSConnection(host)
+
+
+class PlgSSL_PersistentTransport(Plg_PersistentTransport):
+    """Persistent https transport, using client certificates"""
+
+    def __init__(self, ssl_context, timeout=None, use_datetime=0):
+        Plg_PersistentTransport.__init__(self, timeout, use_datetime)
+        self.ssl_ctx = ssl_context
+
+    def _new_connection(self, host):
+        _host, _port = urllib.splitport(host)
+        return SSLCommon.PlgHTTPSConnection(_host, (_port and int(_port) or 443),
+                                            ssl_context=self.ssl_ctx, timeout=self._timeout)
+
+
 class PlgXMLRPCServerProxy(xmlrpclib.ServerProxy):
     def __init__(self, uri, certs, timeout=None, verbose=0, allow_none=0):
         if certs and len(certs) > 0:
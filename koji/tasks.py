@@ -192,7 +192,9 @@ class BaseTaskHandler(object):
             The build daemon forks all tasks as separate processes. This function
             uses signal.pause to sleep. The main process watches subtasks in
             the database and will send the subprocess corresponding to the
-            subtask a SIGUSR2 to wake it up when subtasks complete.
+            subtask a SIGUSR2 to wake it up when subtasks complete. With the
+            task_events option, the hub notifies the main process as soon as
+            that happens (see TaskManager.waitForEvents).
         """
         if isinstance(subtasks,int):
             # allow single integer w/o enclosing list
@@ -5,6 +5,7 @@
 #     Mike Bonnet <mikeb@redhat.com>
 
 from koji.plugin import callbacks, callback, ignore_error
+import koji
 import ConfigParser
 import logging
 import qpid.messaging
@@ -15,12 +16,17 @@ CONFIG_FILE = '/etc/koji-hub/plugins/messagebus.conf'
 config = None
 session = None
 target = None
+sender = None
 
 def get_sender():
-    global config, session, target
+    global config, session, target, sender
+    if sender:
+        # reuse the sender, rather than setting up a new link for each message
+        return sender
     if session and target:
         try:
-            return session.sender(target)
+            sender = session.sender(target)
+            return sender
         except:
             logging.getLogger('koji.plugin.messagebus').warning('Error getting session, will retry', exc_info=True)
             session = None
@@ -57,6 +63,15 @@ def get_sender():
 
     return sender
 
+def drop_sender():
+    global sender
+    if sender:
+        try:
+            sender.close()
+        except:
+            pass
+    sender = None
+
 def _token_append(tokenlist, val):
     # Replace any periods with underscores so we have a deterministic number of tokens
     val = val.replace('.', '_')
@@ -129,6 +144,10 @@ def get_message_headers(msgtype, *args, **kws):
 @callback(*[c for c in callbacks.keys() if c.startswith('post')])
 @ignore_error
 def send_message(cbtype, *args, **kws):
+    """Send an event message
+
+    This can be run in the background by setting AsyncCallbacks in the hub
+    config, so that a slow broker does not hold up the call."""
     global config
     sender = get_sender()
     if cbtype.startswith('post'):
@@ -150,5 +169,9 @@ def send_message(cbtype, *args, **kws):
     else:
         raise koji.PluginError, 'unsupported exchange type: %s' % exchange_type
 
-    sender.send(message)
-    sender.close()
+    try:
+        sender.send(message)
+    except:
+        # set up a new sender next time
+        drop_sender()
+        raise
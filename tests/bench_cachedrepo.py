@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+"""Measure repo creation with createrepo and with the metadata cache
+
+Creates the repodata for a package list (such as the pkglist of a repo of a
+large tag, e.g. /mnt/koji/repos/<tag>/<id>/<arch>/pkglist) three times:
+
+  - with 'createrepo -d', as kojid does without an old repo
+  - with cachedrepo and an empty cache
+  - with cachedrepo again, now that every package is in the cache
+
+and checks that the primary, filelists and other xml of the three repos are
+the same.
+
+Usage: bench_cachedrepo.py [--limit N] [--cachedrepo PATH] pkgdir pkglist
+"""
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CACHEDREPO = os.path.join(TOPDIR, 'builder/cachedrepo')
+
+
+def run(cmd):
+    """Run a command, returning the seconds it took"""
+    start = time.time()
+    status = os.spawnvp(os.P_WAIT, cmd[0], cmd)
+    elapsed = time.time() - start
+    if status:
+        print "command failed: %s" % ' '.join(cmd)
+        sys.exit(1)
+    return elapsed
+
+
+def read_md(outdir, mdtype):
+    """Return the uncompressed xml of one of the metadata files"""
+    datadir = os.path.join(outdir, 'repodata')
+    for fn in os.listdir(datadir):
+        if fn.endswith('%s.xml.gz' % mdtype):
+            fo = gzip.open(os.path.join(datadir, fn))
+            try:
+                return fo.read()
+            finally:
+                fo.close()
+    return None
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] pkgdir pkglist")
+    parser.add_option("--limit", type="int", help="only use the first N packages")
+    parser.add_option("--cachedrepo", default=CACHEDREPO, help="path to the cachedrepo script")
+    parser.add_option("--baseurl", default="http://example.com/packages", help="package base url")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("pkgdir and pkglist required")
+    pkgdir, pkglist = args
+    # let cachedrepo find the koji library of this tree
+    os.environ['PYTHONPATH'] = os.pathsep.join([TOPDIR] + filter(None, [os.environ.get('PYTHONPATH')]))
+    workdir = tempfile.mkdtemp()
+    try:
+        if options.limit:
+            lines = file(pkglist).readlines()[:options.limit]
+            pkglist = os.path.join(workdir, 'pkglist')
+            fo = file(pkglist, 'w')
+            fo.writelines(lines)
+            fo.close()
+        count = len([l for l in file(pkglist).readlines() if l.strip()])
+        cachedir = os.path.join(workdir, 'cache')
+        results = []
+        for label, name, cmd in (
+                ('createrepo', 'full', ['createrepo', '-qd', '-i', pkglist]),
+                ('cachedrepo (cold)', 'cold', [options.cachedrepo, '-q', '-c', cachedir, '-i', pkglist]),
+                ('cachedrepo (warm)', 'warm', [options.cachedrepo, '-q', '-c', cachedir, '-i', pkglist])):
+            outdir = os.path.join(workdir, name)
+            os.mkdir(outdir)
+            cmd = cmd + ['-o', outdir, '-u', options.baseurl, pkgdir]
+            results.append((label, outdir, run(cmd)))
+        print "%i packages" % count
+        print "%-20s %10s %12s" % ('run', 'seconds', 'packages/sec')
+        for label, outdir, elapsed in results:
+            print "%-20s %10.1f %12.1f" % (label, elapsed, count / max(elapsed, 0.001))
+        for mdtype in ('primary', 'filelists', 'other'):
+            data = [read_md(outdir, mdtype) for label, outdir, elapsed in results]
+            if data[1:] != data[:-1]:
+                print "%s metadata differs!" % mdtype
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+"""Measure the cost of host.getLoadData against the number of hosts
+
+Needs a scratch PostgreSQL database with the koji schema loaded. Set
+KOJI_TEST_DB to its name (and KOJI_TEST_DBUSER or KOJI_TEST_DBHOST if needed).
+Fake hosts are created for each run and everything is rolled back afterwards.
+
+For each host count this reports the time per call for the old per-host
+channel query, for get_ready_hosts with the channel cache disabled
+(HostChannelCacheTTL = 0) and with the cache warm.
+
+Usage: bench_load_data.py [--calls N] [host counts...]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hub'))
+
+import koji
+import koji.db
+from koji.context import context
+
+
+def create_hosts(cursor, count, channels=4):
+    """Insert count ready hosts with active sessions"""
+    cursor.execute("SELECT id FROM channels")
+    chan_ids = [row[0] for row in cursor.fetchall()]
+    for i in range(len(chan_ids), channels):
+        cursor.execute("INSERT INTO channels (name) VALUES (%(name)s) RETURNING id",
+                       {'name': 'bench-channel-%i' % i})
+        chan_ids.append(cursor.fetchone()[0])
+    for i in range(count):
+        name = 'bench-host-%i' % i
+        cursor.execute("INSERT INTO users (name, status, usertype) VALUES (%(name)s, 0, %(type)i) "
+                       "RETURNING id", {'name': name, 'type': koji.USERTYPES['HOST']})
+        user_id = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO host (user_id, name, arches, ready) "
+                       "VALUES (%(user_id)i, %(name)s, 'i386 x86_64', TRUE) RETURNING id",
+                       {'user_id': user_id, 'name': name})
+        host_id = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO sessions (user_id, key, authtype, callnum) "
+                       "VALUES (%(user_id)i, 'bench', 0, 0)", {'user_id': user_id})
+        for chan_id in chan_ids[:1 + i % len(chan_ids)]:
+            cursor.execute("INSERT INTO host_channels (host_id, channel_id) "
+                           "VALUES (%(host_id)i, %(chan_id)i)",
+                           {'host_id': host_id, 'chan_id': chan_id})
+
+
+def per_host_channels(hub):
+    """get_ready_hosts as it was, with one channel query per host"""
+    context.opts['HostChannelCacheTTL'] = 0
+    hosts = hub.get_ready_hosts()
+    c = context.cnx.cursor()
+    for host in hosts:
+        q = """SELECT channel_id FROM host_channels WHERE host_id=%(id)s"""
+        c.execute(q, host)
+        host['channels'] = [row[0] for row in c.fetchall()]
+    return hosts
+
+
+def uncached(hub):
+    context.opts['HostChannelCacheTTL'] = 0
+    return hub.get_ready_hosts()
+
+
+def cached(hub):
+    context.opts['HostChannelCacheTTL'] = 3600
+    return hub.get_ready_hosts()
+
+
+def timeit(func, hub, calls):
+    func(hub)
+    start = time.time()
+    for i in range(calls):
+        func(hub)
+        hub.get_active_tasks()
+    return (time.time() - start) / calls * 1000
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [host counts...]")
+    parser.add_option("--calls", type="int", default=50, help="calls per measurement")
+    options, args = parser.parse_args()
+    counts = [int(x) for x in args] or [10, 50, 150, 500]
+    dbname = os.environ.get('KOJI_TEST_DB')
+    if not dbname:
+        parser.error("KOJI_TEST_DB is not set")
+    import kojihub
+    koji.db.setDBopts(database=dbname,
+                      user=os.environ.get('KOJI_TEST_DBUSER'),
+                      host=os.environ.get('KOJI_TEST_DBHOST'))
+    context.cnx = koji.db.connect()
+    context.opts = {}
+    print "%6s %12s %12s %12s" % ('hosts', 'per host', 'uncached', 'cached')
+    for count in counts:
+        cursor = context.cnx.cursor()
+        create_hosts(cursor, count)
+        kojihub.host_channel_cache.invalidate()
+        results = [timeit(func, kojihub, options.calls)
+                   for func in (per_host_channels, uncached, cached)]
+        print "%6i %10.2fms %10.2fms %10.2fms" % tuple([count] + results)
+        context.cnx.rollback()
+
+
+if __name__ == '__main__':
+    main()
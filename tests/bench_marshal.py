@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+"""Compare xmlrpclib.dumps and koji.fastxmlrpc.dumps on large responses
+
+By default this uses generated responses shaped like the results of
+listTaggedRPMS, listBuilds and getBuildrootListing. Recorded responses can
+be used instead by passing files holding the xml of a methodResponse
+(e.g. saved from a hub with curl).
+
+Usage: bench_marshal.py [--rows N] [--repeat N] [response.xml ...]
+"""
+
+import gc
+import os
+import random
+import sys
+import time
+import xmlrpclib
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji.fastxmlrpc
+
+
+def _build(rnd, i):
+    name = 'package%i' % rnd.randint(1, 5000)
+    version = '%i.%i' % (rnd.randint(0, 9), rnd.randint(0, 20))
+    release = '%i.fc13' % rnd.randint(1, 30)
+    return {'build_id': i,
+            'id': i,
+            'package_id': rnd.randint(1, 5000),
+            'package_name': name,
+            'name': name,
+            'version': version,
+            'release': release,
+            'epoch': rnd.choice([None, None, None, 1]),
+            'nvr': '%s-%s-%s' % (name, version, release),
+            'state': 1,
+            'task_id': rnd.randint(1, 10 ** 6),
+            'owner_id': rnd.randint(1, 300),
+            'owner_name': 'user%i' % rnd.randint(1, 300),
+            'creation_event_id': rnd.randint(1, 10 ** 6),
+            'creation_time': '2010-06-%02i 12:%02i:%02i.123456' % (rnd.randint(1, 30),
+                                                                    rnd.randint(0, 59),
+                                                                    rnd.randint(0, 59)),
+            'completion_time': '2010-06-%02i 13:00:00' % rnd.randint(1, 30),
+            'volume_id': 0,
+            'volume_name': 'DEFAULT',
+            'tag_id': 1,
+            'tag_name': 'dist-f13 & <updates>'}
+
+
+def _rpm(rnd, i, build):
+    arch = rnd.choice(['i686', 'x86_64', 'noarch', 'src'])
+    return {'id': i,
+            'name': build['name'] + rnd.choice(['', '-devel', '-libs']),
+            'version': build['version'],
+            'release': build['release'],
+            'epoch': build['epoch'],
+            'arch': arch,
+            'build_id': build['id'],
+            'buildroot_id': rnd.randint(1, 10 ** 6),
+            'external_repo_id': 0,
+            'external_repo_name': 'INTERNAL',
+            'payloadhash': '%032x' % rnd.getrandbits(128),
+            'size': rnd.randint(1000, 10 ** 8),
+            'buildtime': rnd.randint(10 ** 9, 2 * 10 ** 9),
+            'is_update': rnd.choice([True, False])}
+
+
+def list_tagged_rpms(rows, seed=0):
+    """Shaped like the result of listTaggedRPMS"""
+    rnd = random.Random(seed)
+    builds = [_build(rnd, i) for i in xrange(1, rows / 4 + 2)]
+    rpms = [_rpm(rnd, i, rnd.choice(builds)) for i in xrange(1, rows + 1)]
+    return [rpms, builds]
+
+
+def list_builds(rows, seed=0):
+    """Shaped like the result of listBuilds"""
+    rnd = random.Random(seed)
+    return [_build(rnd, i) for i in xrange(1, rows + 1)]
+
+
+def buildroot_listing(rows, seed=0):
+    """Shaped like the result of getBuildrootListing"""
+    rnd = random.Random(seed)
+    builds = [_build(rnd, i) for i in xrange(1, rows / 4 + 2)]
+    ret = []
+    for i in xrange(1, rows + 1):
+        rpm = _rpm(rnd, i, rnd.choice(builds))
+        rpm['rpm_id'] = rpm['id']
+        rpm['is_update'] = rnd.choice([True, False])
+        ret.append(rpm)
+    return ret
+
+
+SHAPES = [('listTaggedRPMS', list_tagged_rpms),
+          ('listBuilds', list_builds),
+          ('getBuildrootListing', buildroot_listing)]
+
+
+def timeit(func, value, repeat):
+    best = None
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.time()
+            func((value,), methodresponse=1, allow_none=1)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        gc.enable()
+    return best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [response.xml ...]")
+    parser.add_option("--rows", type="int", default=20000, help="rows per generated response")
+    parser.add_option("--repeat", type="int", default=3, help="runs per measurement (best is kept)")
+    options, args = parser.parse_args()
+    if args:
+        responses = []
+        for fn in args:
+            params, method = xmlrpclib.loads(file(fn).read())
+            responses.append((os.path.basename(fn), params[0]))
+    else:
+        responses = [(name, func(options.rows)) for name, func in SHAPES]
+    print "%-22s %10s %10s %10s %8s" % ('response', 'bytes', 'xmlrpclib', 'fast', 'speedup')
+    for name, value in responses:
+        stock = xmlrpclib.dumps((value,), methodresponse=1, allow_none=1)
+        fast = koji.fastxmlrpc.dumps((value,), methodresponse=1, allow_none=1)
+        if stock != fast:
+            print "%s: output differs!" % name
+            sys.exit(1)
+        t_stock = timeit(xmlrpclib.dumps, value, options.repeat)
+        t_fast = timeit(koji.fastxmlrpc.dumps, value, options.repeat)
+        print "%-22s %10i %9.3fs %9.3fs %7.1fx" % (name, len(stock), t_stock, t_fast,
+                                                   t_stock / t_fast)
+
+
+if __name__ == '__main__':
+    main()
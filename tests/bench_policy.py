@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+"""Replay recorded policy checks and report evaluations per second
+
+The hub logs the data each policy is checked with when the
+koji.policy.input logger is set to DEBUG (e.g. LogLevel =
+WARNING koji.policy.input:DEBUG). Pass those log files (or files with one
+JSON [policy, data] pair per line) to replay the checks against the
+policies in a hub config file.
+
+Most policy tests query the database. Set KOJI_TEST_DB to its name (and
+KOJI_TEST_DBUSER or KOJI_TEST_DBHOST if needed) to replay against a copy
+of the hub database. Checks run as an anonymous user unless the recorded
+data has a user_id, and nothing is written.
+
+The checks are run without the policy test cache, with a fresh cache for
+each check, and with a cache shared by each run of --group checks (as in a
+call such as moveAllBuilds that checks many builds).
+
+Usage: bench_policy.py [--config hub.conf] [--repeat N] [--group N] input...
+"""
+
+import os
+import sys
+import time
+import ConfigParser
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hub'))
+
+import koji
+import koji.auth
+import koji.db
+import koji.jsonrpc
+from koji.context import context
+
+
+def _str(value):
+    """Convert ascii unicode to str, as the hub would have it"""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    elif isinstance(value, list):
+        return [_str(v) for v in value]
+    elif isinstance(value, dict):
+        return dict([(_str(k), _str(v)) for k, v in value.iteritems()])
+    return value
+
+
+def read_inputs(filenames):
+    marker = 'policy-input: '
+    ret = []
+    for fn in filenames:
+        for line in file(fn):
+            pos = line.find(marker)
+            if pos != -1:
+                line = line[pos + len(marker):]
+            elif not line.startswith('['):
+                continue
+            name, data = _str(koji.jsonrpc.json.loads(line))
+            ret.append((name, data))
+    return ret
+
+
+def replay(kojihub, inputs, cache, group):
+    """Check all the inputs, returning the results"""
+    context.opts['PolicyTestCache'] = cache
+    results = []
+    for i, (name, data) in enumerate(inputs):
+        if not group or i % group == 0:
+            # a new call
+            context.policy_cache = None
+        try:
+            results.append(kojihub.check_policy(name, data.copy()))
+        except koji.GenericError, e:
+            results.append(str(e))
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] input...")
+    parser.add_option("--config", help="hub config file with the policies")
+    parser.add_option("--repeat", type="int", default=3, help="runs per measurement (best is kept)")
+    parser.add_option("--group", type="int", default=20,
+                      help="checks sharing a cache in the last measurement")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no input files given")
+    if koji.jsonrpc.json is None:
+        parser.error("no json module available")
+    import kojihub
+    import kojixmlrpc
+    opts = {'policy': {}, 'Plugins': ''}
+    if options.config:
+        config = ConfigParser.RawConfigParser()
+        config.read(options.config)
+        if config.has_section('policy'):
+            opts['policy'] = dict(config.items('policy'))
+    for pname, text in kojixmlrpc._default_policies.iteritems():
+        opts['policy'].setdefault(pname, text)
+    inputs = read_inputs(args)
+    if not inputs:
+        parser.error("no recorded policy checks found")
+    dbname = os.environ.get('KOJI_TEST_DB')
+    if dbname:
+        koji.db.setDBopts(database=dbname,
+                          user=os.environ.get('KOJI_TEST_DBUSER'),
+                          host=os.environ.get('KOJI_TEST_DBHOST'))
+        context.cnx = koji.db.connect()
+    context.opts = {}
+    context.policy = kojixmlrpc.get_policy(opts, None)
+    context.handlers = kojixmlrpc.HandlerAccess(kojixmlrpc.get_registry(opts, None))
+    context.session = koji.auth.Session(None, hostip='127.0.0.1')
+    print "%i recorded checks" % len(inputs)
+    print "%-24s %12s" % ('cache', 'checks/sec')
+    expected = None
+    for label, cache, group in (('none', False, 1),
+                                ('per check', True, 1),
+                                ('per %i checks' % options.group, True, options.group)):
+        best = None
+        for i in range(options.repeat):
+            start = time.time()
+            results = replay(kojihub, inputs, cache, group)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+            if hasattr(context, 'cnx'):
+                context.cnx.rollback()
+        if expected is None:
+            expected = results
+        elif results != expected:
+            print "%s: results differ!" % label
+            sys.exit(1)
+        print "%-24s %12.1f" % (label, len(inputs) / best)
+
+
+if __name__ == '__main__':
+    main()
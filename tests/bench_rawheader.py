@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+"""Measure rpm header parsing with koji.RawHeader
+
+Reads the signature and main headers out of the given rpms (directories
+are searched for *.rpm) and times, per header:
+
+  - building the index the old way (slicing and multibyte per field)
+  - building the index with RawHeader
+  - reading every entry with RawHeader.get_values
+  - finding the signing key of the signature header (get_sighdr_key, as
+    used by import-sig)
+
+The index built both ways is compared before anything is timed.
+
+Usage: bench_rawheader.py [--repeat N] rpm|dir...
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji
+
+
+def old_index(header):
+    """Build the index as RawHeader did before"""
+    data = [ ord(x) for x in header[8:12] ]
+    il = koji.multibyte(data[:4])
+    index = {}
+    for i in xrange(il):
+        entry = []
+        for j in xrange(4):
+            ofs = 16 + i*16 + j*4
+            data = [ ord(x) for x in header[ofs:ofs+4] ]
+            entry.append(koji.multibyte(data))
+        index[entry[0]] = entry
+    return index
+
+
+def read_headers(paths):
+    """Return a list of (sighdr, hdr) pairs for the rpms found"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend([os.path.join(root, n) for n in names if n.endswith('.rpm')])
+        else:
+            files.append(path)
+    ret = []
+    for fn in files:
+        try:
+            ret.append((koji.rip_rpm_sighdr(fn), koji.rip_rpm_hdr(fn)))
+        except koji.GenericError, e:
+            print "skipping %s: %s" % (fn, e)
+    return ret
+
+
+def all_values(header):
+    rh = koji.RawHeader(header)
+    for tag in rh.index:
+        rh.get_values(tag)
+
+
+def timeit(func, headers, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for header in headers:
+            func(header)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] rpm|dir...")
+    parser.add_option("--repeat", type="int", default=3, help="runs per measurement (best is kept)")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no rpms given")
+    pairs = read_headers(args)
+    if not pairs:
+        parser.error("no rpms found")
+    sighdrs = [p[0] for p in pairs]
+    headers = sighdrs + [p[1] for p in pairs]
+    entries = 0
+    for header in headers:
+        index = koji.RawHeader(header).index
+        if index != old_index(header):
+            print "index differs!"
+            sys.exit(1)
+        entries += len(index)
+    print "%i rpms, %i headers, %i index entries" % (len(pairs), len(headers), entries)
+    print "%-24s %12s" % ('operation', 'headers/sec')
+    for label, func, data in (('index (old)', old_index, headers),
+                              ('index', koji.RawHeader, headers),
+                              ('index + all values', all_values, headers),
+                              ('signing key', koji.get_sighdr_key, sighdrs)):
+        best = timeit(func, data, options.repeat)
+        if best:
+            print "%-24s %12.1f" % (label, len(data) / best)
+        else:
+            print "%-24s %12s" % (label, '-')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+"""Measure the per-call cost of loading the hub session
+
+Needs a scratch PostgreSQL database with the koji schema loaded. Set
+KOJI_TEST_DB to its name (and KOJI_TEST_DBUSER or KOJI_TEST_DBHOST if needed).
+A user and a session are created for the run and deleted afterwards.
+
+Each simulated call loads the session the way the hub does at the start of
+a call, checks a permission and rolls back, as a read-only call would. This
+is timed for anonymous calls, and for logged-in calls with the session
+cache disabled (SessionCacheTTL = 0) and enabled.
+
+Usage: bench_session.py [--calls N]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji
+import koji.auth
+import koji.db
+from koji.context import context
+
+HOSTIP = '127.0.0.2'
+
+
+def create_session(cursor):
+    """Insert a user and a session for it, returning the session args"""
+    cursor.execute("INSERT INTO users (name, status, usertype) VALUES ('bench-session', 0, 0) "
+                   "RETURNING id")
+    user_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO sessions (user_id, key, hostip, authtype, callnum) "
+                   "VALUES (%(user_id)i, 'bench-key', %(hostip)s, 0, 0) RETURNING id",
+                   {'user_id': user_id, 'hostip': HOSTIP})
+    session_id = cursor.fetchone()[0]
+    return user_id, {'session-id': [str(session_id)], 'session-key': ['bench-key']}
+
+
+def call(args, callnum):
+    if args is None:
+        # no session args (as there is no context.req)
+        session = koji.auth.Session(None, HOSTIP)
+    else:
+        args = args.copy()
+        args['callnum'] = [str(callnum)]
+        session = koji.auth.Session(args, HOSTIP)
+    session.hasPerm('admin')
+    context.cnx.rollback()
+
+
+def timeit(args, ttl, calls):
+    context.opts['SessionCacheTTL'] = ttl
+    koji.auth.session_cache.invalidate()
+    call(args, 1)
+    start = time.time()
+    for i in range(calls):
+        call(args, i + 2)
+    return (time.time() - start) / calls * 1000
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--calls", type="int", default=1000, help="calls per measurement")
+    options, args = parser.parse_args()
+    dbname = os.environ.get('KOJI_TEST_DB')
+    if not dbname:
+        parser.error("KOJI_TEST_DB is not set")
+    koji.db.setDBopts(database=dbname,
+                      user=os.environ.get('KOJI_TEST_DBUSER'),
+                      host=os.environ.get('KOJI_TEST_DBHOST'))
+    context.cnx = koji.db.connect()
+    context.opts = {}
+    cursor = context.cnx.cursor()
+    # the session load commits, so the fixture has to be committed too
+    user_id, sinfo = create_session(cursor)
+    context.cnx.commit()
+    try:
+        print "%-24s %10s" % ('call', 'per call')
+        for name, args, ttl in (('anonymous', None, 0),
+                                ('logged in, uncached', sinfo, 0),
+                                ('logged in, cached', sinfo, 3600)):
+            print "%-24s %8.3fms" % (name, timeit(args, ttl, options.calls))
+    finally:
+        context.cnx.rollback()
+        cursor = context.cnx.cursor()
+        cursor.execute("DELETE FROM sessions WHERE user_id = %(user_id)i", {'user_id': user_id})
+        cursor.execute("DELETE FROM users WHERE id = %(user_id)i", {'user_id': user_id})
+        context.cnx.commit()
+
+
+if __name__ == '__main__':
+    main()
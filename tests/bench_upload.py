@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""Measure ClientSession upload throughput against a local stand-in hub
+
+The stand-in hub implements just enough of the hub to accept uploads
+(uploadFile, raw POST uploads, rawUploadEnabled and checkUpload), writing
+into a temporary directory. A fixed delay is added to every request to
+stand in for the round trip to a remote hub.
+
+Usage: bench_upload.py [--size MB] [--latency SECONDS] [--threads N]
+"""
+
+import base64
+import cgi
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import xmlrpclib
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji
+from koji.util import md5_constructor
+
+
+class StandInHub(object):
+    """The upload calls of the hub, writing under topdir"""
+
+    def __init__(self, topdir, raw=True):
+        self.topdir = topdir
+        self.raw = raw
+
+    def path(self, path, name):
+        udir = os.path.join(self.topdir, os.path.normpath(path))
+        koji.ensuredir(udir)
+        return os.path.join(udir, name)
+
+    def write(self, fn, offset, data):
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if offset == 0:
+                os.ftruncate(fd, 0)
+            os.lseek(fd, offset, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def digest(self, fn):
+        sum = md5_constructor()
+        fo = file(fn, 'rb')
+        while True:
+            block = fo.read(819200)
+            if not block:
+                break
+            sum.update(block)
+        fo.close()
+        return sum.hexdigest()
+
+    def uploadFile(self, path, name, size, md5sum, offset, data):
+        contents = base64.decodestring(data)
+        offset = koji.decode_int(offset)
+        size = koji.decode_int(size)
+        fn = self.path(path, name)
+        if offset == -1:
+            fd = os.open(fn, os.O_RDWR)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+            return self.digest(fn) == md5sum
+        if md5_constructor(contents).hexdigest() != md5sum:
+            return False
+        self.write(fn, offset, contents)
+        return True
+
+    def rawUploadEnabled(self):
+        return self.raw
+
+    def checkUpload(self, path, name):
+        fn = self.path(path, name)
+        return {'size': koji.encode_int(os.path.getsize(fn)), 'hexdigest': self.digest(fn)}
+
+    def rawUpload(self, args, data):
+        fn = self.path(args['filepath'][0], args['filename'][0])
+        offset = int(args['offset'][0])
+        self.write(fn, offset, data)
+        if 'size' in args:
+            fd = os.open(fn, os.O_RDWR)
+            try:
+                os.ftruncate(fd, int(args['size'][0]))
+            finally:
+                os.close(fd)
+        return {'offset': koji.encode_int(offset), 'size': len(data),
+                'hexdigest': md5_constructor(data).hexdigest()}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        hub = self.server.hub
+        try:
+            if self.headers.get('Content-Type') == 'application/octet-stream':
+                args = cgi.parse_qs(urlparse.urlsplit(self.path)[3])
+                result = hub.rawUpload(args, data)
+            else:
+                params, method = xmlrpclib.loads(data)
+                params, opts = koji.decode_args(*params)
+                result = getattr(hub, method)(*params, **opts)
+            body = xmlrpclib.dumps((result,), methodresponse=1, allow_none=1)
+        except Exception, e:
+            body = xmlrpclib.dumps(xmlrpclib.Fault(1, str(e)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def run(url, hub, localfile, raw, threads, n):
+    hub.raw = raw
+    session = koji.ClientSession(url, {'retry_interval': 1})
+    # the stand-in hub does not check sessions
+    session.setSession({'session-id': 1, 'session-key': 'bench'})
+    start = time.time()
+    session.uploadWrapper(localfile, 'bench/%i' % n, parallel=threads)
+    elapsed = time.time() - start
+    session.logged_in = False
+    return elapsed
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--size", type="int", default=64, help="file size in MB")
+    parser.add_option("--latency", type="float", default=0.05,
+                      help="delay added to each request, in seconds")
+    parser.add_option("--threads", type="int", default=4, help="threads for parallel uploads")
+    options, args = parser.parse_args()
+    topdir = tempfile.mkdtemp()
+    try:
+        localfile = os.path.join(topdir, 'upload.bin')
+        fo = file(localfile, 'wb')
+        for i in xrange(options.size):
+            fo.write(os.urandom(1048576))
+        fo.close()
+        hub = StandInHub(os.path.join(topdir, 'hub'))
+        server = Server(('127.0.0.1', 0), Handler)
+        server.hub = hub
+        server.latency = options.latency
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        url = 'http://127.0.0.1:%i/kojihub' % server.server_address[1]
+        print "%iMB file, %.3fs latency per request" % (options.size, options.latency)
+        print "%-10s %8s %10s %10s" % ('mode', 'threads', 'seconds', 'MB/s')
+        n = 0
+        for raw in (False, True):
+            for threads in (1, options.threads):
+                n += 1
+                elapsed = run(url, hub, localfile, raw, threads, n)
+                print "%-10s %8i %10.2f %10.1f" % (raw and 'raw' or 'uploadFile', threads,
+                                                   elapsed, options.size / elapsed)
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
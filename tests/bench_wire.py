@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+"""Compare response sizes and call latency of the hub wire encodings
+
+A stand-in hub answers listTagged and listRPMs from a generated fixture,
+encoding its responses the way hub/kojixmlrpc.py does: XML-RPC (with
+koji.fastxmlrpc) or JSON (koji.jsonrpc) depending on the request, gzipped
+when the client accepts it. ClientSession is then timed with the different
+client options.
+
+Usage: bench_wire.py [--rows N] [--calls N] [--latency SECONDS]
+"""
+
+import gzip
+import os
+import sys
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji
+import koji.fastxmlrpc
+import koji.jsonrpc
+from xmlrpclib import loads, Fault
+
+import bench_marshal
+
+
+class StandInHub(object):
+
+    def __init__(self, rows):
+        self.builds = bench_marshal.list_builds(rows)
+        self.rpms = bench_marshal.buildroot_listing(rows)
+
+    def jsonEnabled(self):
+        return True
+
+    def listTagged(self, tag, **opts):
+        return self.builds
+
+    def listRPMs(self, **opts):
+        return self.rpms
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Type') == koji.jsonrpc.CONTENT_TYPE:
+            params, method = koji.jsonrpc.loads(data)
+            dumps = koji.jsonrpc.dumps
+            content_type = koji.jsonrpc.CONTENT_TYPE
+        else:
+            params, method = loads(data)
+            dumps = koji.fastxmlrpc.dumps
+            content_type = 'text/xml'
+        try:
+            params, opts = koji.decode_args(*params)
+            result = getattr(self.server.hub, method)(*params, **opts)
+            response = dumps((result,), methodresponse=1, allow_none=1)
+        except Exception, e:
+            response = dumps(Fault(1, str(e)))
+        self.send_response(200)
+        if self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            sio = StringIO()
+            fo = gzip.GzipFile(fileobj=sio, mode='wb', compresslevel=self.server.gzip)
+            fo.write(response)
+            fo.close()
+            response = sio.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.server.sizes.append(len(response))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+MODES = [('xml', {'keepalive': False}, 0),
+         ('xml keepalive', {}, 0),
+         ('xml gzip', {}, 1),
+         ('json', {'use_json': True}, 0),
+         ('json gzip', {'use_json': True}, 1)]
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--rows", type="int", default=20000, help="rows in each response")
+    parser.add_option("--calls", type="int", default=5, help="calls per measurement")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="delay added to each request, in seconds")
+    options, args = parser.parse_args()
+    if koji.jsonrpc.json is None:
+        parser.error("no json module available")
+    server = Server(('127.0.0.1', 0), Handler)
+    server.hub = StandInHub(options.rows)
+    server.latency = options.latency
+    server.sizes = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = 'http://127.0.0.1:%i/kojihub' % server.server_address[1]
+    print "%i rows per response, %.3fs latency per request" % (options.rows, options.latency)
+    print "%-14s %-12s %12s %10s" % ('mode', 'call', 'bytes', 'seconds')
+    for name, opts, level in MODES:
+        server.gzip = level
+        session = koji.ClientSession(url, opts)
+        for call, args in (('listTagged', ('dist-f13',)), ('listRPMs', ())):
+            # the first call includes the jsonEnabled check
+            session.callMethod(call, *args)
+            server.sizes = []
+            start = time.time()
+            for i in range(options.calls):
+                session.callMethod(call, *args)
+            elapsed = (time.time() - start) / options.calls
+            print "%-14s %-12s %12i %10.3f" % (name, call, server.sizes[-1], elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Helpers for the tests that run against a database
+
+These tests need a scratch PostgreSQL database with the koji schema loaded.
+Set KOJI_TEST_DB to its name (and KOJI_TEST_DBUSER or KOJI_TEST_DBHOST if
+needed) to run them. Without it they are left out of the suite. Everything
+a test does is rolled back afterwards.
+
+A test module lists its database test cases in a suite() function:
+
+    def suite():
+        return dbtest.suite(MyTestCase)
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hub'))
+
+import koji
+import koji.db
+from koji.context import context
+
+
+def configured():
+    """Return true if a test database is configured"""
+    return bool(os.environ.get('KOJI_TEST_DB'))
+
+
+def suite(*classes):
+    """Return a suite of the given test cases, or an empty one without a database"""
+    ret = unittest.TestSuite()
+    if not configured():
+        print >> sys.stderr, "KOJI_TEST_DB not set, skipping %s" \
+              % ', '.join([cls.__name__ for cls in classes])
+        return ret
+    for cls in classes:
+        ret.addTest(unittest.makeSuite(cls))
+    return ret
+
+
+class DBTestCase(unittest.TestCase):
+    """Base class for tests that use the test database
+
+    Each test runs in a transaction that is rolled back afterwards.
+    Subclasses add their data in load_fixture(). self.hub is the kojihub
+    module.
+    """
+
+    def setUp(self):
+        import kojihub
+        self.hub = kojihub
+        koji.db.setDBopts(database=os.environ['KOJI_TEST_DB'],
+                          user=os.environ.get('KOJI_TEST_DBUSER'),
+                          host=os.environ.get('KOJI_TEST_DBHOST'))
+        context.cnx = koji.db.connect()
+        context.opts = {}
+        self.cursor = context.cnx.cursor()
+        try:
+            self.load_fixture()
+        except:
+            # tearDown is not called when setUp fails
+            DBTestCase.tearDown(self)
+            raise
+
+    def tearDown(self):
+        context.cnx.rollback()
+        context._threadclear()
+
+    def load_fixture(self):
+        pass
+
+    def insert(self, query, values=None):
+        """Run an INSERT and return the id of the new row"""
+        self.cursor.execute(query + " RETURNING id", values or {})
+        return self.cursor.fetchone()[0]
+
+    def execute(self, query, values=None):
+        self.cursor.execute(query, values or {})
+
+    def count(self, table, **where):
+        """Return the number of rows of a table matching the given values"""
+        clauses = ['%s = %%(%s)s' % (key, key) for key in where]
+        query = "SELECT COUNT(*) FROM %s" % table
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        self.cursor.execute(query, where)
+        return self.cursor.fetchone()[0]
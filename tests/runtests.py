@@ -26,7 +26,12 @@ for root, dirs, files in os.walk(testDir):
             test_file = test_file[:-3]
             if root_path:
                 test_file = "%s.%s" % (root_path, test_file)
-            suite = unittest.defaultTestLoader.loadTestsFromName(test_file)
+            module = __import__(test_file, globals(), locals(), ['__name__'])
+            if hasattr(module, 'suite'):
+                # the module chooses which of its tests can run here
+                suite = module.suite()
+            else:
+                suite = unittest.defaultTestLoader.loadTestsFromModule(module)
             allTests.addTests(suite._tests)
 
 unittest.TextTestRunner(verbosity=2).run(allTests)
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+"""Simulate task assignment for a fake build fleet
+
+Compares the distributed mode, where each builder polls the load data and
+decides for itself (TaskManager.getNextTask), against the hub scheduler,
+which assigns batches centrally (koji.scheduler.assign_tasks).
+
+Reports assignment latency (task creation to start), fairness of the load
+across hosts (Jain's index of host utilization) and, for the distributed
+mode, how often builders raced for the same task.
+
+Usage: sim_scheduler.py [--hosts N] [--tasks N] [--seed N] ...
+"""
+
+import os
+import random
+import sys
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import koji
+import koji.scheduler
+
+FREE = koji.TASK_STATES['FREE']
+ASSIGNED = koji.TASK_STATES['ASSIGNED']
+OPEN = koji.TASK_STATES['OPEN']
+CLOSED = koji.TASK_STATES['CLOSED']
+
+ARCHES = ['i686', 'x86_64', 'ppc', 'ppc64']
+
+
+class Fleet(object):
+    """A fake set of hosts and a stream of tasks"""
+
+    def __init__(self, nhosts, ntasks, seed=0, rate=2.0, channels=3):
+        rnd = random.Random(seed)
+        self.hosts = []
+        for i in range(nhosts):
+            arches = rnd.sample(ARCHES, rnd.randint(1, 2))
+            chans = [1] + rnd.sample(range(2, channels + 2), rnd.randint(0, 1))
+            self.hosts.append({'id': i + 1,
+                               'name': 'host%i' % (i + 1),
+                               'arches': ' '.join(arches),
+                               'channels': chans,
+                               'capacity': float(rnd.choice([2, 4, 4, 8])),
+                               'task_load': 0.0})
+        # only generate tasks that some host can run
+        bins = koji.scheduler.index_bins(self.hosts).keys()
+        self.tasks = []
+        now = 0.0
+        for i in range(ntasks):
+            now += rnd.expovariate(rate)
+            channel_id, arch = rnd.choice(bins).split(':')
+            self.tasks.append({'id': i + 1,
+                               'state': FREE,
+                               'channel_id': int(channel_id),
+                               'arch': arch,
+                               'host_id': None,
+                               'weight': rnd.choice([0.2, 1.0, 1.0, 1.5, 2.0]),
+                               'priority': rnd.choice([10, 20, 20, 20]),
+                               'create_time': now,
+                               'duration': rnd.expovariate(1.0 / 30)})
+
+
+class Simulation(object):
+    """Run a fleet through one of the assignment modes
+
+    Time advances in steps of tick seconds. Each host polls the hub once
+    every sleeptime seconds, at its own offset.
+    """
+
+    def __init__(self, fleet, mode, sleeptime=15, interval=5, tick=1.0, seed=0):
+        self.mode = mode
+        self.sleeptime = sleeptime
+        self.interval = interval
+        self.tick = tick
+        self.rnd = random.Random(seed)
+        self.hosts = [dict(h) for h in fleet.hosts]
+        self.tasks = [dict(t) for t in fleet.tasks]
+        self.offsets = dict([(h['id'], self.rnd.uniform(0, sleeptime)) for h in self.hosts])
+        self.busy = dict([(h['id'], 0.0) for h in self.hosts])
+        self.collisions = 0
+        self.last_assigned = {}
+
+    def pending(self, now):
+        """Free and assigned tasks, as get_active_tasks would return them"""
+        ret = [t for t in self.tasks
+               if t['create_time'] <= now and t['state'] in (FREE, ASSIGNED)]
+        ret.sort(key=lambda t: (t['priority'], t['create_time']))
+        return ret
+
+    def start(self, task, host, now):
+        task['state'] = OPEN
+        task['host_id'] = host['id']
+        task['start_time'] = now
+        host['task_load'] += task['weight']
+
+    def finish(self, now):
+        for task in self.tasks:
+            if task['state'] == OPEN and task['start_time'] + task['duration'] <= now:
+                task['state'] = CLOSED
+                host = self.hosts[task['host_id'] - 1]
+                host['task_load'] -= task['weight']
+
+    def polling(self, now):
+        """Return the hosts that poll during this tick, in random order"""
+        ret = []
+        for host in self.hosts:
+            phase = (now - self.offsets[host['id']]) % self.sleeptime
+            if phase < self.tick:
+                ret.append(host)
+        self.rnd.shuffle(ret)
+        return ret
+
+    def ready(self, host):
+        return host['task_load'] <= host['capacity']
+
+    def poll_distributed(self, host, hosts, tasks):
+        """One getNextTask call, using load data fetched at the start of the tick"""
+        bin_hosts = koji.scheduler.index_bins(hosts)
+        ours = [h for h in hosts if h['id'] == host['id']][0]
+        our_avail = koji.scheduler.host_avail(ours)
+        bins = dict.fromkeys(koji.scheduler.host_bins(ours))
+        for snap in tasks[:100]:
+            task = self.tasks[snap['id'] - 1]
+            if snap['state'] == ASSIGNED:
+                if snap['host_id'] == host['id']:
+                    return task
+            elif snap['state'] == FREE:
+                bin = koji.scheduler.task_bin(snap)
+                if not bins.has_key(bin):
+                    continue
+                bin_avail = koji.scheduler.bin_avail(bin_hosts[bin])
+                if not koji.scheduler.check_rel_avail(bin_avail, our_avail):
+                    return None
+                if task['state'] != FREE:
+                    # another host opened it since we fetched the load data
+                    self.collisions += 1
+                    continue
+                return task
+        return None
+
+    def poll_central(self, host):
+        assigned = [t for t in self.tasks
+                    if t['state'] == ASSIGNED and t['host_id'] == host['id']]
+        assigned.sort(key=lambda t: (t['priority'], t['create_time']))
+        if assigned:
+            return assigned[0]
+        return None
+
+    def schedule(self, now):
+        hosts = [dict(h) for h in self.hosts if self.ready(h)]
+        tasks = self.pending(now)
+        for task_id, host_id in koji.scheduler.assign_tasks(hosts, tasks,
+                                    last_assigned=self.last_assigned):
+            task = self.tasks[task_id - 1]
+            task['state'] = ASSIGNED
+            task['host_id'] = host_id
+
+    def run(self):
+        now = 0.0
+        last_batch = None
+        end = self.tasks[-1]['create_time']
+        while True:
+            self.finish(now)
+            if self.mode == 'central' and (last_batch is None or now - last_batch >= self.interval):
+                self.schedule(now)
+                last_batch = now
+            polling = self.polling(now)
+            if self.mode == 'distributed':
+                # everyone polling in this tick sees the same load data
+                hosts = [dict(h) for h in self.hosts if self.ready(h)]
+                tasks = [dict(t) for t in self.pending(now)]
+            for host in polling:
+                if not self.ready(host):
+                    continue
+                if self.mode == 'central':
+                    task = self.poll_central(host)
+                else:
+                    task = self.poll_distributed(host, hosts, tasks)
+                if task is not None:
+                    self.start(task, host, now)
+            for host in self.hosts:
+                self.busy[host['id']] += min(host['task_load'], host['capacity']) * self.tick
+            now += self.tick
+            if now > end and not [t for t in self.tasks if t['state'] != CLOSED]:
+                break
+            if now > end * 10 + 3600:
+                # the fleet cannot keep up, stop here
+                break
+        self.end = now
+        return self.report()
+
+    def report(self):
+        latency = [t['start_time'] - t['create_time'] for t in self.tasks if t.has_key('start_time')]
+        latency.sort()
+        ret = {'mode': self.mode,
+               'started': len(latency),
+               'total': len(self.tasks),
+               'collisions': self.collisions}
+        if latency:
+            ret['mean_latency'] = sum(latency) / len(latency)
+            ret['p95_latency'] = latency[int(len(latency) * 0.95) - 1]
+            ret['max_latency'] = latency[-1]
+        util = [self.busy[h['id']] / (h['capacity'] * self.end) for h in self.hosts]
+        ret['fairness'] = jain_index(util)
+        return ret
+
+
+def jain_index(values):
+    """Jain's fairness index: 1.0 when all values are equal, 1/n at worst"""
+    total = sum(values)
+    squares = sum([v * v for v in values])
+    if not squares:
+        return 1.0
+    return total * total / (len(values) * squares)
+
+
+def compare(nhosts=20, ntasks=500, seed=0, rate=2.0, sleeptime=15, interval=5):
+    fleet = Fleet(nhosts, ntasks, seed=seed, rate=rate)
+    results = []
+    for mode in ('distributed', 'central'):
+        sim = Simulation(fleet, mode, sleeptime=sleeptime, interval=interval, seed=seed)
+        results.append(sim.run())
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--hosts", type="int", default=20, help="number of hosts")
+    parser.add_option("--tasks", type="int", default=500, help="number of tasks")
+    parser.add_option("--rate", type="float", default=2.0, help="tasks created per second")
+    parser.add_option("--sleeptime", type="int", default=15, help="host poll interval")
+    parser.add_option("--interval", type="int", default=5, help="hub scheduler batch interval")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    options, args = parser.parse_args()
+    results = compare(options.hosts, options.tasks, options.seed, options.rate,
+                      options.sleeptime, options.interval)
+    print "%-12s %8s %10s %10s %10s %9s %10s" % ('mode', 'started', 'mean lat', 'p95 lat',
+                                                'max lat', 'fairness', 'collisions')
+    for r in results:
+        print "%-12s %4i/%-4i %9.1fs %9.1fs %9.1fs %9.3f %10i" % (r['mode'], r['started'],
+                r['total'], r.get('mean_latency', 0), r.get('p95_latency', 0),
+                r.get('max_latency', 0), r['fairness'], r['collisions'])
+
+
+if __name__ == '__main__':
+    main()
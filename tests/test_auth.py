@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+"""Test the session cache in auth.py"""
+
+import unittest
+
+import koji
+import koji.auth
+from koji.context import context
+
+
+class FakeCursor(object):
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.row = None
+
+    def execute(self, query, values):
+        query = ' '.join(query.split())
+        self.cnx.queries.append(query)
+        if query.startswith('SELECT callnum, expired'):
+            self.row = (self.cnx.callnum, False, None, self.cnx.excl_id)
+        elif query.startswith('SELECT id FROM sessions WHERE user_id'):
+            # the exclusive session lookup
+            self.row = self.cnx.excl_id and (self.cnx.excl_id,) or None
+        elif query.startswith('SELECT') and 'FROM sessions WHERE id' in query:
+            # the full session load, fields are in dict order
+            fields = query[7:query.index(' FROM sessions')].split(',')
+            data = {'authtype': 0, 'callnum': self.cnx.callnum, 'exclusive': None,
+                    'expired': False, 'master': None, 'start_time': None,
+                    'update_time': None, 'EXTRACT(EPOCH FROM start_time)': 0,
+                    'EXTRACT(EPOCH FROM update_time)': 0, 'user_id': 7}
+            self.row = tuple([data[f] for f in fields])
+        elif query.startswith('SELECT name,status,usertype FROM users'):
+            self.row = ('someone', koji.USER_STATUS['NORMAL'], 0)
+        elif query.startswith('UPDATE sessions SET callnum'):
+            self.cnx.callnum = values['callnum']
+        else:
+            self.row = None
+
+    def fetchone(self):
+        return self.row
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.queries = []
+        self.callnum = None
+        self.excl_id = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.queries.append('COMMIT')
+
+
+class SessionCacheTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def setUp(self):
+        context.cnx = FakeConnection()
+        context.opts = {'SessionCacheTTL': 60}
+        koji.auth.session_cache.invalidate()
+        self.args = {'session-id': ['3'], 'session-key': ['key']}
+
+    def tearDown(self):
+        koji.auth.session_cache.invalidate()
+        context._threadclear()
+
+    def load(self, callnum):
+        args = self.args.copy()
+        args['callnum'] = [str(callnum)]
+        return koji.auth.Session(args, '10.0.0.1')
+
+    def test_cache(self):
+        """Test that a cached session is loaded with one query"""
+        cnx = context.cnx
+        session = self.load(1)
+        self.assert_(session.logged_in)
+        self.assertEqual(session.user_id, 7)
+        self.assert_('COMMIT' in cnx.queries)
+        cnx.queries = []
+        session = self.load(2)
+        self.assertEqual(len(cnx.queries), 1)
+        self.assertEqual(session.user_id, 7)
+        self.assertEqual(session.callnum, 2)
+        # callnum is only written on request
+        self.assertEqual(cnx.callnum, None)
+        session.updateCallnum()
+        self.assertEqual(cnx.callnum, 2)
+        self.assertRaises(koji.RetryError, self.load, 2)
+        self.assertRaises(koji.SequenceError, self.load, 1)
+        # a different key is not served from the cache
+        cnx.queries = []
+        self.args['session-key'] = ['other']
+        self.load(3)
+        self.assert_(len(cnx.queries) > 1)
+
+    def test_exclusive(self):
+        """Test that a cached session sees another session take the lock"""
+        cnx = context.cnx
+        self.assertEqual(self.load(1).lockerror, None)
+        # another hub process makes an unrelated session exclusive
+        cnx.excl_id = 99
+        cnx.queries = []
+        session = self.load(2)
+        self.assertEqual(len(cnx.queries), 1)
+        self.assertEqual(session.lockerror, "User locked by another session")
+        cnx.excl_id = None
+        self.assertEqual(self.load(3).lockerror, None)
+
+    def test_invalidate(self):
+        """Test cache invalidation and ttl"""
+        cnx = context.cnx
+        self.load(1)
+        koji.auth.session_cache.invalidate(user_id=7)
+        cnx.queries = []
+        self.load(2)
+        self.assert_(len(cnx.queries) > 1)
+        koji.auth.session_cache.invalidate(session_id=3)
+        cnx.queries = []
+        self.load(3)
+        self.assert_(len(cnx.queries) > 1)
+        context.opts['SessionCacheTTL'] = 0
+        cnx.queries = []
+        self.load(4)
+        self.assert_(len(cnx.queries) > 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+"""Test ClientSession.batch"""
+
+import unittest
+import xmlrpclib
+
+import koji
+
+
+class FakeSession(koji.ClientSession):
+    """A ClientSession that answers multiCall itself"""
+
+    def __init__(self, opts=None):
+        koji.ClientSession.__init__(self, 'http://localhost/kojihub', opts)
+        self.sent = []
+
+    def _callMethod(self, name, args, kwargs):
+        if self.multicall:
+            return koji.ClientSession._callMethod(self, name, args, kwargs)
+        assert name == 'multiCall'
+        calls = args[0]
+        self.sent.append((len(calls), kwargs))
+        ret = []
+        for call in calls:
+            params, opts = koji.decode_args(*call['params'])
+            if call['methodName'] == 'double':
+                ret.append([params[0] * 2])
+            elif call['methodName'] == 'fail':
+                ret.append({'faultCode': koji.ActionNotAllowed.faultCode,
+                            'faultString': params[0]})
+            else:
+                ret.append({'faultCode': 1, 'faultString': 'no such method'})
+        return ret
+
+
+class BatchTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def test_batches(self):
+        """Test that calls are sent in batches and resolve on access"""
+        session = FakeSession({'batch_size': 3})
+        batch = session.batch()
+        results = [batch.double(i) for i in range(7)]
+        self.assertEqual(session.sent, [(3, {}), (3, {})])
+        self.assertEqual(results[0].result, 0)
+        self.assert_(not results[6].done())
+        self.assertEqual(results[6].result, 12)
+        self.assertEqual(session.sent[-1], (1, {}))
+        self.assertEqual([r.result for r in results], range(0, 14, 2))
+        self.assert_(not session.multicall)
+
+    def test_errors(self):
+        """Test that faults are raised on access"""
+        session = FakeSession()
+        batch = session.batch(size=10, readonly=True)
+        ok = batch.double(2)
+        denied = batch.fail('nope')
+        unknown = batch.bogus()
+        batch.flush()
+        self.assertEqual(session.sent, [(3, {'readonly': True})])
+        self.assertEqual(ok.result, 4)
+        try:
+            denied.result
+        except koji.ActionNotAllowed, e:
+            self.assertEqual(str(e), 'nope')
+        else:
+            self.fail('no error raised')
+        self.assertRaises(xmlrpclib.Fault, getattr, unknown, 'result')
+
+
+if __name__ == '__main__':
+    unittest.main()
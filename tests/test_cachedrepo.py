@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+"""Test writing a repo from the package metadata cache
+
+These tests need createrepo. Without it they are left out of the suite.
+"""
+
+import gzip
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.dom.minidom
+
+
+CACHEDREPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../builder/cachedrepo')
+
+try:
+    cachedrepo = imp.load_source('cachedrepo', CACHEDREPO)
+except ImportError:
+    cachedrepo = None
+
+
+PKGS = [('foo', '1', 'x86_64'), ('foo-doc', '1', 'noarch'), ('bar', '2', 'x86_64')]
+
+
+def cached_package(name, version, arch):
+    """Return the cache entry of a package, with xml like createrepo's"""
+    values = {'name': name, 'version': version, 'arch': arch}
+    primary = '''
+<package type="rpm">
+  <name>%(name)s</name>
+  <arch>%(arch)s</arch>
+  <version epoch="0" ver="%(version)s" rel="1"/>
+  <format>
+    <rpm:sourcerpm>%(name)s-%(version)s-1.src.rpm</rpm:sourcerpm>
+  </format>
+</package>''' % values
+    filelists = '''
+<package pkgid="x" name="%(name)s" arch="%(arch)s">
+  <version epoch="0" ver="%(version)s" rel="1"/>
+  <file>/usr/share/%(name)s</file>
+</package>''' % values
+    other = '''
+<package pkgid="x" name="%(name)s" arch="%(arch)s">
+  <version epoch="0" ver="%(version)s" rel="1"/>
+</package>''' % values
+    return cachedrepo.CachedPackage('%(name)s-%(version)s-1.%(arch)s' % values,
+                                    primary, filelists, other)
+
+
+class CachedRepoTestCase(unittest.TestCase):
+    """Check the repos written from the cache"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.tempdir, 'packages')
+        os.mkdir(self.pkgdir)
+        self.relpaths = []
+        for name, version, arch in PKGS:
+            relpath = '%s-%s-1.%s.rpm' % (name, version, arch)
+            file(os.path.join(self.pkgdir, relpath), 'w').close()
+            self.relpaths.append(relpath)
+        self.pkglist = os.path.join(self.tempdir, 'pkglist')
+        fo = file(self.pkglist, 'w')
+        fo.write(''.join([relpath + '\n' for relpath in self.relpaths]))
+        fo.close()
+        # the test packages are not real rpms
+        self.saved_payloadhash = cachedrepo.payloadhash
+        cachedrepo.payloadhash = lambda path: os.path.basename(path)
+
+    def tearDown(self):
+        cachedrepo.payloadhash = self.saved_payloadhash
+        shutil.rmtree(self.tempdir)
+
+    def repo(self):
+        outdir = os.path.join(self.tempdir, 'repo')
+        opts = cachedrepo.parse_args(['-q', '-c', os.path.join(self.tempdir, 'cache'),
+                                      '-i', self.pkglist, '-o', outdir, self.pkgdir])
+        return cachedrepo.CachedRepo(opts)
+
+    def read_md(self, mdtype):
+        outdir = os.path.join(self.tempdir, 'repo')
+        repomd = xml.dom.minidom.parse(os.path.join(outdir, 'repodata/repomd.xml'))
+        for data in repomd.getElementsByTagName('data'):
+            if data.getAttribute('type') == mdtype:
+                href = data.getElementsByTagName('location')[0].getAttribute('href')
+                fo = gzip.open(os.path.join(outdir, href))
+                try:
+                    return xml.dom.minidom.parseString(fo.read())
+                finally:
+                    fo.close()
+        return None
+
+    def test_from_cache(self):
+        """Test that every cached package is written to the repo"""
+        repo = self.repo()
+        for relpath, pkg in zip(self.relpaths, PKGS):
+            repo.cache.set(relpath, relpath, cached_package(*pkg))
+        repo = self.repo()
+        def read_package(relpath):
+            raise AssertionError, "%s not found in the cache" % relpath
+        repo.read_package = read_package
+        repo.write_metadata(self.relpaths)
+        self.assertEqual(repo.cache.hits, len(PKGS))
+        for mdtype in ('primary', 'filelists', 'other'):
+            doc = self.read_md(mdtype)
+            self.assertEqual(doc.documentElement.getAttribute('packages'), str(len(PKGS)))
+            self.assertEqual(len(doc.getElementsByTagName('package')), len(PKGS))
+        names = [node.firstChild.data for node in self.read_md('primary').getElementsByTagName('name')]
+        self.assertEqual(names, ['foo', 'foo-doc', 'bar'])
+
+
+def suite():
+    if cachedrepo is None:
+        print >> sys.stderr, "createrepo not available, skipping CachedRepoTestCase"
+        return unittest.TestSuite()
+    return unittest.makeSuite(CachedRepoTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+"""Test the fastxmlrpc.py module"""
+
+import datetime
+import unittest
+import xmlrpclib
+
+import koji.fastxmlrpc
+
+
+class FastXMLRPCTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def check(self, params, **opts):
+        self.assertEqual(koji.fastxmlrpc.dumps(params, **opts), xmlrpclib.dumps(params, **opts))
+
+    def test_identical(self):
+        """Test that the output matches xmlrpclib"""
+        rows = [{'id': 1, 'name': 'foo & <bar>', 'epoch': None, 'ok': True, 'size': 2L,
+                 'ratio': 0.5, u'uname': u'caf\xe9', 'when': datetime.datetime(2010, 6, 1),
+                 'nested': {'a': [1, 'b', None, (False,)]}, 'empty': {}},
+                {}, [], (), 'str', u'\u2603', -2147483648, 2147483647,
+                xmlrpclib.Binary('\0\1'), xmlrpclib.DateTime(0)]
+        self.check((rows,), methodresponse=1, allow_none=1)
+        self.check((rows, 1, 'two'), methodname='someCall', allow_none=1)
+        self.check(('a', 1), methodname=u'method', encoding='iso-8859-1')
+        self.check(([1, 'x'],))
+        self.check(xmlrpclib.Fault(1000, 'oops <here>'))
+
+    def test_shapes(self):
+        """Test the generated benchmark responses"""
+        import bench_marshal
+        for name, func in bench_marshal.SHAPES:
+            self.check((func(200),), methodresponse=1, allow_none=1)
+
+    def test_errors(self):
+        """Test that the same errors are raised"""
+        for value in (None, [None], {'a': None}):
+            self.assertRaises(TypeError, koji.fastxmlrpc.dumps, (value,))
+        for value in (2 ** 31, [2 ** 31], {'a': -2 ** 31 - 1}, [2L ** 40]):
+            self.assertRaises(OverflowError, koji.fastxmlrpc.dumps, (value,), allow_none=1)
+        self.assertRaises(TypeError, koji.fastxmlrpc.dumps, ({1: 'a'},))
+        loop = []
+        loop.append(loop)
+        self.assertRaises(TypeError, koji.fastxmlrpc.dumps, (loop,))
+        loop = {}
+        loop['a'] = loop
+        self.assertRaises(TypeError, koji.fastxmlrpc.dumps, (loop,))
+        self.assertRaises(TypeError, koji.fastxmlrpc.dumps, ([object()],))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+"""Test the process-wide caches of the hub
+
+The database queries are replaced, so no database is needed. Without the
+hub dependencies (mod_python, pgdb) they are left out of the suite.
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hub'))
+
+from koji.context import context
+
+try:
+    import kojihub
+except ImportError:
+    kojihub = None
+
+
+class HubCacheTestCase(unittest.TestCase):
+    """Check the caches when requests race each other"""
+
+    def setUp(self):
+        self.hub = kojihub
+        self.saved = (kojihub.InheritanceSnapshot, kojihub._fetchMulti)
+        context.opts = {}
+
+    def tearDown(self):
+        self.hub.InheritanceSnapshot, self.hub._fetchMulti = self.saved
+        context._threadclear()
+
+    def test_snapshot_race(self):
+        """Test that a snapshot loaded by another thread meanwhile is used"""
+        cache = self.hub.InheritanceCache()
+        winner = object()
+        def snapshot(event):
+            # another request adds the same event while we load it
+            cache.snapshots[event] = winner
+        self.hub.InheritanceSnapshot = snapshot
+        self.assert_(cache.snapshot(1) is winner)
+        self.assertEqual(cache.snapshots, {1: winner})
+
+    def test_snapshot_threads(self):
+        """Test that many threads loading events keep the cache bounded"""
+        class FakeSnapshot(object):
+            def __init__(self, event):
+                self.event = event
+        self.hub.InheritanceSnapshot = FakeSnapshot
+        cache = self.hub.InheritanceCache()
+        errors = []
+        def worker(start):
+            try:
+                for event in xrange(start, start + 200):
+                    if cache.snapshot(event).event != event:
+                        errors.append('wrong snapshot for %i' % event)
+            except Exception, e:
+                errors.append(str(e))
+        threads = [threading.Thread(target=worker, args=(n * 50,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assert_(len(cache.snapshots) <= cache.max_snapshots)
+
+    def test_host_channels_invalidate(self):
+        """Test that a load overlapping an invalidate is not kept"""
+        cache = self.hub.HostChannelCache()
+        def fetch(query, values):
+            # the channels change while we read them
+            cache.invalidate()
+            return [(1, 1), (1, 2), (2, 1)]
+        self.hub._fetchMulti = fetch
+        self.assertEqual(cache.get(), {1: [1, 2], 2: [1]})
+        self.assertEqual(cache.data, None)
+        self.hub._fetchMulti = lambda query, values: [(1, 1)]
+        self.assertEqual(cache.get(), {1: [1]})
+        self.assertEqual(cache.get(), {1: [1]})
+        self.assertNotEqual(cache.data, None)
+
+
+def suite():
+    if kojihub is None:
+        print >> sys.stderr, "hub dependencies not available, skipping HubCacheTestCase"
+        return unittest.TestSuite()
+    return unittest.makeSuite(HubCacheTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
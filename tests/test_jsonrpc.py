@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+"""Test the jsonrpc.py module
+
+These tests need a json module. Without one they are left out of the suite.
+"""
+
+import sys
+import unittest
+import xmlrpclib
+
+import koji
+import koji.jsonrpc
+
+
+class JSONRPCTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def roundtrip(self, params, **opts):
+        """Check that json and xmlrpc decode to the same values"""
+        j = koji.jsonrpc.loads(koji.jsonrpc.dumps(params, **opts))
+        x = xmlrpclib.loads(xmlrpclib.dumps(params, allow_none=1, **opts))
+        self.assertEqual(j, x)
+        # including the types of strings
+        self.assertEqual(repr(j), repr(x))
+        return j
+
+    def test_roundtrip(self):
+        """Test calls and responses"""
+        value = [{'id': 1, 'name': 'foo & <bar>', 'epoch': None, 'ok': True,
+                  'ratio': 0.5, u'uname': u'caf\xe9', 'utf8': 'caf\xc3\xa9',
+                  'nested': {'a': [1, 'b', None, (False,)]}, 'empty': {}},
+                 [], (), 'str', -2147483648, 2147483647]
+        ret = self.roundtrip((value,), methodresponse=1)
+        self.assertEqual(ret[1], None)
+        params, method = self.roundtrip((value, 'x'), methodname='someCall')
+        self.assertEqual(method, 'someCall')
+        args = koji.encode_args(1, 'two', three=3)
+        params, method = self.roundtrip(tuple(args), methodname='someCall')
+        self.assertEqual(koji.decode_args(*params), ((1, 'two'), {'three': 3}))
+
+    def test_fault(self):
+        """Test fault mapping"""
+        data = koji.jsonrpc.dumps(xmlrpclib.Fault(koji.ActionNotAllowed.faultCode, 'nope'))
+        try:
+            koji.jsonrpc.loads(data)
+        except xmlrpclib.Fault, fault:
+            err = koji.convertFault(fault)
+            self.assert_(isinstance(err, koji.ActionNotAllowed))
+            self.assertEqual(str(err), 'nope')
+        else:
+            self.fail('no fault raised')
+
+    def test_fallback(self):
+        """Test that values JSON cannot carry are refused"""
+        for value in (xmlrpclib.Binary('\0'), xmlrpclib.DateTime(0), 'caf\xe9'):
+            self.assertRaises((TypeError, ValueError), koji.jsonrpc.dumps,
+                              ([value],), methodresponse=1)
+
+
+def suite():
+    if koji.jsonrpc.json is None:
+        print >> sys.stderr, "json not available, skipping JSONRPCTestCase"
+        return unittest.TestSuite()
+    return unittest.makeSuite(JSONRPCTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
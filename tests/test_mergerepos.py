@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+"""Compare the yum and streaming engines of mergerepos
+
+These tests need yum and createrepo. Without them they are left out of the
+suite.
+"""
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import gzip
+import imp
+import os
+import re
+import sha
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urlparse
+import xml.dom.minidom
+from xml.sax.saxutils import unescape
+
+
+MERGEREPOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../builder/mergerepos')
+
+try:
+    mergerepos = imp.load_source('mergerepos', MERGEREPOS)
+except ImportError:
+    mergerepos = None
+
+
+LOCATION_RE = re.compile(r'<location\s([^>]*)>')
+ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+
+
+def location(primary):
+    """Return where a package of a primary.xml is downloaded from
+
+    This resolves xml:base the way yum does. Without one, the location is
+    relative to the merged repo.
+    """
+    attrs = dict(ATTR_RE.findall(LOCATION_RE.search(primary).group(1)))
+    href = unescape(attrs['href'])
+    base = unescape(attrs.get('xml:base', ''))
+    if not base:
+        return href
+    if not base.endswith('/'):
+        base += '/'
+    return urlparse.urljoin(base, href)
+
+
+def pkg_values(pkg):
+    name, epoch, version, release, arch, sourcerpm = pkg
+    ret = {'name': name, 'epoch': epoch, 'version': version, 'release': release,
+           'arch': arch, 'sourcerpm': sourcerpm}
+    ret['pkgid'] = sha.new(repr(pkg)).hexdigest()
+    return ret
+
+
+def primary_xml(pkg):
+    return '''<package type="rpm">
+  <name>%(name)s</name>
+  <arch>%(arch)s</arch>
+  <version epoch="%(epoch)s" ver="%(version)s" rel="%(release)s"/>
+  <checksum type="sha" pkgid="YES">%(pkgid)s</checksum>
+  <summary>%(name)s</summary>
+  <description>%(name)s</description>
+  <packager>Koji</packager>
+  <url></url>
+  <time file="1" build="1"/>
+  <size package="1" installed="1" archive="1"/>
+  <location href="%(name)s-%(version)s-%(release)s.%(arch)s.rpm"/>
+  <format>
+    <rpm:license>GPL</rpm:license>
+    <rpm:vendor>Koji</rpm:vendor>
+    <rpm:group>Test</rpm:group>
+    <rpm:buildhost>localhost</rpm:buildhost>
+    <rpm:sourcerpm>%(sourcerpm)s</rpm:sourcerpm>
+    <rpm:header-range start="1" end="2"/>
+    <rpm:provides>
+      <rpm:entry name="%(name)s" flags="EQ" epoch="%(epoch)s" ver="%(version)s" rel="%(release)s"/>
+    </rpm:provides>
+  </format>
+</package>
+''' % pkg_values(pkg)
+
+
+def filelists_xml(pkg):
+    return '''<package pkgid="%(pkgid)s" name="%(name)s" arch="%(arch)s">
+  <version epoch="%(epoch)s" ver="%(version)s" rel="%(release)s"/>
+  <file>/usr/share/%(name)s</file>
+</package>
+''' % pkg_values(pkg)
+
+
+def other_xml(pkg):
+    values = pkg_values(pkg)
+    values['changelogs'] = ''.join(['  <changelog author="Koji" date="%i">entry %i</changelog>\n' % (i, i)
+                                    for i in range(5)])
+    return '''<package pkgid="%(pkgid)s" name="%(name)s" arch="%(arch)s">
+  <version epoch="%(epoch)s" ver="%(version)s" rel="%(release)s"/>
+%(changelogs)s</package>
+''' % values
+
+
+MD_FILES = [
+    ('primary', '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%i">\n',
+     '</metadata>\n', primary_xml),
+    ('filelists', '<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="%i">\n',
+     '</filelists>\n', filelists_xml),
+    ('other', '<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%i">\n',
+     '</otherdata>\n', other_xml),
+    ]
+
+
+def make_repo(path, pkgs):
+    """Write the xml repodata of a repo with the given packages"""
+    datadir = os.path.join(path, 'repodata')
+    os.makedirs(datadir)
+    repomd = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+              '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n']
+    for mdtype, header, footer, func in MD_FILES:
+        data = '<?xml version="1.0" encoding="UTF-8"?>\n' + header % len(pkgs) \
+                + ''.join([func(pkg) for pkg in pkgs]) + footer
+        fn = os.path.join(datadir, '%s.xml.gz' % mdtype)
+        fo = gzip.GzipFile(fn, 'wb')
+        fo.write(data)
+        fo.close()
+        repomd.append('''  <data type="%s">
+    <location href="repodata/%s.xml.gz"/>
+    <checksum type="sha">%s</checksum>
+    <timestamp>1</timestamp>
+    <open-checksum type="sha">%s</open-checksum>
+  </data>
+''' % (mdtype, mdtype, sha.new(file(fn, 'rb').read()).hexdigest(), sha.new(data).hexdigest()))
+    repomd.append('</repomd>\n')
+    fo = file(os.path.join(datadir, 'repomd.xml'), 'w')
+    fo.write(''.join(repomd))
+    fo.close()
+
+
+REPOS = [
+    [('foo', '0', '1', '1', 'x86_64', 'foo-1-1.src.rpm'),
+     ('foo-doc', '0', '1', '1', 'noarch', 'foo-1-1.src.rpm'),
+     # an older build of foo in the same repo loses
+     ('foo', '0', '0.9', '1', 'x86_64', 'foo-0.9-1.src.rpm'),
+     ('foo-old', '0', '0.9', '1', 'noarch', 'foo-0.9-1.src.rpm'),
+     ('bar', '0', '2', '1', 'x86_64', 'bar-2-1.src.rpm'),
+     ('bar', '0', '2', '1', 'i686', 'bar-2-1.src.rpm'),
+     ('blocked', '0', '1', '1', 'x86_64', 'blocked-1-1.src.rpm'),
+     ('ppconly', '0', '1', '1', 'ppc', 'ppconly-1-1.src.rpm'),
+     # a newer build later in the same repo wins
+     ('qux', '2', '1', '1', 'x86_64', 'qux-1-1.src.rpm'),
+     ('qux', '3', '1.1', '1', 'x86_64', 'qux-1.1-1.src.rpm'),
+     ('amd', '0', '1', '1', 'amd64', 'amd-1-1.src.rpm')],
+    [# the first repo takes precedence for foo, even though this is newer
+     ('foo', '0', '2', '1', 'x86_64', 'foo-2-1.src.rpm'),
+     ('zed', '0', '1', '1', 'x86_64', 'zed-1-1.src.rpm'),
+     ('zed-libs', '1', '1', '1', 'noarch', 'zed-1-1.src.rpm'),
+     ('blocked', '0', '2', '1', 'x86_64', 'blocked-2-1.src.rpm')],
+    [# the same zed build in a later repo is not used again
+     ('zed', '0', '1', '1', 'x86_64', 'zed-1-1.src.rpm'),
+     # but its subpackages that are only here are
+     ('zed-extra', '0', '1', '1', 'noarch', 'zed-1-1.src.rpm'),
+     ('newpkg', '0', '1', '1', 'noarch', 'newpkg-1-1.src.rpm')],
+    ]
+
+
+class RepoHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve the files under the root of the server"""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+
+class MergereposTestCase(unittest.TestCase):
+    """Check that both engines pick the same packages"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.urls = []
+        for i in range(len(REPOS)):
+            path = os.path.join(self.tempdir, 'repo%i' % i)
+            make_repo(path, REPOS[i])
+            self.urls.append('file://%s/' % path)
+        self.blocklist = os.path.join(self.tempdir, 'blocklist')
+        fo = file(self.blocklist, 'w')
+        fo.write('blocked\n')
+        fo.close()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            if hasattr(self.server, 'shutdown'):
+                self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def serve(self):
+        """Serve the repos over http instead"""
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RepoHandler)
+        self.server.root = self.tempdir
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        base = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+        self.urls = [base + 'repo%i/' % i for i in range(len(REPOS))]
+
+    def merge(self, name, extra):
+        """Merge the repos and return the packages and origins of the result
+
+        The packages are (package info, location) pairs.
+        """
+        outdir = os.path.join(self.tempdir, name)
+        args = ['-a', 'x86_64', '-b', self.blocklist, '-o', outdir] + extra
+        for url in self.urls:
+            args.extend(['-r', url])
+        mergerepos.main(args)
+        datadir = os.path.join(outdir, 'repodata')
+        repomd = xml.dom.minidom.parse(os.path.join(datadir, 'repomd.xml'))
+        files = {}
+        for data in repomd.getElementsByTagName('data'):
+            href = data.getElementsByTagName('location')[0].getAttribute('href')
+            files[data.getAttribute('type')] = os.path.join(outdir, href)
+        fo = gzip.open(files['primary'])
+        pkgs = [(mergerepos.package_info(p), location(p)) for p in mergerepos.iter_packages(fo)]
+        fo.close()
+        pkgs.sort()
+        fo = gzip.open(files['origin'])
+        origins = fo.readlines()
+        fo.close()
+        origins.sort()
+        return pkgs, origins
+
+    def test_compare(self):
+        """Test that the streaming merge matches the yum one"""
+        expected = self.merge('yum', [])
+        result = self.merge('stream', ['--stream'])
+        self.assertEqual(result, expected)
+        names = [info[0] for info, loc in result[0]]
+        names.sort()
+        self.assertEqual(names, ['amd', 'bar', 'foo', 'foo-doc', 'newpkg', 'qux', 'zed', 'zed-extra', 'zed-libs'])
+        self.assert_("1:zed-libs-1-1.noarch\t%s\n" % self.urls[1] in result[1])
+        # the packages are downloaded from their own repos
+        for info, loc in result[0]:
+            if info[0] == 'zed-extra':
+                self.assertEqual(loc, self.urls[2] + 'zed-extra-1-1.noarch.rpm')
+            elif info[0] == 'zed-libs':
+                self.assertEqual(loc, self.urls[1] + 'zed-libs-1-1.noarch.rpm')
+
+
+    def test_cached(self):
+        """Test that repos merged through the cache still point at the server"""
+        self.serve()
+        cachedir = os.path.join(self.tempdir, 'cache')
+        expected = self.merge('yum', ['-c', cachedir])
+        result = self.merge('stream', ['--stream', '-c', cachedir])
+        self.assertEqual(result, expected)
+        for info, loc in result[0]:
+            self.assert_(loc.startswith('http://'), loc)
+        self.assert_("1:zed-libs-1-1.noarch\t%s\n" % self.urls[1] in result[1])
+
+
+def suite():
+    if mergerepos is None:
+        print >> sys.stderr, "yum or createrepo not available, skipping MergereposTestCase"
+        return unittest.TestSuite()
+    return unittest.makeSuite(MergereposTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
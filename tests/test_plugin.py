@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+"""Test the async callbacks in plugin.py"""
+
+import threading
+import time
+import unittest
+
+import koji
+import koji.plugin
+from koji.context import context
+
+
+class AsyncCallbackTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def setUp(self):
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.saved = koji.plugin.callbacks['postTag'][:]
+        koji.plugin.callbacks['postTag'] = []
+        def record(cbtype, *args, **kws):
+            self.record(cbtype, *args, **kws)
+        koji.plugin.register_callback('postTag', koji.plugin.ignore_error(record))
+        context.opts = {'AsyncCallbacks': True, 'AsyncCallbackTimeout': 0}
+        self.saved_queue = koji.plugin.callback_queue
+        self.queue = koji.plugin.callback_queue = koji.plugin.CallbackQueue()
+
+    def tearDown(self):
+        self.gate.set()
+        koji.plugin.callbacks['postTag'] = self.saved
+        koji.plugin.callback_queue = self.saved_queue
+        context._threadclear()
+
+    def record(self, cbtype, *args, **kws):
+        self.gate.wait()
+        self.calls.append((cbtype, kws['build']['id']))
+
+    def wait_for(self, count):
+        for i in range(100):
+            if self.queue.stats()['run'] >= count:
+                return
+            time.sleep(0.01)
+        self.fail('callbacks not run')
+
+    def test_deferred(self):
+        """Test that callbacks are run after commit, in the background"""
+        build = {'id': 1}
+        koji.plugin.run_callbacks('postTag', build=build)
+        build['id'] = 2
+        self.assertEqual(self.calls, [])
+        koji.plugin.commit_callbacks()
+        self.wait_for(1)
+        # with the data as it was
+        self.assertEqual(self.calls, [('postTag', 1)])
+        koji.plugin.run_callbacks('postTag', build=build)
+        koji.plugin.discard_callbacks()
+        koji.plugin.commit_callbacks()
+        time.sleep(0.05)
+        self.assertEqual(len(self.calls), 1)
+        # inline when async callbacks are off
+        context.opts['AsyncCallbacks'] = False
+        koji.plugin.run_callbacks('postTag', build=build)
+        self.assertEqual(self.calls[-1], ('postTag', 2))
+
+    def test_full(self):
+        """Test that callbacks are dropped when the queue is full"""
+        context.opts['AsyncCallbackQueueSize'] = 2
+        self.gate.clear()
+        for i in range(5):
+            koji.plugin.run_callbacks('postTag', build={'id': i})
+        koji.plugin.commit_callbacks()
+        stats = self.queue.stats()
+        # one is taken by the worker, two wait in the queue
+        self.assert_(stats['dropped'] >= 2)
+        self.assertEqual(stats['queued'] + stats['dropped'], 5)
+        self.assertEqual(stats['size'], 2)
+        self.gate.set()
+        self.wait_for(stats['queued'])
+        self.assertEqual(self.queue.stats()['failed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
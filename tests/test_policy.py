@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+"""Test the policy.py module"""
+
+import unittest
+
+import koji
+import koji.policy
+
+
+class CountingTest(koji.policy.MatchTest):
+    """Match the color field, counting the runs"""
+    name = 'color'
+    field = 'color'
+    keys = ('color',)
+    runs = 0
+
+    def run(self, data):
+        CountingTest.runs += 1
+        return super(CountingTest, self).run(data)
+
+
+RULES = """
+bool urgent :: allow
+color red blue :: {
+    compare size > 10 :: {
+        color red :: deny big red
+    }
+    match shape square !! allow round
+    all :: deny square
+}
+color green && compare size < 5 :: allow small green
+# nothing matches otherwise
+"""
+
+
+class PolicyTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def setUp(self):
+        tests = koji.policy.findSimpleTests([globals(), vars(koji.policy)])
+        self.ruleset = koji.policy.SimpleRuleSet(RULES.splitlines(), tests)
+        CountingTest.runs = 0
+
+    def check(self, data, expected, cache=None):
+        base = {'urgent': False, 'size': 1, 'shape': 'square', 'color': 'red'}
+        base.update(data)
+        self.assertEqual(self.ruleset.apply(base, cache=cache), expected)
+
+    def test_apply(self):
+        """Test rule evaluation"""
+        self.check({'urgent': True}, 'allow')
+        self.check({'size': 20}, 'deny big red')
+        # falls out of the inner block, on to the next rule
+        self.check({'size': 20, 'color': 'blue', 'shape': 'round'}, 'allow round')
+        self.check({'color': 'blue'}, 'deny square')
+        self.check({'color': 'green'}, 'allow small green')
+        self.check({'color': 'green', 'size': 6}, None)
+        self.assertEqual(self.ruleset.last_rule(), '(no match)')
+        self.check({'size': 20, 'color': 'blue'}, 'deny square')
+        self.assertEqual(self.ruleset.last_rule(), 'color red blue  :: ... all  :: deny square')
+        self.assertEqual(sorted(self.ruleset.all_actions()), ['allow', 'deny'])
+
+    def test_cache(self):
+        """Test that cached test results are reused"""
+        self.check({'color': 'blue', 'size': 20, 'shape': 'round'}, 'allow round')
+        runs = CountingTest.runs
+        cache = {}
+        for i in range(3):
+            self.check({'color': 'blue', 'size': 20, 'shape': 'round'}, 'allow round', cache)
+        self.assertEqual(CountingTest.runs, runs + 2)
+        # different data, new results
+        self.check({'color': 'red', 'size': 20}, 'deny big red', cache)
+        self.assertEqual(CountingTest.runs, runs + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+"""Test the RawHeader class"""
+
+import struct
+import unittest
+
+import koji
+
+
+def make_header(entries):
+    """Build a header from a list of (tag, dtype, count, data) entries"""
+    index = []
+    store = ''
+    for tag, dtype, count, data in entries:
+        index.append(struct.pack('>IIII', tag, dtype, len(store), count))
+        store += data
+    return koji.RPM_HEADER_MAGIC + '\x01' + '\0' * 4 \
+            + struct.pack('>II', len(entries), len(store)) + ''.join(index) + store
+
+
+ENTRIES = [
+    (1000, 6, 1, 'foo\0'),
+    (1001, 8, 3, 'a\0bb\0\0'),
+    (1002, 4, 2, struct.pack('>II', 7, 2**32 - 1)),
+    (1003, 3, 1, struct.pack('>H', 300)),
+    (1004, 7, 5, '\x01\x02\x03\x04\x05'),
+    (1005, 5, 1, struct.pack('>Q', 2**40)),
+    (1006, 2, 3, '\x01\x02\x03'),
+    (1007, 1, 2, 'xy'),
+    (1008, 9, 1, 'i18n\0'),
+    (1009, 0, 0, ''),
+]
+
+
+class RawHeaderTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def test_values(self):
+        """Test reading each data type"""
+        rh = koji.RawHeader(make_header(ENTRIES))
+        self.assertEqual(len(rh.index), len(ENTRIES))
+        self.assertEqual(rh[1000], 'foo')
+        self.assertEqual(rh.get(1002), 7)
+        self.assertEqual(rh.get(1003), 300)
+        self.assertEqual(rh.get(1004), '\x01\x02\x03\x04\x05')
+        self.assertEqual(rh.get(1005), 2**40)
+        self.assertEqual(rh.get(1001), ['a', 'bb', ''])
+        self.assertEqual(rh.get(999, 'x'), 'x')
+        self.assertEqual(rh.get_values(1000), 'foo')
+        self.assertEqual(rh.get_values(1001), ['a', 'bb', ''])
+        self.assertEqual(rh.get_values(1002), [7, 2**32 - 1])
+        self.assertEqual(rh.get_values(1003), [300])
+        self.assertEqual(rh.get_values(1005), [2**40])
+        self.assertEqual(rh.get_values(1006), [1, 2, 3])
+        self.assertEqual(rh.get_values(1007), ['x', 'y'])
+        self.assertEqual(rh.get_values(1008), ['i18n'])
+        self.assertEqual(rh.get_values(1009), None)
+        self.assertEqual(rh.get_values(999), None)
+        # decoded values are kept
+        self.assert_(rh.get_values(1001) is rh.get_values(1001))
+
+    def test_invalid(self):
+        """Test that broken headers are rejected"""
+        data = make_header(ENTRIES)
+        self.assertRaises(koji.GenericError, koji.RawHeader, 'junk' + data)
+        self.assertRaises(koji.GenericError, koji.RawHeader, data[:-1])
+        rh = koji.RawHeader(make_header([(1000, 4, 3, struct.pack('>I', 1))]))
+        self.assertRaises(koji.GenericError, rh.get_values, 1000)
+        rh = koji.RawHeader(make_header([(1000, 8, 2, 'a\0b')]))
+        self.assertRaises(koji.GenericError, rh.get_values, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+"""Test adding rpms and repodata to a repo in the hub
+
+The repo is written to a temporary directory. Host verification and the
+repo lookup are replaced, so no database is needed. Without the hub
+dependencies (mod_python, pgdb) they are left out of the suite.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../hub'))
+
+import koji
+
+try:
+    import kojihub
+except ImportError:
+    kojihub = None
+
+
+class FakeHost(object):
+
+    def verify(self):
+        return True
+
+
+class RepoAddRPMsTestCase(unittest.TestCase):
+    """Check the batched repo calls"""
+
+    def setUp(self):
+        self.hub = kojihub
+        self.saved = (kojihub.Host, kojihub.repo_info, kojihub.repo_expire,
+                      koji.pathinfo.topdir)
+        self.topdir = tempfile.mkdtemp()
+        koji.pathinfo.topdir = self.topdir
+        self.rinfo = {'id': 1, 'tag_name': 'f14-build', 'state': koji.REPO_INIT}
+        kojihub.Host = FakeHost
+        kojihub.repo_info = lambda repo_id, strict=False: self.rinfo
+        kojihub.repo_expire = lambda repo_id: None
+        self.repodir = koji.pathinfo.repo(1, 'f14-build')
+        for arch in ('x86_64', 'i386'):
+            koji.ensuredir(os.path.join(self.repodir, arch, 'RPMS'))
+            koji.ensuredir(os.path.join(self.repodir, arch, 'SRPMS'))
+        koji.ensuredir(os.path.join(self.repodir, 'groups'))
+        self.workdir = os.path.join(koji.pathinfo.work(), 'tasks/1')
+        koji.ensuredir(self.workdir)
+        self.exports = kojihub.HostExports()
+
+    def tearDown(self):
+        (self.hub.Host, self.hub.repo_info, self.hub.repo_expire,
+         koji.pathinfo.topdir) = self.saved
+        shutil.rmtree(self.topdir)
+
+    def upload(self, fn):
+        fo = file(os.path.join(self.workdir, fn), 'w')
+        fo.write(fn)
+        fo.close()
+        return 'tasks/1/%s' % fn
+
+    def rpms(self, arch, subdir='RPMS'):
+        ret = os.listdir(os.path.join(self.repodir, arch, subdir))
+        ret.sort()
+        return ret
+
+    def test_add(self):
+        """Test that every rpm is linked into the right arches"""
+        manifest = [(self.upload('foo-1-1.x86_64.rpm'), 'x86_64', None),
+                    (self.upload('foo-1-1.i686.rpm'), 'i686', None),
+                    (self.upload('foo-doc-1-1.noarch.rpm'), 'noarch', None),
+                    (self.upload('foo-1-1.src.rpm'), 'x86_64', 1)]
+        self.assertEqual(self.exports.repoAddRPMs(1, manifest), 6)
+        self.assertEqual(self.rpms('x86_64'), ['foo-1-1.x86_64.rpm', 'foo-doc-1-1.noarch.rpm'])
+        self.assertEqual(self.rpms('i386'), ['foo-1-1.i686.rpm', 'foo-doc-1-1.noarch.rpm'])
+        self.assertEqual(self.rpms('i386', 'SRPMS'), ['foo-1-1.src.rpm'])
+        # adding the same files again is harmless
+        self.assertEqual(self.exports.repoAddRPMs(1, manifest), 0)
+
+    def test_errors(self):
+        """Test that all problems are reported and nothing is linked"""
+        koji.ensuredir(os.path.join(self.topdir, 'secret'))
+        file(os.path.join(self.repodir, 'x86_64/RPMS/bar-1-1.x86_64.rpm'), 'w').write('old')
+        manifest = [(self.upload('foo-1-1.x86_64.rpm'), 'x86_64', None),
+                    (self.upload('bar-1-1.x86_64.rpm'), 'x86_64', None),
+                    (self.upload('baz-1-1.i686.rpm'), 'x86_64', None),
+                    ('tasks/1/missing-1-1.noarch.rpm', 'noarch', None),
+                    ('tasks/../../secret/evil-1-1.noarch.rpm', 'noarch', None),
+                    ('tasks/1/foo-1-1.x86_64.rpm',)]
+        try:
+            self.exports.repoAddRPMs(1, manifest)
+        except koji.GenericError, e:
+            lines = str(e).splitlines()
+        else:
+            self.fail("no error raised")
+        self.assertEqual(len(lines), 6)
+        self.assert_(lines[1].strip().startswith('File already in repo'))
+        self.assertEqual(self.rpms('x86_64'), ['bar-1-1.x86_64.rpm'])
+
+    def test_repo_done(self):
+        """Test that repodata is moved into place only if all of it is there"""
+        self.upload('repomd.xml')
+        self.upload('primary.xml.gz')
+        data = {'x86_64': ('tasks/1', ['repomd.xml', 'primary.xml.gz']),
+                'i386': ('tasks/1', ['repomd.xml', 'other.xml.gz'])}
+        self.assertRaises(koji.GenericError, self.exports.repoDone, 1, data, True)
+        self.failIf(os.path.exists(os.path.join(self.repodir, 'x86_64/repodata')))
+        del data['i386']
+        self.exports.repoDone(1, data, True)
+        self.assertEqual(os.listdir(self.workdir), [])
+        files = os.listdir(os.path.join(self.repodir, 'x86_64/repodata'))
+        files.sort()
+        self.assertEqual(files, ['primary.xml.gz', 'repomd.xml'])
+
+
+def suite():
+    if kojihub is None:
+        print >> sys.stderr, "hub dependencies not available, skipping RepoAddRPMsTestCase"
+        return unittest.TestSuite()
+    return unittest.makeSuite(RepoAddRPMsTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+"""Compare incremental and full repo generation in the hub
+
+These tests need a test database, see dbtest.py. The repos are written to a
+temporary directory.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dbtest
+import koji
+from koji.context import context
+
+
+class RepoInitTestCase(dbtest.DBTestCase):
+    """Check that both ways of generating a repo agree"""
+
+    def setUp(self):
+        dbtest.DBTestCase.setUp(self)
+        self.topdir = tempfile.mkdtemp()
+        self.saved_topdir = koji.pathinfo.topdir
+        koji.pathinfo.topdir = self.topdir
+
+    def tearDown(self):
+        dbtest.DBTestCase.tearDown(self)
+        koji.pathinfo.topdir = self.saved_topdir
+        shutil.rmtree(self.topdir)
+
+    def execute(self, query, values):
+        values['user'] = self.user
+        self.cursor.execute(query, values)
+
+    def load_fixture(self):
+        self.user = self.insert("INSERT INTO users (name, status, usertype) "
+                                "VALUES ('repo-init-test', 0, 0)")
+        self.tags = {}
+        for name in ('top', 'base'):
+            tag = self.insert("INSERT INTO tag (name) VALUES (%(name)s)",
+                              {'name': 'repo-init-test-' + name})
+            self.execute("""INSERT INTO tag_config (tag_id, arches, creator_id)
+                VALUES (%(tag)i, 'x86_64 i686', %(user)i)""", {'tag': tag})
+            self.tags[name] = tag
+        self.execute("""INSERT INTO tag_inheritance (tag_id, parent_id, priority, creator_id)
+            VALUES (%(top)i, %(base)i, 10, %(user)i)""", self.tags.copy())
+        self.pkgs = {}
+        for i in range(1, 5):
+            self.pkgs[i] = self.insert("INSERT INTO package (name) VALUES (%(name)s)",
+                                       {'name': 'repo-init-test-pkg%i' % i})
+        for i in (1, 2, 3):
+            self.list_pkg('base', i)
+        self.tag_build(self.new_build(1, '1'), 'base')
+        self.tag_build(self.new_build(2, '1'), 'base')
+        self.tag_build(self.new_build(3, '1'), 'top')
+
+    def list_pkg(self, tag, pkg, blocked=False):
+        self.execute("""INSERT INTO tag_packages (package_id, tag_id, owner, blocked, creator_id)
+            VALUES (%(pkg)i, %(tag)i, %(user)i, %(blocked)s, %(user)i)""",
+            {'pkg': self.pkgs[pkg], 'tag': self.tags[tag], 'blocked': blocked})
+
+    def new_build(self, pkg, version):
+        values = {'pkg': self.pkgs[pkg], 'version': version, 'user': self.user,
+                  'state': koji.BUILD_STATES['COMPLETE']}
+        build = self.insert("""INSERT INTO build
+            (pkg_id, version, release, completion_time, state, owner)
+            VALUES (%(pkg)i, %(version)s, '1', NOW(), %(state)i, %(user)i)""", values)
+        for arch in ('src', 'noarch', 'x86_64', 'i686'):
+            for name in ('repo-init-test-pkg%i' % pkg, 'repo-init-test-pkg%i-debuginfo' % pkg):
+                self.execute("""INSERT INTO rpminfo
+                    (build_id, name, version, release, arch, external_repo_id,
+                     payloadhash, size, buildtime)
+                    VALUES (%(build)i, %(name)s, %(version)s, '1', %(arch)s, 0, 'x', 1, 1)""",
+                    {'build': build, 'name': name, 'version': version, 'arch': arch})
+        return build
+
+    def tag_build(self, build, tag):
+        self.execute("""INSERT INTO tag_listing (build_id, tag_id, creator_id)
+            VALUES (%(build)i, %(tag)i, %(user)i)""", {'build': build, 'tag': self.tags[tag]})
+
+    def untag_build(self, build, tag):
+        self.execute("""UPDATE tag_listing SET revoke_event=get_event(), revoker_id=%(user)i,
+            active=NULL WHERE build_id=%(build)i AND tag_id=%(tag)i AND active""",
+            {'build': build, 'tag': self.tags[tag]})
+
+    def read_repo(self, repo_id):
+        ret = {}
+        repodir = koji.pathinfo.repo(repo_id, 'repo-init-test-top')
+        for arch in os.listdir(repodir):
+            for fn in ('pkglist', 'blocklist'):
+                path = os.path.join(repodir, arch, fn)
+                if os.path.isfile(path):
+                    lines = file(path).readlines()
+                    lines.sort()
+                    ret[(arch, fn)] = lines
+        ret['comps'] = file(os.path.join(repodir, 'groups', 'comps.xml')).read()
+        return ret
+
+    def check(self, **kwargs):
+        """Make a repo both ways and compare them"""
+        context.opts['IncrementalRepoInit'] = True
+        repo_id, event_id = self.hub.repo_init(self.tags['top'], **kwargs)
+        self.hub.repo_ready(repo_id)
+        context.opts['IncrementalRepoInit'] = False
+        full_id = self.hub.repo_init(self.tags['top'], event=event_id, **kwargs)[0]
+        self.assertEqual(self.read_repo(repo_id), self.read_repo(full_id))
+        return repo_id
+
+    def test_incremental(self):
+        """Test repos generated from the previous one"""
+        self.check()
+        new = self.new_build(1, '2')
+        self.tag_build(new, 'top')
+        self.check()
+        # blocked and newly listed packages
+        self.list_pkg('top', 2, blocked=True)
+        self.list_pkg('top', 4)
+        self.tag_build(self.new_build(4, '1'), 'base')
+        self.check()
+        self.untag_build(new, 'top')
+        self.check()
+        # different options make a full repo
+        self.check(with_src=True, with_debuginfo=True)
+        self.check(with_src=True, with_debuginfo=True)
+
+
+def suite():
+    return dbtest.suite(RepoInitTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+"""Test the external repodata cache against a local http server"""
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import email.Utils
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import koji
+import koji.repocache
+from koji.util import sha1_constructor
+
+
+class RepoHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve files from the server's topdir, honoring If-Modified-Since"""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.topdir, path.lstrip('/'))
+
+    def send_head(self):
+        self.server.requests.append(self.path)
+        path = self.translate_path(self.path)
+        since = self.headers.getheader('If-Modified-Since')
+        if since and os.path.isfile(path):
+            mtime = email.Utils.formatdate(int(os.stat(path).st_mtime), usegmt=True)
+            if since == mtime:
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+    def log_message(self, *args):
+        pass
+
+
+def write_repo(path, files, mtime):
+    """Write a repo with the given {mdtype: content} repodata files"""
+    datadir = os.path.join(path, 'repodata')
+    koji.ensuredir(datadir)
+    repomd = ['<repomd xmlns="http://linux.duke.edu/metadata/repo">\n']
+    for mdtype, content in files.items():
+        checksum = sha1_constructor(content).hexdigest()
+        fn = '%s-%s.xml.gz' % (checksum, mdtype)
+        fo = file(os.path.join(datadir, fn), 'w')
+        fo.write(content)
+        fo.close()
+        repomd.append('<data type="%s"><location href="repodata/%s"/>'
+                      '<checksum type="sha">%s</checksum><timestamp>1</timestamp></data>\n'
+                      % (mdtype, fn, checksum))
+    repomd.append('</repomd>\n')
+    fn = os.path.join(datadir, 'repomd.xml')
+    fo = file(fn, 'w')
+    fo.write(''.join(repomd))
+    fo.close()
+    os.utime(fn, (mtime, mtime))
+
+
+class RepodataCacheTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RepoHandler)
+        self.server.topdir = os.path.join(self.tempdir, 'www')
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.baseurl = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+        self.cache = koji.repocache.RepodataCache(os.path.join(self.tempdir, 'cache'))
+        self.mirrors = 0
+
+    def tearDown(self):
+        if hasattr(self.server, 'shutdown'):
+            self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def mirror(self, repo, types=None):
+        self.mirrors += 1
+        destdir = os.path.join(self.tempdir, 'mirror%i' % self.mirrors)
+        del self.server.requests[:]
+        ret = self.cache.mirror(self.baseurl + repo, destdir, types)
+        return ret, destdir
+
+    def read(self, destdir, mdtype):
+        for fn in os.listdir(os.path.join(destdir, 'repodata')):
+            if fn.endswith('-%s.xml.gz' % mdtype):
+                return file(os.path.join(destdir, 'repodata', fn)).read()
+        return None
+
+    def test_refresh(self):
+        """Test that files are only downloaded when they change"""
+        www = self.server.topdir
+        files = {'primary': 'primary 1', 'filelists': 'filelists 1', 'other': 'other 1'}
+        write_repo(os.path.join(www, 'f13/x86_64'), files, 1000)
+        (hits, total), destdir = self.mirror('f13/x86_64')
+        self.assertEqual((hits, total), (0, 3))
+        self.assertEqual(self.read(destdir, 'primary'), 'primary 1')
+        self.assertEqual(file(os.path.join(destdir, 'repodata/repomd.xml')).read(),
+                         file(os.path.join(www, 'f13/x86_64/repodata/repomd.xml')).read())
+
+        # unchanged: only repomd.xml is asked for, and not sent again
+        (hits, total), destdir = self.mirror('f13/x86_64')
+        self.assertEqual((hits, total), (3, 3))
+        self.assertEqual(self.server.requests, ['/f13/x86_64/repodata/repomd.xml'])
+        self.assertEqual(self.read(destdir, 'other'), 'other 1')
+
+        # one changed file is downloaded
+        files['primary'] = 'primary 2'
+        write_repo(os.path.join(www, 'f13/x86_64'), files, 2000)
+        (hits, total), destdir = self.mirror('f13/x86_64/')
+        self.assertEqual((hits, total), (2, 3))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.read(destdir, 'primary'), 'primary 2')
+
+        # another url with the same content shares the files
+        write_repo(os.path.join(www, 'f13/i386'), files, 2000)
+        (hits, total), destdir = self.mirror('f13/i386', types=['primary'])
+        self.assertEqual((hits, total), (1, 1))
+        self.assertEqual(self.read(destdir, 'filelists'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (6, 4))
+
+    def test_bad_checksum(self):
+        """Test that corrupt files are not cached"""
+        repodir = os.path.join(self.server.topdir, 'broken')
+        write_repo(repodir, {'primary': 'primary'}, 1000)
+        datadir = os.path.join(repodir, 'repodata')
+        for fn in os.listdir(datadir):
+            if fn.endswith('primary.xml.gz'):
+                file(os.path.join(datadir, fn), 'w').write('garbage')
+        self.assertRaises(koji.GenericError, self.mirror, 'broken')
+        cached = []
+        for root, dirs, files in os.walk(os.path.join(self.tempdir, 'cache', 'objects')):
+            cached.extend(files)
+        self.assertEqual(cached, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+"""Compare the stored and read-from-rpm results of the rpm header calls
+
+These tests need a test database, see dbtest.py.
+"""
+
+import unittest
+
+import dbtest
+import koji
+import rpm
+from koji.context import context
+
+
+class FakeHeader(dict):
+    """An rpm header, as far as the hub looks at it"""
+
+    def __init__(self, fields):
+        dict.__init__(self)
+        for name, value in fields.iteritems():
+            self[getattr(rpm, 'RPMTAG_' + name.upper())] = value
+        self.setdefault(koji.RPM_TAG_FILEDIGESTALGO, None)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+
+HEADER = {
+    'summary': 'A test package',
+    'description': 'Caf\xe9 test',
+    'url': None,
+    'license': 'GPL',
+    'filenames': ['/usr/bin/b', '/usr/bin/a', '/usr/share/c'],
+    'filemd5s': ['11', '22', ''],
+    'filesizes': [10, 300, 0],
+    'fileflags': [0, 0, 1],
+    'fileusername': ['root', 'root', 'root'],
+    'filegroupname': ['root', 'wheel', 'root'],
+    'filemtimes': [100, 200, 300],
+    'filemodes': [0755, 0700, 040755],
+    'requirename': ['libc.so.6', 'bash'],
+    'requireversion': ['', '4.0'],
+    'requireflags': [0, 12],
+    'providename': ['test'],
+    'provideversion': ['1-1'],
+    'provideflags': [8],
+    'conflictname': [],
+    'conflictversion': [],
+    'conflictflags': [],
+    'obsoletename': None,
+    'obsoleteversion': None,
+    'obsoleteflags': None,
+}
+
+
+class RPMHeadersTestCase(dbtest.DBTestCase):
+    """Check that both ways of answering agree"""
+
+    def setUp(self):
+        self.hdr = FakeHeader(HEADER)
+        dbtest.DBTestCase.setUp(self)
+        self.exports = self.hub.RootExports()
+        self.saved = (self.hub.check_rpm_headers, self.hub._rpm_path,
+                      self.hub.store_rpm_headers, koji.get_rpm_header)
+
+    def tearDown(self):
+        (self.hub.check_rpm_headers, self.hub._rpm_path,
+         self.hub.store_rpm_headers, koji.get_rpm_header) = self.saved
+        dbtest.DBTestCase.tearDown(self)
+
+    def load_fixture(self):
+        user_id = self.insert("INSERT INTO users (name, status, usertype) "
+                              "VALUES ('rpmheaders-test', 0, 0)")
+        pkg_id = self.insert("INSERT INTO package (name) VALUES ('rpmheaders-test')")
+        build_id = self.insert("INSERT INTO build (pkg_id, version, release, state, owner, "
+                               "completion_time) "
+                               "VALUES (%(pkg_id)i, '1', '1', 1, %(user_id)i, NOW())", locals())
+        self.rpm_id = self.insert("INSERT INTO rpminfo (build_id, name, version, release, arch, "
+                                  "external_repo_id, payloadhash, size, buildtime) "
+                                  "VALUES (%(build_id)i, 'rpmheaders-test', '1', '1', 'noarch', "
+                                  "0, 'abc', 1, 1)", locals())
+
+    def on_disk(self):
+        """Make the rpm appear to be on disk, with our header"""
+        self.hub._rpm_path = lambda rpm_info: '/fake/rpmheaders-test-1-1.noarch.rpm'
+        koji.get_rpm_header = lambda path: self.hdr
+
+    def stored(self):
+        return (self.count('rpmheaders', rpm_id=self.rpm_id),
+                self.count('rpmfiles', rpm_id=self.rpm_id),
+                self.count('rpmdeps', rpm_id=self.rpm_id))
+
+    def both(self, method, *args, **kwargs):
+        """Return the results of a call from the stored data and the header"""
+        hub = self.hub
+        hub.check_rpm_headers = lambda rpm_info: True
+        stored = getattr(self.exports, method)(*args, **kwargs)
+        hub.check_rpm_headers = lambda rpm_info: self.hdr
+        read = getattr(self.exports, method)(*args, **kwargs)
+        return stored, read
+
+    def test_compare(self):
+        """Test that stored data gives the same results"""
+        self.hub.store_rpm_headers(self.rpm_id, self.hdr)
+        for opts in ({}, {'order': 'name'}, {'order': '-size', 'limit': 2},
+                     {'offset': 1}, {'countOnly': True}, {'asList': True}):
+            stored, read = self.both('listRPMFiles', self.rpm_id, queryOpts=opts)
+            self.assertEqual(stored, read)
+        for opts in ({}, {'order': 'name'}, {'order': '-name', 'limit': 2},
+                     {'offset': 1}, {'countOnly': True}, {'asList': True}):
+            for depType in (None, koji.DEP_REQUIRE, koji.DEP_OBSOLETE):
+                stored, read = self.both('getRPMDeps', self.rpm_id, depType, queryOpts=opts)
+                self.assertEqual(stored, read)
+        for filename in ('/usr/bin/a', '/usr/share/c', '/nothing'):
+            stored, read = self.both('getRPMFile', self.rpm_id, filename)
+            self.assertEqual(stored, read)
+        stored, read = self.both('getRPMHeaders', self.rpm_id,
+                                 headers=['Summary', 'description', 'url'])
+        self.assertEqual(stored, read)
+        self.assertEqual(stored['description'], 'Caf\xc3\xa9 test')
+        self.assertEqual(self.exports.listRPMFiles(self.rpm_id)[0]['name'], '/usr/bin/b')
+
+    def test_backfill(self):
+        """Test that the data of an rpm is stored the first time it is used"""
+        self.on_disk()
+        self.assertEqual(self.stored(), (0, 0, 0))
+        files = self.exports.listRPMFiles(self.rpm_id)
+        self.assertEqual(self.stored(), (1, 3, 3))
+        # now it comes from the database
+        def no_header(path):
+            raise AssertionError, "rpm read again"
+        koji.get_rpm_header = no_header
+        self.assertEqual(self.exports.listRPMFiles(self.rpm_id), files)
+
+    def test_backfill_readonly(self):
+        """Test that read-only calls use the header without storing it"""
+        self.on_disk()
+        context.readonly = True
+        files = self.exports.listRPMFiles(self.rpm_id)
+        self.assertEqual([f['name'] for f in files], ['/usr/bin/b', '/usr/bin/a', '/usr/share/c'])
+        self.assertEqual(self.stored(), (0, 0, 0))
+
+    def test_backfill_race(self):
+        """Test that a failed store (e.g. a concurrent one) leaves the transaction usable"""
+        self.on_disk()
+        store = self.saved[2]
+        def store_twice(rpm_id, hdr):
+            # the second insert hits the primary key, as a concurrent call would
+            store(rpm_id, hdr)
+            store(rpm_id, hdr)
+        self.hub.store_rpm_headers = store_twice
+        files = self.exports.listRPMFiles(self.rpm_id)
+        self.assertEqual(len(files), 3)
+        self.assertEqual(self.stored(), (0, 0, 0))
+        self.hub.store_rpm_headers = store
+        self.exports.listRPMFiles(self.rpm_id)
+        self.assertEqual(self.stored(), (1, 3, 3))
+
+
+def suite():
+    return dbtest.suite(RPMHeadersTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
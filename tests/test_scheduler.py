@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+"""Test the scheduler.py module"""
+
+import unittest
+
+import koji
+import koji.scheduler
+
+FREE = koji.TASK_STATES['FREE']
+ASSIGNED = koji.TASK_STATES['ASSIGNED']
+
+
+def host(id, arches, channels, capacity=4.0, task_load=0.0):
+    return {'id': id, 'name': 'host%i' % id, 'arches': arches, 'channels': channels,
+            'capacity': capacity, 'task_load': task_load}
+
+def task(id, arch='x86_64', channel_id=1, state=FREE, host_id=None, weight=1.0):
+    return {'id': id, 'state': state, 'channel_id': channel_id, 'arch': arch,
+            'host_id': host_id, 'weight': weight}
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """Main test case container"""
+
+    def test_bins(self):
+        """Test the bin helpers"""
+        h = host(1, 'x86_64 i686', [1, 2])
+        bins = koji.scheduler.host_bins(h)
+        bins.sort()
+        self.assertEqual(bins, ['1:i686', '1:noarch', '1:x86_64',
+                                '2:i686', '2:noarch', '2:x86_64'])
+        self.assertEqual(koji.scheduler.task_bin(task(1, 'noarch', 2)), '2:noarch')
+        index = koji.scheduler.index_bins([h, host(2, 'ppc', [1])])
+        self.assertEqual([x['id'] for x in index['1:noarch']], [1, 2])
+        self.assertEqual([x['id'] for x in index['1:ppc']], [2])
+
+    def test_check_rel_avail(self):
+        """Test the median rule"""
+        hosts = [host(1, 'x86_64', [1], 4.0, 1.0), host(2, 'x86_64', [1], 4.0, 3.0),
+                 host(3, 'x86_64', [1], 8.0, 2.0)]
+        avail = koji.scheduler.bin_avail(hosts)
+        self.assertEqual(avail, [6.0, 3.0, 1.0])
+        self.assert_(koji.scheduler.check_rel_avail(avail, 6.0))
+        self.assert_(koji.scheduler.check_rel_avail(avail, 3.0))
+        self.failIf(koji.scheduler.check_rel_avail(avail, 1.0))
+
+    def test_assign_tasks(self):
+        """Test batch assignment"""
+        hosts = [host(1, 'x86_64', [1], 4.0, 0.0), host(2, 'x86_64', [1], 4.0, 2.0),
+                 host(3, 'ppc', [1], 4.0, 0.0)]
+        tasks = [task(10), task(11), task(12, 'ppc'), task(13, 'x86_64', 2), task(14)]
+        ret = koji.scheduler.assign_tasks(hosts, tasks)
+        # most available capacity first, one task per host per batch,
+        # and nobody can take the channel 2 task
+        self.assertEqual(ret, [(10, 1), (11, 2), (12, 3)])
+        ret = koji.scheduler.assign_tasks(hosts, tasks, max_per_host=2)
+        self.assertEqual(ret, [(10, 1), (11, 1), (12, 3), (14, 2)])
+        ret = koji.scheduler.assign_tasks(hosts, tasks, skip_channels=[1])
+        self.assertEqual(ret, [])
+
+    def test_assign_load(self):
+        """Test that assigned tasks and capacity are respected"""
+        hosts = [host(1, 'x86_64', [1], 2.0, 0.0), host(2, 'x86_64', [1], 2.0, 0.0)]
+        # host 1 already has a heavy task waiting for it
+        tasks = [task(10, state=ASSIGNED, host_id=1, weight=2.5), task(11), task(12)]
+        ret = koji.scheduler.assign_tasks(hosts, tasks, max_per_host=5)
+        self.assertEqual(ret, [(11, 2), (12, 2)])
+        # a host at exactly its capacity is full
+        hosts = [host(1, 'x86_64', [1], 2.0, 2.0), host(2, 'x86_64', [1], 2.0, 1.0)]
+        ret = koji.scheduler.assign_tasks(hosts, [task(10), task(11)], max_per_host=5)
+        self.assertEqual(ret, [(10, 2)])
+        # ties go to the least recently assigned host
+        hosts = [host(1, 'x86_64', [1]), host(2, 'x86_64', [1])]
+        last = {}
+        ret = koji.scheduler.assign_tasks(hosts, [task(10)], last_assigned=last)
+        self.assertEqual(ret, [(10, 1)])
+        ret = koji.scheduler.assign_tasks(hosts, [task(11)], last_assigned=last)
+        self.assertEqual(ret, [(11, 2)])
+        ret = koji.scheduler.assign_tasks(hosts, [task(12)], last_assigned=last)
+        self.assertEqual(ret, [(12, 1)])
+
+    def test_simulation(self):
+        """Run a small simulation in both modes"""
+        import sim_scheduler
+        for result in sim_scheduler.compare(nhosts=5, ntasks=50, rate=0.2):
+            self.assertEqual(result['started'], result['total'])
+            self.assert_(0 < result['fairness'] <= 1.0)
+            if result['mode'] == 'central':
+                self.assertEqual(result['collisions'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
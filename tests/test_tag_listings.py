@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+"""Compare the set-based and per-tag inherited listings in the hub
+
+These tests need a test database (PostgreSQL 8.4 or later), see dbtest.py.
+"""
+
+import unittest
+
+import dbtest
+import koji
+from koji.context import context
+
+
+class TagListingTestCase(dbtest.DBTestCase):
+    """Check that both listing engines agree"""
+
+    def setUp(self):
+        dbtest.DBTestCase.setUp(self)
+        self.hub.inheritance_cache.invalidate()
+
+    def tearDown(self):
+        dbtest.DBTestCase.tearDown(self)
+        self.hub.inheritance_cache.invalidate()
+
+    def load_fixture(self):
+        user = self.insert("INSERT INTO users (name, status, usertype) "
+                           "VALUES ('listing-test', 0, 0)")
+        self.user = user
+        tags = {}
+        for name in ('top', 'mid', 'base', 'extra'):
+            tags[name] = self.insert("INSERT INTO tag (name) VALUES (%(name)s)",
+                                     {'name': 'listing-test-' + name})
+        self.tags = tags
+        # top -> mid -> base, and top -> extra (with a package filter)
+        # base also appears via extra, so it shows up twice in the inheritance
+        links = [('top', 'mid', 10, ''), ('top', 'extra', 20, '^listing-test-pkg[12]$'),
+                 ('mid', 'base', 10, ''), ('extra', 'base', 10, '')]
+        for child, parent, priority, pkg_filter in links:
+            self.cursor.execute("""INSERT INTO tag_inheritance
+                (tag_id, parent_id, priority, pkg_filter, creator_id)
+                VALUES (%(child)i, %(parent)i, %(priority)i, %(pkg_filter)s, %(user)i)""",
+                {'child': tags[child], 'parent': tags[parent], 'priority': priority,
+                 'pkg_filter': pkg_filter, 'user': user})
+        pkgs = {}
+        for i in range(1, 7):
+            name = 'pkg%i' % i
+            pkgs[name] = self.insert("INSERT INTO package (name) VALUES (%(name)s)",
+                                     {'name': 'listing-test-' + name})
+        # pkg1-pkg3 listed at the top, pkg3 blocked in mid,
+        # pkg5 only listed in base, pkg6 never listed
+        listed = [('top', 'pkg1', False), ('top', 'pkg2', False), ('top', 'pkg3', False),
+                  ('top', 'pkg4', False), ('mid', 'pkg3', True), ('base', 'pkg5', False)]
+        for tag, pkg, blocked in listed:
+            self.cursor.execute("""INSERT INTO tag_packages
+                (package_id, tag_id, owner, blocked, creator_id)
+                VALUES (%(pkg)i, %(tag)i, %(user)i, %(blocked)s, %(user)i)""",
+                {'pkg': pkgs[pkg], 'tag': tags[tag], 'user': user, 'blocked': blocked})
+        # several builds per package, tagged into different levels
+        tagged = [('pkg1', '1', ['base']), ('pkg1', '2', ['mid', 'extra']), ('pkg1', '3', ['top']),
+                  ('pkg2', '1', ['base', 'extra']), ('pkg2', '2', ['base']),
+                  ('pkg3', '1', ['mid']), ('pkg3', '2', ['base']),
+                  ('pkg4', '1', ['extra']), ('pkg4', '2', ['base']),
+                  ('pkg5', '1', ['base']), ('pkg6', '1', ['top'])]
+        for pkg, version, taglist in tagged:
+            build = self.insert("""INSERT INTO build
+                (pkg_id, version, release, completion_time, state, owner)
+                VALUES (%(pkg)i, %(version)s, '1', NOW(), %(state)i, %(user)i)""",
+                {'pkg': pkgs[pkg], 'version': version, 'user': user,
+                 'state': koji.BUILD_STATES['COMPLETE']})
+            for arch in ('src', 'noarch', 'x86_64'):
+                self.cursor.execute("""INSERT INTO rpminfo
+                    (build_id, name, version, release, arch, external_repo_id,
+                     payloadhash, size, buildtime)
+                    VALUES (%(build)i, %(name)s, %(version)s, '1', %(arch)s, 0, 'x', 1, 1)""",
+                    {'build': build, 'name': 'listing-test-' + pkg, 'version': version,
+                     'arch': arch})
+            for tag in taglist:
+                # each insert gets its own event, so the ordering is well defined
+                self.cursor.execute("""INSERT INTO tag_listing (build_id, tag_id, creator_id)
+                    VALUES (%(build)i, %(tag)i, %(user)i)""",
+                    {'build': build, 'tag': tags[tag], 'user': user})
+
+    def compare(self, func, *args, **kwargs):
+        context.opts['SetBasedListings'] = False
+        expected = func(*args, **kwargs)
+        context.opts['SetBasedListings'] = True
+        got = func(*args, **kwargs)
+        self.assertEqual(expected, got)
+        return got
+
+    def compare_rpms(self, *args, **kwargs):
+        # rpm order within a single tag is not defined
+        context.opts['SetBasedListings'] = False
+        expected_rpms, expected_builds = self.hub.readTaggedRPMS(*args, **kwargs)
+        context.opts['SetBasedListings'] = True
+        rpms, builds = self.hub.readTaggedRPMS(*args, **kwargs)
+        self.assertEqual(expected_builds, builds)
+        for rpmlist in expected_rpms, rpms:
+            rpmlist.sort(key=lambda r: (r['id'], r.get('sigkey')))
+        self.assertEqual(expected_rpms, rpms)
+
+    def test_tagged_builds(self):
+        """Compare readTaggedBuilds output"""
+        for tag in self.tags.values():
+            for inherit in (False, True):
+                for latest in (False, True):
+                    self.compare(self.hub.readTaggedBuilds, tag, inherit=inherit, latest=latest)
+        builds = self.compare(self.hub.readTaggedBuilds, self.tags['top'], inherit=True, latest=True)
+        nvrs = [b['nvr'] for b in builds]
+        nvrs.sort()
+        self.assertEqual(nvrs, ['listing-test-pkg1-3-1', 'listing-test-pkg2-2-1',
+                                'listing-test-pkg3-1-1', 'listing-test-pkg4-2-1',
+                                'listing-test-pkg5-1-1'])
+        self.compare(self.hub.readTaggedBuilds, self.tags['top'], inherit=True, latest=True,
+                     package='listing-test-pkg2')
+
+    def test_tagged_rpms(self):
+        """Compare readTaggedRPMS output"""
+        for tag in self.tags.values():
+            for inherit in (False, True):
+                for latest in (False, True):
+                    self.compare_rpms(tag, inherit=inherit, latest=latest)
+        self.compare_rpms(self.tags['top'], inherit=True, latest=True,
+                          arch=['noarch', 'src'], rpmsigs=True)
+        self.compare_rpms(self.tags['top'], inherit=True, arch='x86_64')
+
+
+def suite():
+    return dbtest.suite(TagListingTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+"""Test waiting for task events in the hub
+
+These tests need a test database, see dbtest.py.
+"""
+
+import time
+import unittest
+
+import dbtest
+import koji
+from koji.context import context
+
+
+class FakeSession(object):
+
+    def __init__(self, host_id):
+        self.host_id = host_id
+
+    def getHostId(self):
+        return self.host_id
+
+
+class TaskEventsTestCase(dbtest.DBTestCase):
+    """Check waitForTaskEvents"""
+
+    def load_fixture(self):
+        user = self.insert("INSERT INTO users (name, status, usertype) "
+                           "VALUES ('task-events-test', 0, 1)")
+        self.host_id = self.insert("INSERT INTO host (user_id, name, arches) "
+                                   "VALUES (%(user)i, 'task-events-test', 'x86_64')",
+                                   {'user': user})
+        values = {'user': user, 'host': self.host_id,
+                  'open': koji.TASK_STATES['OPEN'], 'closed': koji.TASK_STATES['CLOSED']}
+        self.parent = self.insert("""INSERT INTO task
+            (state, channel_id, host_id, waiting, owner, method, arch)
+            VALUES (%(open)i, 1, %(host)i, TRUE, %(user)i, 'build', 'noarch')""", values)
+        values['parent'] = self.parent
+        self.insert("""INSERT INTO task
+            (state, channel_id, parent, awaited, owner, method, arch)
+            VALUES (%(closed)i, 1, %(parent)i, TRUE, %(user)i, 'buildArch', 'x86_64')""",
+            values)
+        context.session = FakeSession(self.host_id)
+
+    def committed(self):
+        """Return true if our tasks can be seen from another connection"""
+        cnx = koji.db.connect()
+        try:
+            c = cnx.cursor()
+            c.execute("SELECT COUNT(*) FROM task WHERE id = %(id)i", {'id': self.parent})
+            return c.fetchone()[0] != 0
+        finally:
+            cnx.close()
+
+    def test_alerts(self):
+        """Test that finished subtasks are reported within our transaction"""
+        host = self.hub.Host()
+        self.assertEqual(host.waitForTaskEvents(5), [self.parent])
+        self.assertEqual(self.count('task', parent=self.parent), 1)
+        self.failIf(self.committed())
+
+    def test_timeout(self):
+        """Test that waiting out the timeout leaves our transaction alone"""
+        host = self.hub.Host()
+        start = time.time()
+        self.assertEqual(host.waitForTaskEvents(0.5, [self.parent]), [])
+        self.assert_(time.time() - start >= 0.5)
+        self.assertEqual(self.count('task', parent=self.parent), 1)
+        self.failIf(self.committed())
+
+
+def suite():
+    return dbtest.suite(TaskEventsTestCase)
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
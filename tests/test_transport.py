@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+"""Test when the persistent transport sends a request again"""
+
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import unittest
+
+from koji.ssl.XMLRPCServerProxy import Plg_PersistentTransport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer POSTs, counting them by path
+
+    /close answers and then drops the connection without saying so, as a
+    server closing an idle connection would. /slow answers after a second.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(self.path)
+        if self.path == '/slow':
+            time.sleep(1)
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # e.g. answering a client that gave up waiting
+        pass
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.host = '127.0.0.1:%i' % self.server.server_address[1]
+        self.transport = Plg_PersistentTransport(timeout=0.3)
+
+    def tearDown(self):
+        self.transport.close()
+        if hasattr(self.server, 'shutdown'):
+            self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path):
+        return self.transport.post(self.host, path, 'request', 'text/plain')[1]
+
+    def test_closed_connection(self):
+        """Test that a request on a connection the server closed is sent again"""
+        self.assertEqual(self.post('/close'), 'ok')
+        # let the server finish closing the connection
+        time.sleep(0.2)
+        self.assertEqual(self.post('/next'), 'ok')
+        self.assertEqual(self.server.requests, ['/close', '/next'])
+
+    def test_timeout(self):
+        """Test that a request that timed out is not sent again"""
+        self.assertEqual(self.post('/first'), 'ok')
+        self.assertRaises(socket.timeout, self.post, '/slow')
+        # long enough for a second copy to have arrived
+        time.sleep(1.5)
+        self.assertEqual(self.server.requests, ['/first', '/slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
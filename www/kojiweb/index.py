@@ -366,6 +366,7 @@ _TASKS = ['build',
           'tagBuild',
           'newRepo',
           'createrepo',
+          'createrepoMulti',
           'buildNotification',
           'tagNotification',
           'dependantTask',